@@ -0,0 +1,104 @@
+"""Limits on how much work a single peer can make a node do."""
+import threading
+import time
+
+from blockchain_constants import *
+from cache import LRUCache
+
+
+class TokenBucket(object):
+    """
+    Allows rate actions per second on average, and bursts of up to burst.
+
+    :ivar tokens: Actions allowed right now
+    :ivar updated: Time tokens was last refilled
+    """
+    __slots__ = ['rate', 'burst', 'tokens', 'updated']
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time() if now is None else now
+
+    def take(self, n=1, now=None):
+        """
+        Takes up to n tokens.
+
+        :return: Number of tokens taken, less than n if the bucket ran out
+        """
+        now = time.time() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        taken = min(n, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate=MSG_RATE_LIMIT, burst=MSG_RATE_BURST, capacity=RATE_LIMITER_SIZE):
+        """
+        A TokenBucket per host.
+
+        Buckets of the capacity most recently seen hosts are kept. A host
+        whose bucket was evicted starts again with a full one, which it
+        could have refilled in the meantime anyway.
+
+        :param rate: Actions per second allowed per host
+        :param burst: Actions a host can take at once
+        :param capacity: Hosts tracked
+        """
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = LRUCache(capacity)  # host -> TokenBucket
+
+    def take(self, host, n=1):
+        """
+        :return: How many of n actions host may take now
+        """
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets.put(host, bucket)
+            return bucket.take(n)
+
+    def allow(self, host):
+        """Whether host may take one action now."""
+        return self.take(host) == 1
+
+
+class ConnectionLimiter(object):
+
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST):
+        """
+        Counts the open connections from each host.
+
+        :param max_per_host: Connections a host may have open at once
+        """
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.counts = {}  # host -> open connections
+
+    def acquire(self, host):
+        """
+        Counts a new connection from host, unless it already has max_per_host.
+
+        :return: Whether the connection may be served. If so, release() it once closed.
+        """
+        with self.lock:
+            count = self.counts.get(host, 0)
+            if count >= self.max_per_host:
+                return False
+            self.counts[host] = count + 1
+            return True
+
+    def release(self, host):
+        with self.lock:
+            count = self.counts.get(host, 0)
+            if count <= 1:
+                self.counts.pop(host, None)
+            else:
+                self.counts[host] = count - 1
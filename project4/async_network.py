@@ -0,0 +1,257 @@
+"""asyncio version of the peer server, for nodes with many concurrent peers."""
+import asyncio
+import io
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from blockchain_constants import *
+from link import FRAME_CONTROL, FRAME_HEADER, FrameWriter, KEEPALIVE_ID, pack_frame
+from network import Server
+
+# Number of lines following the command line, for commands with a fixed size
+PAYLOAD_LINES = {
+    "LINK": 0,
+    "PEER_REQUEST": 0,
+    "PEERS_REQUEST": 0,
+    "MESSAGE_BROADCAST": 1,
+    "BLOCK_BROADCAST": 1,
+    "BLOCK_REQUEST": 1,
+    "HEADERS_REQUEST": 1,
+    "UPDATE_REQUEST": 1,
+    "UPDATE_STREAM": 1,
+}
+
+# Largest batch accepted by commands with a count line followed by that many lines
+BATCH_LIMITS = {
+    "MESSAGES_BROADCAST": MSG_BUFFER_SIZE,
+    "BLOCKS_BROADCAST": BROADCAST_BATCH_SIZE,
+    "INV": BROADCAST_BATCH_SIZE,
+    "BLOCKS_REQUEST": SYNC_BATCH_SIZE,
+}
+
+
+async def read_frame(reader):
+    """
+    Reads a peer link frame (see link.py) from a StreamReader.
+
+    :return: (request_id, flags, payload), or None at the end of the stream
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise ValueError("Truncated frame header")
+    length, request_id, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame of %d bytes too large" % length)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ValueError("Truncated frame")
+    return request_id, flags, payload
+
+
+class StreamWriterFile(object):
+    """
+    File-like wrapper around an asyncio StreamWriter for use from a worker thread.
+
+    Writes are buffered until flush(), which hands the data to the event loop
+    and waits for the transport to drain. A peer that reads slowly therefore
+    blocks only the worker thread serving it, rather than growing the
+    transport's buffer without bound.
+    """
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.buffer = []
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        data = "".join(self.buffer).encode()
+        self.buffer = []
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result(TIMEOUT)
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class AsyncServer(Server):
+
+    def __init__(self, blockchain, do_peering, accept_blocks, accept_non_local_msgs,
+                 backlog=SERVER_BACKLOG, max_connections=MAX_CONNECTIONS,
+                 handler_threads=ASYNC_HANDLER_THREADS):
+        """
+        Serves the same line protocol as Server from a single asyncio event loop.
+
+        Connections are accepted and their requests read on the event loop, so
+        an idle or slow peer costs a socket rather than a thread. Once a
+        request has been read it is handled by Server.handle_request on a
+        bounded pool of threads, since the Blockchain calls it makes can block.
+
+        :param backlog: Pending connections the listening socket queues
+        :param max_connections: Concurrent connections to serve. Further
+                                connections are sent "ERROR Server busy". A
+                                single IP address may have at most
+                                MAX_CONNECTIONS_PER_HOST of them.
+        :param handler_threads: Threads handling requests
+        """
+        super().__init__(blockchain, do_peering, accept_blocks, accept_non_local_msgs)
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.connections = 0
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads)
+
+    def run(self):
+        asyncio.run(self.serve(start_threads=True))
+
+    async def serve(self, host='', port=DEFAULT_PORT, start_threads=False):
+        """
+        Listens on port and serves peers until cancelled.
+
+        :param start_threads: Whether to catch up with our peers and start the
+                              broadcast and update threads once listening
+        """
+        try:
+            server = await asyncio.start_server(self.handle_stream, host, port,
+                                                backlog=self.backlog, limit=MAX_LINE_LENGTH)
+            self.log.info("Started up on port %d" % port)
+        except OSError:
+            self.log.error("Unable to start on port %d" % port)
+            exit()
+
+        if start_threads:
+            await asyncio.get_running_loop().run_in_executor(None, self.start_background_threads)
+
+        async with server:
+            await server.serve_forever()
+
+    async def read_request(self, reader):
+        """
+        Reads a whole request from the peer.
+
+        :return: The request lines, including the command line. The command
+                 line is empty if the peer closed the connection.
+        """
+        command_line = await reader.readline()
+        lines = [command_line]
+        command = command_line.decode().strip()
+
+        if command in BATCH_LIMITS:
+            count_line = await reader.readline()
+            lines.append(count_line)
+            try:
+                count = int(count_line.decode().strip())
+            except ValueError:
+                count = 0
+            # Larger batches are refused by handle_request without reading them
+            if count <= BATCH_LIMITS[command]:
+                for _ in range(count):
+                    lines.append(await reader.readline())
+        else:
+            for _ in range(PAYLOAD_LINES.get(command, 0)):
+                lines.append(await reader.readline())
+
+        return [line.decode() for line in lines]
+
+    async def handle_stream(self, reader, writer):
+        cl_addr = writer.get_extra_info('peername')
+        self.maintain()
+
+        try:
+            if self.connections >= self.max_connections:
+                self.log.debug("Thread: %d - From: %s - Warning: Denied, server busy" %
+                               (threading.get_ident() % 10000, str(cl_addr)))
+                writer.write(b"ERROR Server busy\n")
+                await writer.drain()
+                return
+
+            if not self.connection_limiter.acquire(cl_addr[0]):
+                self.log.debug("Thread: %d - From: %s - Warning: Denied, too many connections" %
+                               (threading.get_ident() % 10000, str(cl_addr)))
+                writer.write(b"ERROR Too many connections\n")
+                await writer.drain()
+                return
+
+            self.connections += 1
+            try:
+                lines = await asyncio.wait_for(self.read_request(reader), REQUEST_TIMEOUT)
+                if lines[0] == '':
+                    # Closed without sending a command
+                    return
+                if lines[0].strip() == "LINK":
+                    await self.serve_link(reader, writer, cl_addr)
+                    return
+                f_in = io.StringIO("".join(lines))
+                f_out = StreamWriterFile(writer, asyncio.get_running_loop())
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.handle_request, f_in, f_out, cl_addr)
+            finally:
+                self.connections -= 1
+                self.connection_limiter.release(cl_addr[0])
+
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            self.log.debug("Thread: %d - From: %s - Connection timed out or reset" %
+                           (threading.get_ident() % 10000, str(cl_addr)))
+        except:
+            self.log.error("Thread: %d - From: %s - Exception in handling connection\n%s" %
+                           (threading.get_ident() % 10000, str(cl_addr), traceback.format_exc()))
+        finally:
+            writer.close()
+
+    async def serve_link(self, reader, writer, cl_addr):
+        """
+        Serves a peer link (see link.py) until the peer closes it or it is
+        idle for LINK_IDLE_TIMEOUT.
+
+        Request frames are handled concurrently on the handler threads, at
+        most LINK_MAX_IN_FLIGHT of them at once. Frames are not read while
+        the link is at that limit. Credit and cancel frames are passed to the
+        FrameWriter of their request.
+        """
+        loop = asyncio.get_running_loop()
+
+        async def send(data):
+            writer.write(data)
+            await writer.drain()
+
+        def send_frame(request_id, flags, payload):
+            # Called from handler threads
+            asyncio.run_coroutine_threadsafe(send(pack_frame(request_id, flags, payload)), loop).result(TIMEOUT)
+
+        await send(b"ACK\n")
+        handlers = set()
+        frame_writers = {}  # request id -> FrameWriter of requests being handled
+        try:
+            while True:
+                frame = await asyncio.wait_for(read_frame(reader), LINK_IDLE_TIMEOUT)
+                if frame is None:
+                    break
+                request_id, flags, payload = frame
+                if request_id == KEEPALIVE_ID:
+                    await send(pack_frame(KEEPALIVE_ID, 0, b''))
+                    continue
+                if flags & FRAME_CONTROL:
+                    frame_writer = frame_writers.get(request_id)
+                    if frame_writer is not None:
+                        frame_writer.control(flags, payload)
+                    continue
+                if len(handlers) >= LINK_MAX_IN_FLIGHT:
+                    await asyncio.wait(handlers, return_when=asyncio.FIRST_COMPLETED)
+                frame_writers[request_id] = frame_writer = FrameWriter(send_frame, request_id)
+                handler = loop.run_in_executor(self.executor, self.handle_frame, payload, frame_writer, cl_addr)
+                handlers.add(handler)
+                handler.add_done_callback(handlers.discard)
+                handler.add_done_callback(lambda _, request_id=request_id: frame_writers.pop(request_id, None))
+        finally:
+            for frame_writer in list(frame_writers.values()):
+                frame_writer.cancel()
+            if len(handlers) > 0:
+                await asyncio.wait(handlers)
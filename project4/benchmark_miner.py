@@ -0,0 +1,109 @@
+"""
+Benchmarks the miner's idle CPU use and how quickly it restarts mining after
+a new block arrives.
+
+Run from the project4 directory (the Blockchain loads the keys in it):
+
+    python3 benchmark_miner.py [idle_seconds] [interrupts]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from blockchain import Blockchain
+from blockchain_constants import *
+from objects import Block, get_collusion_message
+
+SAMPLE_LEDGER = 'tests/chain_data/ledger.txt'
+
+
+def get_benchmark_blockchain(directory):
+    ledger_file = os.path.join(directory, LEDGER_FILE)
+    shutil.copy(SAMPLE_LEDGER, ledger_file)
+    return Blockchain(ledger_file, os.path.join(directory, MESSAGE_FILE), os.path.join(directory, STATS_FILE))
+
+
+def start_miner(blockchain):
+    thread = threading.Thread(target=blockchain.mine)
+    thread.daemon = True
+    thread.start()
+    while blockchain.mining_pool is None:
+        time.sleep(WAIT_TIME)
+
+
+def benchmark_idle_cpu(blockchain, seconds):
+    """Returns the fraction of a core this process uses while the miner waits for messages."""
+    start_cpu = time.process_time()
+    start_wall = time.time()
+    time.sleep(seconds)
+    return (time.process_time() - start_cpu) / (time.time() - start_wall)
+
+
+def benchmark_interrupts(blockchain, interrupts):
+    """Returns the seconds between each peer block being added and the miner submitting new work."""
+    submitted = threading.Event()
+    submit = blockchain.mining_pool.submit
+
+    def timed_submit(suffix):
+        job_id = submit(suffix)
+        submitted.set()
+        return job_id
+
+    blockchain.mining_pool.submit = timed_submit
+
+    with blockchain.lock:
+        for _ in range(MSGS_PER_BLOCK):
+            blockchain.message_queue.append(get_collusion_message(blockchain.keys))
+        blockchain.chain_changed.notify_all()
+    submitted.wait()
+
+    latencies = []
+    for _ in range(interrupts):
+        # The miner only starts a new block once enough messages are queued
+        with blockchain.lock:
+            for _ in range(MSGS_PER_BLOCK):
+                blockchain.message_queue.append(get_collusion_message(blockchain.keys))
+        submitted.clear()
+
+        # Stand-in for a block from a peer. _add_block skips the PoW check.
+        block = Block(nonce='00',
+                      parent=blockchain.latest_block.get_hash,
+                      create_time=time.time(),
+                      miner=blockchain.miner_id,
+                      posts=[get_collusion_message(blockchain.keys) for _ in range(MSGS_PER_BLOCK)])
+        start = time.perf_counter()
+        blockchain._add_block(block, write_to_ledger=False, mined_ourselves=False)
+        submitted.wait()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def main(idle_seconds, interrupts):
+    directory = tempfile.mkdtemp()
+    blockchain = None
+    try:
+        blockchain = get_benchmark_blockchain(directory)
+        logging.getLogger('blockchain').disabled = True
+        start_miner(blockchain)
+
+        cpu = benchmark_idle_cpu(blockchain, idle_seconds)
+        print("Idle CPU use over %.1fs: %.1f%% of a core" % (idle_seconds, cpu * 100))
+
+        latencies = sorted(benchmark_interrupts(blockchain, interrupts))
+        print("Interrupt to restart over %d blocks: median %.1f us, max %.1f us" %
+              (len(latencies), latencies[len(latencies) // 2] * 1e6, latencies[-1] * 1e6))
+    finally:
+        if blockchain is not None and blockchain.mining_pool is not None:
+            blockchain.mining_pool.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    idle_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    interrupts = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(idle_seconds, interrupts)
@@ -1,30 +1,178 @@
+import bisect
 import hashlib
 import logging
 import os
-import random
 import threading
 import time
-from typing import List
-from binascii import hexlify
+from collections import OrderedDict, namedtuple
+from functools import partial
 
 from blockchain_constants import *
+from cache import LRUCache
+from disk_writer import DiskWriter
 from key import Keys
-from objects import parse_block, parse_message, Block, get_collusion_message
+from ledger import open_ledger
+from miner import MiningPool
+from objects import parse_block, parse_lazy_block, parse_message, make_lazy_block, Block, get_block_suffix, \
+    get_collusion_message
+from verification import VerificationPool
 
 
-class MessageQueue(List):
+class MessageQueue(object):
+
+    def __init__(self, capacity=MSG_BUFFER_SIZE, eviction_policy=MSG_EVICTION_POLICY):
+        """
+        FIFO queue of Messages waiting to be mined, indexed by Message.digest.
+
+        Membership checks and removal are constant time instead of
+        re-serializing every queued message. The queue holds at most capacity
+        messages, besides any put back with appendleft(). When it is full,
+        eviction_policy decides whether a new message evicts the oldest one
+        (EVICT_OLDEST) or is rejected (REJECT_NEWEST).
+
+        :param capacity: Maximum number of queued messages
+        :param eviction_policy: EVICT_OLDEST or REJECT_NEWEST
+        """
+        self.capacity = capacity
+        self.eviction_policy = eviction_policy
+        self._messages = OrderedDict()  # Message.digest -> Message, oldest first
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(list(self._messages.values()))
 
     def __contains__(self, item):
-        return repr(item) in map(repr, self)
+        return item.digest in self._messages
 
+    def contains_digest(self, digest):
+        """Whether the message with the given Message.digest is queued."""
+        return digest in self._messages
 
-class Blockchain(object):
+    def is_full(self):
+        return len(self._messages) >= self.capacity
+
+    def append(self, message):
+        """
+        Adds a message to the back of the queue.
+
+        :return: False if the message was rejected because the queue is full
+        """
+        if message.digest in self._messages:
+            return True
+        if self.is_full():
+            if self.eviction_policy == REJECT_NEWEST:
+                return False
+            self._messages.popitem(last=False)
+        self._messages[message.digest] = message
+        return True
+
+    def appendleft(self, message):
+        """
+        Puts a message back at the front of the queue.
+
+        Used for messages which were taken off the queue to be mined and were
+        already accepted from peers, so they are never rejected or evicted.
+        A full queue goes over capacity until mining takes them again.
+        """
+        if message.digest in self._messages:
+            return
+        self._messages[message.digest] = message
+        self._messages.move_to_end(message.digest, last=False)
+
+    def pop(self):
+        """Removes and returns the oldest message."""
+        return self._messages.popitem(last=False)[1]
+
+    def remove(self, message):
+        """Removes a message, raising ValueError if it is not queued."""
+        try:
+            del self._messages[message.digest]
+        except KeyError:
+            raise ValueError("Message not in queue")
+
+    def discard(self, message):
+        """Removes a message if it is queued."""
+        self.discard_digest(message.digest)
+
+    def discard_digest(self, digest):
+        """Removes the message with the given Message.digest if it is queued."""
+        self._messages.pop(digest, None)
+
+
+class OrphanPool(object):
+
+    def __init__(self, capacity=ORPHAN_POOL_SIZE):
+        """
+        Block strings which arrived before their parent, indexed by the missing parent hash.
+
+        Holds at most capacity blocks, evicting the oldest when full. Safe to
+        use from several threads.
+
+        :param capacity: Maximum number of orphan blocks kept
+        """
+        self.capacity = capacity
+        self._orphans = OrderedDict()  # block hash -> (parent hash, block string), oldest first
+        self._children = {}  # parent hash -> set of orphan block hashes
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._orphans)
+
+    def __contains__(self, block_hash):
+        with self._lock:
+            return block_hash in self._orphans
+
+    def add(self, block_hash, parent_hash, block_str):
+        """
+        Adds an orphan block.
+
+        :return: False if the block was already in the pool
+        """
+        with self._lock:
+            if block_hash in self._orphans:
+                return False
+            if len(self._orphans) >= self.capacity:
+                self._remove(next(iter(self._orphans)))
+            self._orphans[block_hash] = (parent_hash, block_str)
+            self._children.setdefault(parent_hash, set()).add(block_hash)
+            return True
+
+    def get_parent(self, block_hash):
+        """Returns the missing parent hash of an orphan, or None if block_hash is not in the pool."""
+        with self._lock:
+            orphan = self._orphans.get(block_hash)
+            return None if orphan is None else orphan[0]
+
+    def discard(self, block_hash):
+        with self._lock:
+            self._remove(block_hash)
+
+    def pop_children(self, parent_hash):
+        """
+        Removes and returns every orphan waiting for parent_hash.
+
+        :return: List of (block hash, block string)
+        """
+        with self._lock:
+            children = self._children.pop(parent_hash, ())
+            return [(block_hash, self._orphans.pop(block_hash)[1]) for block_hash in children]
+
+    def _remove(self, block_hash):
+        orphan = self._orphans.pop(block_hash, None)
+        if orphan is None:
+            return
+        siblings = self._children[orphan[0]]
+        siblings.discard(block_hash)
+        if len(siblings) == 0:
+            del self._children[orphan[0]]
 
-    num_trees = 0
-    fork_counter = 0
-    fork_lengths = {0: 0}
 
-    def __init__(self, ledger_file, message_file, stats_file):
+class Blockchain(object):
+
+    def __init__(self, ledger_file, message_file, stats_file, mining_workers=MINING_WORKERS):
         """
         Responsible for initializing a Block object.
 
@@ -34,6 +182,9 @@ class Blockchain(object):
 
         blockchain_bbs.py creates a Blockchain object which it then passes to
         a Server object from network.py
+
+        mining_workers is the number of processes mine() searches for nonces
+        with. The processes are only started once mine() is called.
         """
 
         self.log = logging.getLogger('blockchain')
@@ -66,30 +217,57 @@ class Blockchain(object):
         self.ledger_file = ledger_file
         self.stats_file = stats_file
         self._create_empty_files()
-
-        # Use this lock to protect internal data of this class from the
-        # multi-threaded server.  Wrap code which modifies the blockchain with
-        # "with self.lock:". Be careful not to nest these contexts or it will
-        # cause deadlock.
+        self.ledger = open_ledger(self.ledger_file)
+        # Files are written on a background thread, so the lock is only held for in-memory work
+        self.disk_writer = DiskWriter(self.ledger, self.message_file, self.stats_file)
+
+        # Use this lock to protect the block tree, the chain tip and the
+        # mining state from the multi-threaded server. Wrap code which
+        # modifies the blockchain with "with self.lock:". Be careful not to
+        # nest these contexts or it will cause deadlock.
         self.lock = threading.Lock()
+        # Signalled (with self.lock held) whenever something the miner waits
+        # on changes: the message queue, the chain tip, the mining flag or a
+        # nonce found by the mining pool.
+        self.chain_changed = threading.Condition(self.lock)
+        # Protects the message queue and the main chain message table, so
+        # incoming messages do not wait for blocks being added. Block adds
+        # take it while holding self.lock. Never take self.lock while holding it.
+        self.queue_lock = threading.Lock()
+        # Protects the time index, so peers' update requests do not wait for blocks being added
+        self.index_lock = threading.Lock()
+        self.mined_lock = threading.Lock()
 
         self.blocks = {}  # dictionary of Block.hash -> BlockNode
+        # All BlockNodes sorted by Block.create_time, with the times in a parallel list for bisecting
+        self.block_times = []
+        self.blocks_by_time = []
         self.root = None
         self.latest_block = None  # BlockNode to mine on
-        self.second_longest_chain = None
         self.mined_block = None  # latest block mined by this blockchain.
         self.latest_time = 0  # Timestamp of latest_block
         self.last_update = 0
         self.total_blocks = 0  # Total blocks in our blockchain
+        self.num_trees = 0  # Number of root blocks seen
+        self.fork_counter = 0  # Next fork number to hand out
+        self.fork_choice = ForkChoice()
+        self.fork_choice.on_reorg(self._log_reorg)
         self.mining_flag = GIVEN_BLOCK
         self.message_list = [get_collusion_message(self.keys) for _ in range(MSGS_PER_BLOCK)]
-        self.max_depth = 0
-        self.messages = set()
-        self.message_num = 0
-        self.last_msg_update = 0
-        self.rejects = {}
+        self.messages = {}  # Message.digest -> number of main chain posts with that digest
+        self.message_num = 0  # Number of posts on the main chain
+        self.message_file_sizes = [0]  # Size of message_file after the main chain block at each depth
+        self.rejects = LRUCache(REJECTED_BLOCKS_CACHE_SIZE)  # hash of a block string -> reason it is invalid
+        self.message_rejects = LRUCache(REJECTED_MESSAGES_CACHE_SIZE)  # digest of a message string -> reason it is invalid
+        self.orphans = OrphanPool()
+        self.mining_workers = mining_workers
+        self.mining_pool = None
+        self.mined_nonce = None  # (job id, nonce) reported by the mining pool
 
         self.message_queue = MessageQueue()
+        self.verifier = VerificationPool(VERIFY_WORKERS)
+        # Published after every block, for readers which must not take self.lock
+        self.snapshot = self._make_snapshot()
 
         self._load_saved_ledger()
 
@@ -116,19 +294,33 @@ class Blockchain(object):
         Reads saved block strings from local ledger.txt. This stops us from having to re-query peers to get the
         entire version history. networking.py uses self.latest_time to do the correct fetch. This time is updated in
         self.add_block_str
+
+        Blocks from a binary ledger were verified before they were written, so they are loaded without hashing them
+        or checking their Proof-of-Work again. They are loaded as LazyBlocks, which only parse their posts when
+        something asks for them. Blocks from a text ledger are verified, then swapped for LazyBlocks pointing at
+        their line in the ledger.
         """
 
-        with open(self.ledger_file, 'r') as ledger:
-            self.log.debug('Loading blocks from local ledger!')
-            i = 0
-            for block_str in ledger:
-                i += 1
-                if self._add_block_str(block_str.strip(), False):
-                    self.log.info("Loaded block %d", i)
+        self.log.debug('Loading blocks from local ledger!')
+        i = 0
+        for block_hash, offset, block_str in self.ledger:
+            i += 1
+            if block_hash is None:
+                added = self._add_block_str(block_str, False)
+                block_node = self.blocks.get(hashlib.sha512(block_str.encode()).hexdigest()) if added else None
+                # A block stored in another form than its repr() is kept whole
+                if block_node is not None and repr(block_node.block) == block_str:
+                    self._block_written(block_node, offset)
+            else:
+                added = self._add_trusted_block_str(block_str, block_hash, offset)
+            if added:
+                self.log.info("Loaded block %d", i)
 
         # After loading all blocks from file, tell our miner to continue
-        self.last_update = self.latest_time
-        self.mining_flag = CONTINUE_MINING
+        with self.lock:
+            self.last_update = self.latest_time
+            self.mining_flag = CONTINUE_MINING
+            self.chain_changed.notify_all()
 
     def get_message_queue_size(self):
         """
@@ -139,9 +331,65 @@ class Blockchain(object):
 
         This function is called by networking.py.
         """
-        with self.lock:
+        with self.queue_lock:
             return len(self.message_queue)
 
+    def is_message_queue_full(self):
+        """
+        Whether add_message_str() would reject a new message for lack of space.
+
+        This function is called by networking.py.
+        """
+        with self.queue_lock:
+            return self.message_queue.is_full() and self.message_queue.eviction_policy == REJECT_NEWEST
+
+    def has_block(self, block_hash):
+        """
+        Whether a block with the given hash has been added.
+
+        This function is called by networking.py.
+        """
+        return block_hash in self.blocks
+
+    def is_known_block(self, block_hash):
+        """
+        Whether a block with the given hash has been added or was already
+        found invalid. Orphans waiting for their parent are neither.
+
+        This function is called by networking.py.
+        """
+        return block_hash in self.blocks or block_hash in self.rejects
+
+    def get_block_depth(self, block_hash):
+        """
+        Get the depth of a block in the tree. Root blocks have depth 1.
+
+        This function is called by networking.py.
+
+        :return: The depth, or None if we do not have the block
+        """
+        block_node = self.blocks.get(block_hash)
+        return None if block_node is None else block_node.depth
+
+    def has_message(self, digest):
+        """
+        Whether the message with the given Message.digest is queued or in the main chain.
+
+        This function is called by networking.py.
+        """
+        with self.queue_lock:
+            return self.message_queue.contains_digest(digest) or digest in self.messages
+
+    def is_known_message(self, digest):
+        """
+        Whether the message with the given Message.digest is queued, in the
+        main chain, or was already found invalid. Cheap enough to call before
+        a received message is parsed.
+
+        This function is called by networking.py.
+        """
+        return digest in self.message_rejects or self.has_message(digest)
+
     def add_message_str(self, msg_str):
         """
         Verifies then adds incoming messages to the message queue.
@@ -154,60 +402,186 @@ class Blockchain(object):
 
         This function is called by networking.py.
         """
+        return self.add_message_strs([msg_str])[0]
+
+    def add_message_strs(self, msg_strs):
+        """
+        Verifies then adds a batch of incoming messages to the message queue.
 
-        message = parse_message(msg_str)
+        Works like add_message_str() for every message string, but the
+        signatures of the whole batch are checked in parallel by the
+        VerificationPool before queue_lock is taken once to queue them.
+        self.lock is only taken briefly to wake the miner.
 
-        # Make sure message string was properly formed
-        if message is None:
-            self.log.debug("Ill-formed message string")
-            return False
+        Message strings found ill-formed or invalidly signed are remembered
+        in self.message_rejects, and rejected again without being parsed.
 
-        # Verify that the message is properly signed
-        if not message.verify_signature():
-            self.log.debug("Invalidly signed message string")
-            return False
+        This function is called by networking.py.
 
+        :return: List of bools, True for each message which was queued
+        """
+        digests = [hashlib.sha256(msg_str.encode()).hexdigest() for msg_str in msg_strs]
+        messages = [None if digest in self.message_rejects else parse_message(msg_str)
+                    for digest, msg_str in zip(digests, msg_strs)]
+        signed = self.verifier.verify_all([message for message in messages if message is not None])
+
+        results = []
+        with self.queue_lock:
+            for digest, message in zip(digests, messages):
+                # Make sure message string was properly formed
+                if message is None:
+                    if digest not in self.message_rejects:
+                        self.log.debug("Ill-formed message string")
+                        self.message_rejects.put(digest, "ill-formed")
+                    results.append(False)
+                    continue
+
+                # Verify that the message is properly signed
+                if not signed.pop(0):
+                    self.log.debug("Invalidly signed message string")
+                    self.message_rejects.put(digest, "invalid signature")
+                    results.append(False)
+                    continue
+
+                results.append(self._queue_message(message))
+
+        if any(results):
+            with self.lock:
+                self.chain_changed.notify_all()
+        return results
+
+    def _queue_message(self, message):
+        """Adds a verified message to the message queue unless it is a duplicate. Call with self.queue_lock held."""
         # Verify that the message is not a duplicate
-        with self.lock:
-            if message in self.message_queue:
-                self.log.debug("Duplicate message rejected (already in message queue)")
-                return False
+        if message in self.message_queue:
+            self.log.debug("Duplicate message rejected (already in message queue)")
+            return False
 
-            # This only checks if messages are in the current blockchain
-            if self._is_duplicate_message(message):
-                self.log.debug("Duplicate message rejected (already in blockchain)")
-                return False
+        # This only checks if messages are in the current blockchain
+        if self._is_duplicate_message(message):
+            self.log.debug("Duplicate message rejected (already in blockchain)")
+            return False
 
-            # Add message to message queue
-            self.log.debug("Adding message to message queue!")
-            self.message_queue.append(message)
+        # Add message to message queue
+        if not self.message_queue.append(message):
+            self.log.debug("Message rejected (message queue full)")
+            return False
 
-            return True
+        self.log.debug("Adding message to message queue!")
+        return True
 
     def _add_block_str(self, block_str, write_to_ledger=True, mined_ourselves=False):
-        block = parse_block(block_str)
-        if block is None:
-            self.log.debug(RED + "%s - Block ill-formed" + NC, block.miner_key_hash[:5])
-            self.rejects[block.block_hash] = "ill-formed"
+        block_hash = self._connect_block_str(block_str, write_to_ledger, mined_ourselves)
+        if block_hash is None:
             return False
 
+        # Orphans waiting for this block can now be added, then theirs, and so on
+        parents = [block_hash]
+        while len(parents) > 0:
+            for _, orphan_str in self.orphans.pop_children(parents.pop()):
+                orphan_hash = self._connect_block_str(orphan_str, write_to_ledger, False)
+                if orphan_hash is not None:
+                    self.log.debug("%s - Connected orphan block", orphan_hash[:5])
+                    parents.append(orphan_hash)
+        return True
+
+    def _connect_block_str(self, block_str, write_to_ledger, mined_ourselves):
+        """
+        Validates a block string and adds it to the tree.
+
+        :return: Hash of the added block, or None if it was not added
+        """
+        block_hash = self._pre_validate_block_str(block_str)
+        if block_hash is None:
+            return None
+
+        block = parse_block(block_str, block_hash)
+        if block is None:
+            self.log.debug(RED + "%s - Block ill-formed" + NC, block_hash[:5])
+            self.rejects.put(block_hash, "ill-formed")
+            return None
+
+        if repr(block) != block_str:
+            # Not in the form the block would be sent in (e.g. an ill-formed
+            # post was dropped), so the hash of the raw string is not its hash
+            block.block_hash = hashlib.sha512(repr(block).encode()).hexdigest()
+
         if not block.verify_pow():
             self.log.debug(RED + "%s - Block invalid POW" + NC + "\n\t%s", block.miner_key_hash[:5], repr(block))
-            self.rejects[block.block_hash] = "invalid POW"
-            return False
+            self.rejects.put(block_hash, "invalid POW")
+            return None
 
         if block.parent_hash not in self.blocks and not block.is_root():
             self.log.debug("%s - Block has non-existent parent", block.miner_key_hash[:5])
-            if block.parent_hash in self.rejects:
-                self.log.warning("\t" + RED + "Block parent %s in rejected: %s" + NC, block.parent_hash, self.rejects[block.parent_hash])
-            self.rejects[block.block_hash] = "non-existent parent"
-            return False
+            return None
 
         if block.block_hash in self.blocks:
             self.log.debug(RED + "%s - Block is a duplicate" + NC, block.miner_key_hash[:5])
+            return None
+
+        if not self._add_block(block, write_to_ledger, mined_ourselves):
+            return None
+        return block.block_hash
+
+    def _pre_validate_block_str(self, block_str):
+        """
+        Checks a block string before it is parsed.
+
+        Costs one SHA-512 of the raw string and a split, so duplicate and
+        spam blocks are turned away without parsing and unhexlifying every
+        post. Blocks with an invalid Proof-of-Work, or whose parent was
+        rejected, are remembered in self.rejects.
+
+        :return: SHA-512 hex digest of block_str, or None if the block is rejected
+        """
+        block_hash = hashlib.sha512(block_str.encode()).hexdigest()
+        if block_hash in self.blocks:
+            self.log.debug(RED + "%s - Block is a duplicate" + NC, block_hash[:5])
+            return None
+
+        reason = self.rejects.get(block_hash)
+        if reason is not None:
+            self.log.debug(RED + "%s - Block already rejected: %s" + NC, block_hash[:5], reason)
+            return None
+
+        if not block_hash.startswith('0' * PROOF_OF_WORK_HARDNESS):
+            self.log.debug(RED + "%s - Block invalid POW" + NC, block_hash[:5])
+            self.rejects.put(block_hash, "invalid POW")
+            return None
+
+        block_parts = block_str.split('|', PARENT_HASH + 1)
+        if len(block_parts) <= PARENT_HASH:
+            self.log.debug(RED + "%s - Block ill-formed" + NC, block_hash[:5])
+            self.rejects.put(block_hash, "ill-formed")
+            return None
+
+        parent_hash = block_parts[PARENT_HASH]
+        reason = self.rejects.get(parent_hash)
+        if reason is not None:
+            self.log.warning("\t" + RED + "Block parent %s in rejected: %s" + NC, parent_hash, reason)
+            self.rejects.put(block_hash, "rejected parent")
+            return None
+
+        if parent_hash not in self.blocks and parent_hash.strip('0') != '':
+            self.orphans.add(block_hash, parent_hash, block_str)
+            # The parent may have been added while we checked
+            if parent_hash not in self.blocks:
+                self.log.debug("%s - Block has non-existent parent, kept as orphan", block_hash[:5])
+                return None
+            self.orphans.discard(block_hash)
+
+        return block_hash
+
+    def _add_trusted_block_str(self, block_str, block_hash, offset):
+        block = parse_lazy_block(block_str, block_hash, self.ledger, offset)
+        if block is None:
+            self.log.warning("Ill-formed block in local ledger")
+            return False
+
+        if block.block_hash in self.blocks or (block.parent_hash not in self.blocks and not block.is_root()):
             return False
 
-        return self._add_block(block, write_to_ledger, mined_ourselves)
+        return self._add_block(block, False, False)
 
     def add_block_str(self, block_str):
         """
@@ -224,9 +598,47 @@ class Blockchain(object):
         return self._add_block_str(block_str, True, False)
 
     def _update_latest_pointers(self, block_node):
-        if block_node.depth > self.max_depth:
+        switch = self.fork_choice.add(block_node)
+        if switch is not None:
+            old_tip, ancestor = switch
             self.latest_block = block_node
-            self.max_depth = block_node.depth
+            self._switch_main_chain(old_tip, block_node, ancestor)
+
+    def _log_reorg(self, event):
+        self.log.info("Switched main chain at depth %d: %d blocks undone",
+                      0 if event.ancestor is None else event.ancestor.depth, event.depth)
+
+    def _switch_main_chain(self, old_tip, new_tip, ancestor):
+        """
+        Updates the main chain message table after the tip moves.
+
+        Only the blocks between each tip and their common ancestor are
+        visited: a normal extension adds the new block's posts, and a reorg
+        first undoes the blocks which left the main chain.
+
+        :param old_tip: BlockNode of the previous tip, or None
+        :param new_tip: BlockNode of the new tip
+        :param ancestor: Common ancestor of the two tips, or None
+        """
+        new_nodes = []
+        node = new_tip
+        while node is not ancestor:
+            new_nodes.append(node)
+            node = node.parent
+        new_nodes.reverse()
+
+        with self.queue_lock:
+            if ancestor is not old_tip:
+                node = old_tip
+                while node is not ancestor:
+                    self._remove_block_msgs(node.block)
+                    node = node.parent
+                self._truncate_message_file(0 if ancestor is None else ancestor.depth)
+
+            for node in new_nodes:
+                self._add_block_msgs(node.block)
+                self._update_msg_queue(node.block)
+        self._write_new_messages(new_nodes)
 
     def _add_block(self, block: Block, write_to_ledger, mined_ourselves):
         """
@@ -238,97 +650,114 @@ class Blockchain(object):
         traverse the BlockNode tree up from this new node and update our
         message tracker with the messages therein.
 
-        WARNING: Certainly not thread safe.
+        Everything happens under self.lock, including the check that the
+        block was not added already.
 
         :param block: The Block object to add
         :return: Success of adding the Block
         """
 
         with self.lock:
+            # Several threads may pass the duplicate checks outside the lock with the same block
+            if block.block_hash in self.blocks:
+                self.log.debug(RED + "%s - Block is a duplicate" + NC, block.miner_key_hash[:5])
+                return False
+
             self.mining_flag = GIVEN_BLOCK
 
-        with self.lock:
             if block.parent_hash in self.blocks:
                 parent_node = self.blocks[block.parent_hash]
-                block_node = BlockNode(block, parent_node)
+                block_node = BlockNode(block, parent_node, self._get_fork_num(parent_node))
                 parent_node.add_child(block_node)
 
                 self._update_latest_pointers(block_node)  # Check if the new block makes a longer chain and switch to it
 
                 self.log.debug(GREEN + "%s:[%s] added block to fork %d at depth %d" + NC, block.miner_key_hash[:6], time.ctime(block.create_time), block_node.fork_num, block_node.depth)
                 # self.log.debug("Added block to blockchain")
-            elif block.is_root:
-                block_node = BlockNode(block, None)
+            elif block.is_root():
+                block_node = BlockNode(block, None, tree_num=self.num_trees)
                 self.root = block_node
                 # self.log.debug("Added block as root")
                 self.log.debug(GREEN + "%s:[%s] added block as root %d" + NC, block.miner_key_hash[:6], time.ctime(block.create_time), block_node.tree_num)
                 self._update_latest_pointers(block_node)
                 # self.messages.clear()
-                Blockchain.num_trees += 1
+                self.num_trees += 1
+            else:
+                return False
 
-            self._add_block_msgs(block)  # Add all new posts to message table
-            if self.message_num % 10000 == 0:
-                self._write_new_messages(self.message_num-10000)  # Save new messages to file
             self.blocks[block.block_hash] = block_node
+            self._add_to_time_index(block_node)
             self.total_blocks += 1
 
             # Update ledger.txt with newly added block
             if write_to_ledger:
-                with open(self.ledger_file, 'a') as ledger:
-                    ledger.write(repr(block) + "\n")
+                self.disk_writer.append_block(block.block_hash, repr(block), partial(self._block_written, block_node))
 
+            self.snapshot = self._make_snapshot()
             if self.total_blocks % STATS_UPDATE_INTERVAL == 0:  # Every few blocks update stats.txt
                 self._write_stats_file()
 
             self.mining_flag = CONTINUE_MINING
 
-            if not mined_ourselves:
-                self._update_msg_queue(block)
-
-            if time.time() - self.last_msg_update > MSG_UPDATE_DELAY:
-                self._reinit_message_table()
-                self.last_msg_update = time.time()
-
+            self.chain_changed.notify_all()
             return True
 
+    def _block_written(self, block_node, offset):
+        """Called by the disk writer once the block of block_node is in the ledger, with offset None if it failed."""
+        if offset is None:
+            # Keep the whole block, it cannot be read back
+            self.log.error("Block %s was not written to the ledger", block_node.block.block_hash[:16])
+            return
+        # The posts can be read back from the ledger, no need to keep them in memory
+        block_node.block = make_lazy_block(block_node.block, self.ledger, offset)
+
     def _add_block_msgs(self, block):
-        for msg in block.posts:
-            self.messages.add(repr(msg))
+        for digest in block.post_digests:
+            self.messages[digest] = self.messages.get(digest, 0) + 1
             self.message_num += 1
 
-    def _write_new_messages(self, last_i):
-        with open(self.message_file, 'a') as message_file:
-            message_file.write("\n".join(list(self.messages)[last_i:]))
-
-    def _reinit_message_table(self):
-        self.messages = set()
-        self.message_num = 0
-        block_node = self.blocks[self.latest_block.get_hash]
-
-        while block_node is not None:
-            self._add_block_msgs(block_node.block)
-            self._update_msg_queue(block_node)
-            block_node = block_node.parent
-
-        # self.messages.reverse()
-        msg_str = "\n".join(self.messages)
-
-        with open(self.message_file, 'w') as message_file:
-            message_file.write("\n")
-            message_file.write(msg_str)
+    def _remove_block_msgs(self, block):
+        for digest in block.post_digests:
+            count = self.messages.get(digest, 0)
+            if count <= 1:
+                self.messages.pop(digest, None)
+            else:
+                self.messages[digest] = count - 1
+            self.message_num -= 1
+
+    def _write_new_messages(self, block_nodes):
+        """Appends the posts of new main chain blocks to message_file."""
+        if len(block_nodes) == 0:
+            return
+        data = []
+        size = self.message_file_sizes[-1]
+        for block_node in block_nodes:
+            data.append("".join(post_str + "\n" for post_str in block_node.block.post_strs).encode())
+            size += len(data[-1])
+            self.message_file_sizes.append(size)
+        self.disk_writer.append_messages(b"".join(data))
+
+    def _truncate_message_file(self, depth):
+        """Drops the posts of main chain blocks deeper than depth from message_file."""
+        del self.message_file_sizes[depth + 1:]
+        self.disk_writer.truncate_messages(self.message_file_sizes[-1])
 
     def _is_duplicate_message(self, message):
-        return repr(message) in self.messages
+        return message.digest in self.messages
+
+    def _get_fork_num(self, parent_node):
+        """Fork number of a new child of parent_node. Every child of a root starts a new fork."""
+        if parent_node.block.is_root():
+            fork_num = self.fork_counter
+            self.fork_counter += 1
+            return fork_num
+        return parent_node.fork_num
 
     def _get_current_depth(self):
-        if len(Blockchain.fork_lengths) == 0:
-            return 0
-        return max(Blockchain.fork_lengths.values())
+        return self.fork_choice.longest
 
     def _get_fork_depth(self):
-        if len(Blockchain.fork_lengths) < 2:
-            return 0
-        return sorted(Blockchain.fork_lengths.keys(), key=lambda x: Blockchain.fork_lengths[x])[1]
+        return self.fork_choice.second_longest
 
     def get_new_block_str(self):
         """
@@ -341,7 +770,7 @@ class Blockchain(object):
 
         This function is called by networking.py.
         """
-        with self.lock:
+        with self.mined_lock:
             if self.mined_block is not None:
                 string = repr(self.mined_block)
                 self.mined_block = None
@@ -349,12 +778,76 @@ class Blockchain(object):
                 return string
             return None
 
+    def _make_snapshot(self):
+        """Builds a ChainSnapshot of the current state. Call with self.lock held."""
+        return ChainSnapshot(tip=self.latest_block,
+                             total_blocks=self.total_blocks,
+                             message_num=self.message_num,
+                             longest=self._get_current_depth(),
+                             second_longest=self._get_fork_depth(),
+                             stale=self.fork_choice.stale)
+
+    def get_snapshot(self):
+        """
+        Get the state of the chain as of the last block added.
+
+        Never blocks. The ChainSnapshot is immutable, so its fields are
+        consistent with each other.
+        """
+        return self.snapshot
+
     def _write_stats_file(self):
-        with open(self.stats_file, 'w') as stats:
-            stats.write("Readable messages: %s\n" % self.message_num)
-            stats.write("Longest chain: %d\n" % self._get_current_depth())
-            stats.write("Stale blocks: %d\n" % (self.total_blocks - self._get_current_depth()))
-            stats.write("Longest fork: %d\n" % self._get_fork_depth())
+        snapshot = self.snapshot
+        self.disk_writer.write_stats("Readable messages: %s\n" % snapshot.message_num +
+                                     "Longest chain: %d\n" % snapshot.longest +
+                                     "Stale blocks: %d\n" % snapshot.stale +
+                                     "Longest fork: %d\n" % snapshot.second_longest)
+
+    def flush(self):
+        """Waits until the ledger, message file and stats file are written."""
+        self.disk_writer.flush()
+
+    def close(self):
+        """
+        Writes out and syncs all pending file writes, then closes the ledger.
+
+        Call this on shutdown, once no more blocks are being added.
+        """
+        self.disk_writer.close()
+        self.ledger.close()
+
+    def _add_to_time_index(self, block_node):
+        with self.index_lock:
+            i = bisect.bisect_right(self.block_times, block_node.get_time)
+            self.block_times.insert(i, block_node.get_time)
+            self.blocks_by_time.insert(i, block_node)
+
+    def _get_blocks_after(self, t):
+        """BlockNodes of blocks created after time t, oldest first."""
+        with self.index_lock:
+            return self.blocks_by_time[bisect.bisect_right(self.block_times, t):]
+
+    def get_block_str(self, block_hash):
+        """
+        Get the string representation of the block with the given hash.
+
+        This function is called by networking.py.
+
+        :return: The block string, or None if we do not have the block
+        """
+        block_node = self.blocks.get(block_hash)
+        return None if block_node is None else repr(block_node.block)
+
+    def get_orphan_parent(self, block_hash):
+        """
+        Get the hash of the missing parent of an orphan block.
+
+        This function is called by networking.py.
+
+        :param block_hash: SHA-512 hex digest of the orphan's block string
+        :return: The parent hash, or None if block_hash is not a waiting orphan
+        """
+        return self.orphans.get_parent(block_hash)
 
     def get_all_block_strs(self, t):
         """
@@ -362,20 +855,45 @@ class Blockchain(object):
 
         This method returns a list of the string encoding of each of the blocks
         in this blockchain, including ones not on the main chain, whose
-        timestamp is greater then the parameter t.
+        timestamp is greater then the parameter t. Blocks are returned oldest
+        first.
+
+        The blocks are found by bisecting the time index, and index_lock is
+        only held while copying the matching nodes, so self.lock is never
+        taken. Block strings come from the Block's cached string or from the
+        ledger, so nothing is re-serialized.
 
         This function is called by networking.py.
         """
-        with self.lock:
-            block_strs = []
+        block_nodes = self._get_blocks_after(t)
+        return [repr(block_node.block) for block_node in block_nodes]
+
+    def get_headers(self, t):
+        """
+        Get the headers of every block in the chain after time t, oldest first.
+
+        A header is a (block hash, parent hash, create time, miner key hash)
+        tuple. Headers are read from the BlockNodes, so no block is parsed or
+        read from the ledger.
 
-            next_nodes = [self.root]
-            while len(next_nodes) > 0:
-                cur_node = next_nodes.pop(0)
-                next_nodes += cur_node.children
-                if cur_node.get_time > t:
-                    block_strs.append(repr(cur_node.block))
-            return block_strs
+        This function is called by networking.py.
+        """
+        return [(block_node.block.block_hash, block_node.block.parent_hash, block_node.block.create_time,
+                 block_node.block.miner_key_hash) for block_node in self._get_blocks_after(t)]
+
+    def iter_block_strs(self, t, batch_size=UPDATE_BATCH_SIZE):
+        """
+        Generate the string representations of blocks after time t in batches.
+
+        Yields lists of at most batch_size block strings, oldest first, so a
+        caller can stream a long chain without holding every block string in
+        memory at once.
+
+        This function is called by networking.py.
+        """
+        block_nodes = self._get_blocks_after(t)
+        for i in range(0, len(block_nodes), batch_size):
+            yield [repr(block_node.block) for block_node in block_nodes[i:i + batch_size]]
 
     def mine(self):
         """
@@ -390,61 +908,104 @@ class Blockchain(object):
         previously attempting to mine.  This process repeats forever, and this
         function never runs.
 
+        The nonce search itself runs in a MiningPool of self.mining_workers
+        processes. This thread only builds work units and collects results.
+
         This function is called in blockchain_bbs.py as a new thread.
         """
-        self.log.debug("Miner %s : Mining on thread %d", self.miner_id[:6], threading.get_ident() % 10000)
-        while True:
-            # Make sure we have enough new messages in the queue
-            if self.get_message_queue_size() < MSGS_PER_BLOCK:
-                continue
-
-            self.log.info("Thread: %d - "+ RED +"Starting to mine a block!" + NC, threading.get_ident() % 10000)
+        if self.mining_pool is None:
+            self.mining_pool = MiningPool(self.mining_workers, on_result=self._on_nonce_found)
 
+        self.log.debug("Miner %s : Mining with %d workers on thread %d", self.miner_id[:6], self.mining_pool.workers,
+                       threading.get_ident() % 10000)
+        while True:
             with self.lock:
-                if self.message_list is None:
-                    self.message_list = [self.message_queue.pop(0) for i in range(MSGS_PER_BLOCK)]
+                # Sleep until there are enough new messages and a chain to mine on
+                self.chain_changed.wait_for(self._ready_to_mine)
 
-            while self.mining_flag != CONTINUE_MINING or self.latest_block is None:
-                pass
+                self.log.info("Thread: %d - " + RED + "Starting to mine a block!" + NC, threading.get_ident() % 10000)
+                if self.message_list is None:
+                    with self.queue_lock:
+                        self.message_list = [self.message_queue.pop() for i in range(MSGS_PER_BLOCK)]
+                parent_node = self.latest_block
+                self.mined_nonce = None
 
-            while self.mining_flag == CONTINUE_MINING:
-                nonce = hexlify(str(random.getrandbits(NONCE_BIT_LENGTH)).encode()).decode()
+            # Everything but the nonce stays the same for this work unit
+            create_time = time.time()
+            suffix = get_block_suffix(parent_node.get_hash, self.miner_id, create_time, self.message_list)
+            job_id = self.mining_pool.submit(suffix)
 
-                # Parent hash is 64 '0's if we are mining the genesis block
-                parent_hash = self.latest_block.block.block_hash if self.latest_block is not None else '0' * 36
+            with self.lock:
+                # Sleep until a worker finds a nonce or a new block changes the tip
+                self.chain_changed.wait_for(lambda: self._mining_done(job_id, parent_node))
+                nonce = self.mined_nonce[1] if self.mined_nonce is not None else None
+            self.mining_pool.cancel()
 
+            if nonce is not None:
                 block = Block(nonce=nonce,
-                              parent=parent_hash,
-                              create_time=time.time(),
+                              parent=parent_node.get_hash,
+                              create_time=create_time,
                               miner=self.miner_id,
                               posts=self.message_list)
 
                 if block.verify_pow():
                     self.log.info("Thread: %d - " + GREEN + "Mined a block !!!" + NC + "\n", threading.get_ident() % 10000)
-                    self.mined_block = block
+                    with self.mined_lock:
+                        self.mined_block = block
                     self._add_block(block, write_to_ledger=True, mined_ourselves=True)
                     self.message_list = None
-                    break
+                    continue
 
-            if self.mining_flag == GIVEN_BLOCK:
+            if self.latest_block is not parent_node:
                 self.log.debug("Mining interrupted - given a block from a peer")
-                self._add_all_to_message_queue(self.message_list)
-            self.mining_flag = CONTINUE_MINING
+                self._recycle_message_list()
+
+    def _ready_to_mine(self):
+        """Wait predicate for mine(). Must be called with self.lock held."""
+        return self.mining_flag == CONTINUE_MINING and self.latest_block is not None and \
+            len(self.message_queue) >= MSGS_PER_BLOCK
+
+    def _mining_done(self, job_id, parent_node):
+        """Wait predicate for mine(). Must be called with self.lock held."""
+        return (self.mined_nonce is not None and self.mined_nonce[0] == job_id) or \
+            self.mining_flag != CONTINUE_MINING or self.latest_block is not parent_node
+
+    def _on_nonce_found(self, job_id, nonce):
+        """Called from the mining pool's collector thread when a worker finds a nonce."""
+        with self.lock:
+            self.mined_nonce = (job_id, nonce)
+            self.chain_changed.notify_all()
+
+    def _recycle_message_list(self):
+        """
+        Drops messages which a new main chain block already contains from the
+        block being mined. If that leaves too few messages, the rest go back to
+        the message queue.
+        """
+        with self.queue_lock:
+            remaining = [msg for msg in self.message_list if not self._is_duplicate_message(msg)]
+            if len(remaining) == len(self.message_list):
+                return
+            self.message_list = None
+
+        self._add_all_to_message_queue(remaining)
 
     def _add_all_to_message_queue(self, msgs):
         with self.lock:
-            for msg in msgs:
-                if msg not in self.message_queue and msg not in self.latest_block.block.posts:
-                    self.message_queue.append(msg)
+            tip_digests = set(self.latest_block.block.post_digests)
+            with self.queue_lock:
+                # These messages were taken from the front of the queue, so put
+                # them back there in their original order
+                recycled = [msg for msg in msgs if msg.digest not in tip_digests]
+                for msg in reversed(recycled):
+                    self.message_queue.appendleft(msg)
+                self.log.debug("Put %d messages back in the message queue, %d queued" %
+                               (len(recycled), len(self.message_queue)))
+            self.chain_changed.notify_all()
 
     def _update_msg_queue(self, block):
-        for msg in block.posts:
-            if msg in self.message_queue:
-                try:
-                    self.message_queue.remove(msg)
-                except ValueError:
-                    self.log.warning(
-                        "Attempted to remove msg from message queue (not in queue!)")
+        for digest in block.post_digests:
+            self.message_queue.discard_digest(digest)
 
     def generate_dot_file(self):
         """
@@ -464,6 +1025,60 @@ class Blockchain(object):
         with open("blockchain.gv", "w") as writeFile:
             writeFile.write(dot_text)
 
+def get_skip_depth(depth):
+    """
+    Depth of the ancestor a BlockNode at depth keeps a skip pointer to.
+
+    Follows the skip list layout Bitcoin uses for its block index
+    (GetSkipHeight, with depth = height + 1): skips from nearby depths land
+    on a few shared ancestors, so any ancestor can be reached in O(log n)
+    jumps.
+    """
+    height = depth - 1
+    if height < 2:
+        return 1
+    if height & 1:
+        # Clear the two lowest set bits of height - 1
+        skip_height = invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    else:
+        skip_height = invert_lowest_one(height)
+    return skip_height + 1
+
+
+def invert_lowest_one(n):
+    """n with its lowest set bit cleared."""
+    return n & (n - 1)
+
+
+def get_common_ancestor(node_a, node_b):
+    """
+    Finds the deepest BlockNode which is an ancestor of (or equal to) both nodes.
+
+    Both nodes are brought to the same depth, then climb together. Nodes at
+    the same depth skip to the same depth, so both take their skip pointer
+    whenever the skip targets still differ. This takes O(log n) steps
+    rather than walking the whole fork.
+
+    :return: The common ancestor, or None if the nodes are in different trees
+    """
+    if node_a is None or node_b is None:
+        return None
+
+    if node_a.depth > node_b.depth:
+        node_a = node_a.get_ancestor(node_b.depth)
+    elif node_b.depth > node_a.depth:
+        node_b = node_b.get_ancestor(node_a.depth)
+
+    while node_a is not node_b:
+        if node_a.skip is not node_b.skip:
+            node_a = node_a.skip
+            node_b = node_b.skip
+        else:
+            node_a = node_a.parent
+            node_b = node_b.parent
+    return node_a
+
+
 class BlockNode(object):
     """
     Holds a single block in the Blockchain tree.
@@ -471,32 +1086,54 @@ class BlockNode(object):
     Contains the parent block if one exists and children blocks if they exist.
     Each block must have exactly one parent unless it is the root node. The hash
     of the Block in question is also considered the hash of the BlockNode.
+
+    Nodes are slotted, since one is kept for every block, and each keeps a
+    skip pointer to an ancestor (see get_skip_depth) for fast ancestor and
+    common ancestor lookups.
     """
 
-    def __init__(self, block: Block, parent):
+    __slots__ = ('block', 'parent', 'children', 'depth', 'tree_num', 'fork_num', 'skip')
+
+    def __init__(self, block: Block, parent, fork_num=0, tree_num=0):
         """
         Construct the BlockNode given a Block and the BlockNode of its parent.
 
         :param block: The Block which this node holds
         :param parent: The parent BlockNode representing the parent Block
+        :param fork_num: Fork of the Blockchain the block is on
+        :param tree_num: Tree of a root block. Other blocks take their parent's.
         """
         self.parent = parent
         self.block = block
         self.children = []
         self.depth = 1 if parent is None else parent.depth + 1
-        self.tree_num = Blockchain.num_trees if parent is None else parent.tree_num
-        if self.parent is None:
-            self.fork_num = 0
-        elif self.parent.block.is_root():
-            self.fork_num = Blockchain.fork_counter
-            Blockchain.fork_counter += 1
-        else:
-            self.fork_num = self.parent.fork_num
+        self.tree_num = tree_num if parent is None else parent.tree_num
+        self.fork_num = fork_num
+        self.skip = None if parent is None else parent.get_ancestor(get_skip_depth(self.depth))
+
+    def get_ancestor(self, depth):
+        """
+        Finds the ancestor of this node at the given depth in O(log n) steps.
+
+        :return: The ancestor BlockNode, this node if depth is its own, or
+                 None if depth is out of range
+        """
+        if depth > self.depth or depth < 1:
+            return None
 
-        if self.fork_num not in Blockchain.fork_lengths:
-            Blockchain.fork_lengths[self.fork_num] = self.depth
-        elif Blockchain.fork_lengths[self.fork_num] < self.depth:
-            Blockchain.fork_lengths[self.fork_num] = self.depth
+        node = self
+        while node.depth != depth:
+            skip_depth = get_skip_depth(node.depth)
+            prev_skip_depth = get_skip_depth(node.depth - 1)
+            # Take the skip pointer unless it overshoots, or the parent's
+            # skip pointer gets closer without overshooting
+            if node.skip is not None and (skip_depth == depth or
+                                          (skip_depth > depth and
+                                           not (prev_skip_depth < skip_depth - 2 and prev_skip_depth >= depth))):
+                node = node.skip
+            else:
+                node = node.parent
+        return node
 
     def add_child(self, child):
         """Add a child BlockNode"""
@@ -514,3 +1151,88 @@ class BlockNode(object):
     @property
     def posts(self):
         return self.block.posts
+
+
+# State of a Blockchain after a block was added. Read without any lock through Blockchain.get_snapshot().
+ChainSnapshot = namedtuple('ChainSnapshot', ['tip', 'total_blocks', 'message_num', 'longest', 'second_longest',
+                                             'stale'])
+
+# Sent to reorg listeners when the best tip moves to another branch. depth is
+# the number of blocks which left the main chain.
+ReorgEvent = namedtuple('ReorgEvent', ['old_tip', 'new_tip', 'ancestor', 'depth'])
+
+
+class ForkChoice(object):
+
+    def __init__(self):
+        """
+        Tracks the chain tips of a Blockchain's BlockNode tree.
+
+        The best tip is the deepest one, with ties going to the tip seen
+        first. Tips never get shallower: a tip only stops being one when a
+        deeper child is added below it. So the best and second best tips can
+        be kept up to date as each block arrives, and the tip and all
+        statistics are read in constant time.
+
+        Listeners added with on_reorg() are called with a ReorgEvent whenever
+        the best tip moves off the current main chain.
+        """
+        self.tip = None  # BlockNode to mine on
+        self.runner_up = None  # Deepest tip which is not self.tip
+        self.num_tips = 0
+        self.total_blocks = 0
+        self.listeners = []
+
+    def on_reorg(self, listener):
+        """
+        :param listener: Called with a ReorgEvent, while the Blockchain lock is held
+        """
+        self.listeners.append(listener)
+
+    def add(self, block_node):
+        """
+        Records a new BlockNode. Must be called after it was added to its parent's children.
+
+        :return: (old tip, common ancestor of the old and new tip) if the
+                 best tip changed, otherwise None
+        """
+        self.total_blocks += 1
+        parent = block_node.parent
+        if parent is None or len(parent.children) > 1:
+            # A new tip, rather than one which replaces its parent
+            self.num_tips += 1
+
+        if self.tip is None or block_node.depth > self.tip.depth:
+            old_tip = self.tip
+            if parent is not old_tip:
+                self.runner_up = old_tip
+            self.tip = block_node
+            if parent is old_tip:
+                return old_tip, old_tip
+
+            ancestor = get_common_ancestor(old_tip, block_node)
+            if old_tip is not None:
+                event = ReorgEvent(old_tip, block_node, ancestor,
+                                   old_tip.depth - (0 if ancestor is None else ancestor.depth))
+                for listener in self.listeners:
+                    listener(event)
+            return old_tip, ancestor
+
+        if block_node is not self.tip and (self.runner_up is None or block_node.depth > self.runner_up.depth):
+            self.runner_up = block_node
+        return None
+
+    @property
+    def longest(self):
+        """Length of the main chain."""
+        return 0 if self.tip is None else self.tip.depth
+
+    @property
+    def second_longest(self):
+        """Length of the longest chain ending at another tip."""
+        return 0 if self.runner_up is None else self.runner_up.depth
+
+    @property
+    def stale(self):
+        """Number of blocks not on the main chain."""
+        return self.total_blocks - self.longest
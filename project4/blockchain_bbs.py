@@ -17,25 +17,36 @@ def ensure_keys():
         import generate_user_key
 
 
-def main(threads):
+def main(workers, use_asyncio=False):
     ensure_keys()
-    blockchain = Blockchain(LEDGER_FILE, MESSAGE_FILE, STATS_FILE)
-    bchain_threads = []
-    for i in range(threads):
-        bchain_threads.append(threading.Thread(target=blockchain.mine))
-    for thread in bchain_threads:
-        thread.start()
+    blockchain = Blockchain(LEDGER_FILE, MESSAGE_FILE, STATS_FILE, mining_workers=workers)
+    # A single miner thread drives a pool of worker processes
+    miner_thread = threading.Thread(target=blockchain.mine)
+    miner_thread.start()
     # blockchain_thread.daemon = True
 
-    server = Server(blockchain, True, True, False)
-    server.run()
-    # Main thread is server thread
-    # This call never returns
+    if use_asyncio:
+        from async_network import AsyncServer
+        server = AsyncServer(blockchain, True, True, False)
+    else:
+        server = Server(blockchain, True, True, False)
+    try:
+        server.run()
+        # Main thread is server thread
+        # This call never returns
+    finally:
+        # Write out any ledger and message file writes still queued
+        blockchain.close()
 
 
 if __name__ == "__main__":
     import sys
-    threads = 1
-    if len(sys.argv) > 1:
-        threads = int(sys.argv[1])
-    main(threads)
+    # Usage: blockchain_bbs.py [--async] [mining workers]
+    args = sys.argv[1:]
+    use_asyncio = '--async' in args
+    if use_asyncio:
+        args.remove('--async')
+    workers = MINING_WORKERS
+    if len(args) > 0:
+        workers = int(args[0])
+    main(workers, use_asyncio)
@@ -1,21 +1,71 @@
 MIN_PEERS = 5
 MAX_PEERS = 100
 MAX_PEER_FAILURE = 10
+DNS_CACHE_TTL = 300.0  # Seconds a resolved peer host name is used before resolving it again
+DNS_WORKERS = 4  # Threads resolving peer host names
+PEER_PROBE_WORKERS = 16  # Peers probed at once during peer discovery
+PEER_PROBE_DEADLINE = 3.0  # Seconds a peer has to answer a discovery probe
+PEER_EWMA_WEIGHT = 0.2  # Weight of the newest sample in a peer's moving averages
+PEER_BACKOFF_BASE = 5.0  # Seconds a peer is skipped after its first failure, doubling with each further one
+PEER_BACKOFF_MAX = 600.0  # Longest a failing peer is skipped
+PEER_SAVE_INTERVAL = 30.0  # Seconds between writes of the peering file
 UPDATE_PAD = 60
 WAIT_TIME = 0.10
 TIMEOUT = 1.0
-MSG_UPDATE_DELAY = 60
 
 MESSAGE_TYPE = 0
 BLOCK_TYPE = 1
 
 DEFAULT_PORT = 50000
+SERVER_BACKLOG = 128  # Pending connections the listening socket queues
+MAX_CONNECTIONS = 4096  # Concurrent connections the asyncio server accepts
+MAX_CONNECTIONS_PER_HOST = 16  # Concurrent connections accepted from one IP address
+ASYNC_HANDLER_THREADS = 32  # Threads the asyncio server runs Blockchain calls on
+MAX_LINE_LENGTH = 1 << 20  # Longest protocol line the asyncio server reads
+REQUEST_TIMEOUT = 10.0  # Seconds the asyncio server waits for a whole request
+LINK_KEEPALIVE_INTERVAL = 30.0  # Seconds a peer link may be quiet before it is pinged
+LINK_IDLE_TIMEOUT = 90.0  # Seconds without any frame before a peer link is closed
+LINK_HANDLER_THREADS = 64  # Threads the threaded server handles peer link requests on
+LINK_MAX_IN_FLIGHT = 16  # Requests from one peer link handled at once
+LINK_RESPONSE_WINDOW = 4  # Response frames sent for one link request before the client grants more
+LEGACY_RETRY_INTERVAL = 600.0  # Seconds before asking a legacy peer for a link again
+MAX_FRAME_SIZE = 1 << 24  # Largest frame accepted on a peer link
 # MAIN_HOST = "andersm2-macpro.union.edu"  # Test
 MAIN_HOST = "andersm2-vrtower.union.edu"  # Production
 
+BROADCAST_BATCH_SIZE = 50  # Most items sent to a peer over one broadcast connection
+PEER_QUEUE_SIZE = 1000  # Most items waiting to be broadcast to a single peer
+SEEN_FILTER_CAPACITY = 100000  # Recent block and message hashes remembered as seen
+SEEN_FILTER_ERROR_RATE = 0.0001  # Chance an unseen hash is taken for a seen one
+INV_REQUEST_TIMEOUT = 5.0  # Seconds before asking another peer for an announced item
+INV_REQUEST_CACHE_SIZE = 10000  # Announced items remembered as asked for
+
+UPDATE_BATCH_SIZE = 100  # Blocks per frame of an UPDATE_STREAM response
+UPDATE_PIPELINE_DEPTH = 4  # Received UPDATE_STREAM frames waiting to be added
+SYNC_WORKERS = 8  # Peers headers and blocks are downloaded from at once while syncing
+SYNC_BATCH_SIZE = 100  # Most blocks asked for with one BLOCKS_REQUEST
+SYNC_DEADLINE = 10.0  # Seconds a peer has to answer a sync request before it counts as failed
+
 MSG_BUFFER_SIZE = 100
+MSG_RATE_LIMIT = 50.0  # Messages per second accepted from one host
+MSG_RATE_BURST = MSG_BUFFER_SIZE  # Messages accepted from one host at once
+RATE_LIMITER_SIZE = 10000  # Hosts whose message rate is tracked
+REJECTED_MESSAGES_CACHE_SIZE = 10000  # Invalid message digests remembered so they are not checked again
+
+# What a full message queue does with a new message
+EVICT_OLDEST = 0
+REJECT_NEWEST = 1
+MSG_EVICTION_POLICY = REJECT_NEWEST
 MSGS_PER_BLOCK = 10
+VERIFY_WORKERS = 4  # Threads verifying message signatures
+PUBLIC_KEY_CACHE_SIZE = 1024  # Parsed sender public keys kept in memory
+SIGNATURE_CACHE_SIZE = 65536  # Message signature check results kept in memory
 PROOF_OF_WORK_HARDNESS = 5
+REJECTED_BLOCKS_CACHE_SIZE = 10000  # Invalid block hashes remembered so they are not checked again
+ORPHAN_POOL_SIZE = 500  # Blocks kept while waiting for their parent to arrive
+ORPHAN_FETCH_DEPTH = 50  # Missing ancestors requested from a peer before waiting for the next update
+ORPHAN_FETCH_THREADS = 4  # Missing parent blocks requested at once
+ORPHAN_FETCH_QUEUE = 64  # Missing parent blocks being or waiting to be requested, before more are left to sync
 
 # Block spacing constants
 NONCE = 0
@@ -40,12 +90,25 @@ PRIVATE_KEY_FILE = 'private_keys.pem'
 KEY_DIRECTORY = 'key_directory.pem'
 
 LEDGER_FILE = 'ledger.txt'
+BINARY_LEDGER_FILE = 'ledger.bin'
+BINARY_LEDGER_EXTENSION = '.bin'
+BLOCK_STR_CACHE_SIZE = 1024  # Block strings read back from the ledger kept in memory
 MESSAGE_FILE = 'messages.txt'
 STATS_FILE = 'stats.txt'
 
 NONCE_BIT_LENGTH = 64
+NONCE_BATCH_SIZE = 2000  # Nonces a mining worker tries between checking for new work
+MINING_WORKERS = 1  # Default number of mining worker processes
 STATS_UPDATE_INTERVAL = 10
 
+# When the disk writer fsyncs the ledger and message file
+FSYNC_NEVER = 0
+FSYNC_BATCH = 1
+FSYNC_INTERVAL = 2
+DISK_FSYNC_POLICY = FSYNC_BATCH
+DISK_FSYNC_INTERVAL = 1.0  # Most seconds between fsyncs with FSYNC_INTERVAL
+DISK_BATCH_SIZE = 500  # Most write events the disk writer applies between flushes
+
 CONTINUE_MINING = 0
 GIVEN_BLOCK = 1
 MINED_BLOCK = 2
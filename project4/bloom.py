@@ -0,0 +1,84 @@
+"""Bloom filters for remembering which hashes have been seen."""
+import hashlib
+import math
+import threading
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        """
+        Set of strings which may report false positives but never false negatives.
+
+        The bit array is sized so that after capacity items have been added,
+        membership checks of other items are false positives with probability
+        error_rate.
+
+        :param capacity: Number of items the filter is sized for
+        :param error_rate: False positive rate at capacity
+        """
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: bit i is h1 + i * h2, from a single digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        """Number of items added, counting repeats."""
+        return self.count
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+
+class RollingBloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        """
+        Bloom filter which remembers at least the last capacity items added.
+
+        Items go into the current of two BloomFilters. Once it is full it
+        becomes the previous filter and the old previous filter is dropped,
+        so memory stays bounded and the false positive rate never exceeds
+        about twice error_rate. Safe to use from several threads.
+
+        :param capacity: Number of recent items always remembered
+        :param error_rate: False positive rate of each of the two filters
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            if len(self.current) >= self.capacity:
+                self.previous = self.current
+                self.current = BloomFilter(self.capacity, self.error_rate)
+            self.current.add(item)
+
+    def __contains__(self, item):
+        with self.lock:
+            return item in self.current or (self.previous is not None and item in self.previous)
+
+    def clear(self):
+        with self.lock:
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.previous = None
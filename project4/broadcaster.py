@@ -0,0 +1,214 @@
+"""Sends broadcast messages and blocks to every peer in parallel."""
+import logging
+import queue
+import threading
+import time
+
+from blockchain_constants import *
+from inventory import inventory_hash
+from link import LineResponse
+
+log = logging.getLogger('Server')
+
+SINGLE_COMMANDS = {MESSAGE_TYPE: "MESSAGE_BROADCAST", BLOCK_TYPE: "BLOCK_BROADCAST"}
+BATCH_COMMANDS = {MESSAGE_TYPE: "MESSAGES_BROADCAST", BLOCK_TYPE: "BLOCKS_BROADCAST"}
+
+
+class PeerSender(object):
+
+    def __init__(self, host, on_failure=None, pool=None, batch_size=BROADCAST_BATCH_SIZE,
+                 queue_size=PEER_QUEUE_SIZE, on_success=None):
+        """
+        Outbound queue and sender thread for a single peer.
+
+        The thread waits for an item, then takes up to batch_size queued
+        items. It announces their hashes with INV and sends the items the
+        peer asks for in one request per item type, using the batch commands
+        MESSAGES_BROADCAST and BLOCKS_BROADCAST. A peer which does not know
+        INV is sent every item, and one which does not know the batch
+        commands is sent one item per request with MESSAGE_BROADCAST and
+        BLOCK_BROADCAST.
+
+        :param host: Peer to send to
+        :param on_failure: Called with host when the peer cannot be reached
+        :param pool: ConnectionPool to send over. If None, every request
+                     opens its own connection.
+        :param batch_size: Most items sent per flush
+        :param queue_size: Most items waiting to be sent. Further items are dropped.
+        :param on_success: Called with (host, seconds) after each batch the peer received
+        """
+        self.host = host
+        self.on_failure = on_failure
+        self.on_success = on_success
+        self.pool = pool
+        self.batch_size = batch_size
+        self.announce = True
+        self.legacy = False
+        self.queue = queue.Queue(queue_size)
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item_type, item, item_hash=None):
+        """
+        Queues an item to be sent to the peer.
+
+        :param item_hash: inventory_hash() of the item, if already known
+        :return: False if the queue is full and the item was dropped
+        """
+        if item_hash is None:
+            item_hash = inventory_hash(item_type, item)
+        try:
+            self.queue.put_nowait((item_type, item, item_hash))
+            return True
+        except queue.Full:
+            log.debug("Outbound queue to %s is full, dropping item", self.host)
+            return False
+
+    def stop(self):
+        """Stops the sender thread after the batch it is sending. Items still queued are dropped."""
+        self._stopped = True
+        try:
+            # Wakes the thread if it is waiting for items
+            self.queue.put_nowait((None, None, None))
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while not self._stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [entry for entry in batch if entry[0] is not None]
+            if len(batch) == 0 or self._stopped:
+                continue
+
+            start = time.time()
+            try:
+                self.send(batch)
+            except (OSError, ValueError):
+                log.warning("Peer %s failed to receive broadcasting", self.host)
+                if self.on_failure is not None:
+                    self.on_failure(self.host)
+                continue
+            if self.on_success is not None:
+                self.on_success(self.host, time.time() - start)
+
+    def send(self, batch):
+        """
+        Sends a batch of (item_type, item, item_hash) entries to the peer, blocks first.
+
+        :raises OSError: If the peer cannot be reached
+        """
+        if self.announce:
+            batch = self._announce(batch)
+
+        for item_type in (BLOCK_TYPE, MESSAGE_TYPE):
+            items = [item for batch_type, item, _ in batch if batch_type == item_type]
+            if len(items) == 1 or (len(items) > 1 and self.legacy):
+                for item in items:
+                    self._send_single(item_type, item)
+            elif len(items) > 1:
+                self._send_batch(item_type, items)
+
+    def _request(self, payload):
+        if self.pool is not None:
+            return self.pool.request(self.host, payload)
+        return LineResponse(self.host, payload)
+
+    def _announce(self, batch):
+        """
+        Announces a batch with INV.
+
+        :return: The entries of batch the peer asked for
+        """
+        payload = "INV\n%d\n" % len(batch) + "".join("%d %s\n" % (item_type, item_hash)
+                                                      for item_type, _, item_hash in batch)
+        with self._request(payload) as f_in:
+            reply = f_in.readline()
+            if reply.startswith("ERROR Command not recognized"):
+                log.info("Peer %s does not accept INV, sending whole items", self.host)
+                self.announce = False
+                return batch
+
+            wanted = set()
+            for _ in range(int(reply)):
+                item_type, item_hash = f_in.readline().split()
+                wanted.add((int(item_type), item_hash))
+        return [entry for entry in batch if (entry[0], entry[2]) in wanted]
+
+    def _send_single(self, item_type, item):
+        """Sends one item with MESSAGE_BROADCAST or BLOCK_BROADCAST and reads the reply."""
+        with self._request("%s\n%s\n" % (SINGLE_COMMANDS[item_type], item)) as f_in:
+            # The reply only tells us the item arrived before we hang up
+            f_in.readline()
+
+    def _send_batch(self, item_type, items):
+        """Sends items with MESSAGES_BROADCAST or BLOCKS_BROADCAST, falling back to single commands."""
+        payload = "%s\n%d\n" % (BATCH_COMMANDS[item_type], len(items)) + "".join(item + "\n" for item in items)
+        with self._request(payload) as f_in:
+            reply = f_in.readline()
+            if reply.startswith("ERROR Command not recognized"):
+                log.info("Peer %s does not accept %s, sending items one by one",
+                         self.host, BATCH_COMMANDS[item_type])
+                self.legacy = True
+            else:
+                # One reply line per item
+                for _ in range(len(items) - 1):
+                    f_in.readline()
+                return
+
+        for item in items:
+            self._send_single(item_type, item)
+
+
+class Broadcaster(object):
+
+    def __init__(self, on_failure=None, pool=None, on_success=None):
+        """
+        Fans broadcast items out to every peer through a PeerSender each.
+
+        Peers are sent to in parallel, so a slow or unreachable peer only
+        delays its own queue, and the time to broadcast an item does not grow
+        with the number of peers.
+
+        :param on_failure: Called with the host of a peer which could not be reached
+        :param pool: ConnectionPool the senders send over
+        :param on_success: Called with (host, seconds) after a peer received a batch
+        """
+        self.on_failure = on_failure
+        self.on_success = on_success
+        self.pool = pool
+        self.senders = {}  # host -> PeerSender
+
+    def broadcast(self, hosts, item_type, item):
+        """
+        Queues an item for every peer in hosts.
+
+        Senders are started for new hosts, in the order given, and stopped
+        for hosts no longer listed.
+
+        :param hosts: Hosts of all current peers, best first
+        :param item_type: MESSAGE_TYPE or BLOCK_TYPE
+        :param item: Message or block string
+        """
+        item_hash = inventory_hash(item_type, item)
+        current = set(hosts)
+        for host in list(self.senders):
+            if host not in current:
+                self.senders.pop(host).stop()
+
+        for host in hosts:
+            if host not in self.senders:
+                self.senders[host] = PeerSender(host, self.on_failure, self.pool, on_success=self.on_success)
+            self.senders[host].put(item_type, item, item_hash)
+
+    def close(self):
+        for sender in self.senders.values():
+            sender.stop()
+        self.senders = {}
@@ -0,0 +1,50 @@
+"""Bounded caches shared between threads."""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, capacity):
+        """
+        Thread-safe dictionary which holds at most capacity entries.
+
+        When full, adding an entry evicts the least recently used one.
+
+        :param capacity: Maximum number of entries
+        """
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as recently used, or default if it is not cached."""
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Caches value for key, evicting the least recently used entry if the cache is full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, or default if it is not cached."""
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,15 @@
+"""
+Converts a text ledger into the binary ledger format.
+
+Usage: python3 convert_ledger.py [ledger.txt] [ledger.bin]
+"""
+import sys
+
+from blockchain_constants import *
+from ledger import convert_text_ledger
+
+if __name__ == '__main__':
+    text_file = sys.argv[1] if len(sys.argv) > 1 else LEDGER_FILE
+    binary_file = sys.argv[2] if len(sys.argv) > 2 else BINARY_LEDGER_FILE
+    count = convert_text_ledger(text_file, binary_file)
+    print("Wrote %d blocks to %s" % (count, binary_file))
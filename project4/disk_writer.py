@@ -0,0 +1,173 @@
+"""Writes the ledger, message file and stats file on a background thread."""
+import logging
+import os
+import queue
+import threading
+import time
+
+from blockchain_constants import *
+
+log = logging.getLogger('blockchain')
+
+# Write events: (kind, data, callback)
+APPEND_BLOCK = 0  # data is (block_hash, block_str), callback gets the record offset, None if not written
+APPEND_MESSAGES = 1  # data is bytes to append to the message file
+TRUNCATE_MESSAGES = 2  # data is the new size of the message file
+WRITE_STATS = 3  # data is the new contents of the stats file
+FLUSH = 4  # callback is called once everything queued before it is written
+
+
+class DiskWriter(object):
+
+    def __init__(self, ledger, message_file, stats_file, fsync_policy=DISK_FSYNC_POLICY,
+                 batch_size=DISK_BATCH_SIZE):
+        """
+        Persists Blockchain state without holding up the Blockchain lock.
+
+        The Blockchain queues write events, which a writer thread applies in
+        order, up to batch_size at a time. All appends in a batch are
+        flushed together, only the last stats update of a batch is written,
+        and files are fsynced according to fsync_policy:
+
+        - FSYNC_NEVER leaves it to the operating system
+        - FSYNC_BATCH syncs after every batch
+        - FSYNC_INTERVAL syncs at most once every DISK_FSYNC_INTERVAL seconds
+
+        Block offset callbacks run on the writer thread once the block can be
+        read back from the ledger, or with None if it could not be written.
+
+        :param ledger: TextLedger or BinaryLedger to append blocks to
+        :param message_file: File name of the main chain message file
+        :param stats_file: File name of the stats file
+        """
+        self.ledger = ledger
+        self.stats_file = stats_file
+        self.fsync_policy = fsync_policy
+        self.batch_size = batch_size
+        self.last_sync = time.time()
+        self._messages = open(message_file, 'ab')
+        self._events = queue.Queue()
+        self._closed = False
+
+        self._writer = threading.Thread(target=self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def append_block(self, block_hash, block_str, on_written=None):
+        """
+        :param on_written: Called with the offset of the ledger record once it is written, or None if it could not be
+        """
+        self._events.put((APPEND_BLOCK, (block_hash, block_str), on_written))
+
+    def append_messages(self, data):
+        """
+        :type data: bytes
+        """
+        self._events.put((APPEND_MESSAGES, data, None))
+
+    def truncate_messages(self, size):
+        self._events.put((TRUNCATE_MESSAGES, size, None))
+
+    def write_stats(self, stats):
+        """
+        :param stats: The whole text of the stats file
+        """
+        self._events.put((WRITE_STATS, stats, None))
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued so far is written.
+
+        :return: False if it timed out
+        """
+        done = threading.Event()
+        self._events.put((FLUSH, None, done.set))
+        return done.wait(timeout)
+
+    def close(self):
+        """Writes out everything queued, syncs the files and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._events.put(None)
+        self._writer.join()
+        self._messages.close()
+
+    def _run(self):
+        """Writer thread loop."""
+        while True:
+            batch = [self._events.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            try:
+                self._write(batch, stopping)
+            except Exception:
+                # Keep writing later batches whatever went wrong with this one
+                log.exception("Error writing blockchain files")
+            if stopping:
+                return
+
+    def _write(self, batch, sync=False):
+        """
+        Applies a batch of write events in order. Syncs the files if sync is True or the policy says so.
+
+        A failed event is logged and the rest of the batch still written.
+        Block callbacks get None for the offset of a block which could not
+        be written, and FLUSH callbacks are always called.
+        """
+        appended = []  # (callback, offset or None)
+        flushed = []
+        try:
+            stats = None
+            for kind, data, callback in batch:
+                offset = None
+                try:
+                    if kind == APPEND_BLOCK:
+                        offset = self.ledger.append(data[0], data[1], flush=False)
+                    elif kind == APPEND_MESSAGES:
+                        self._messages.write(data)
+                    elif kind == TRUNCATE_MESSAGES:
+                        self._messages.flush()
+                        os.ftruncate(self._messages.fileno(), data)
+                    elif kind == WRITE_STATS:
+                        stats = data
+                except Exception:
+                    log.exception("Error writing blockchain files")
+                if kind == APPEND_BLOCK and callback is not None:
+                    appended.append((callback, offset))
+                elif kind == FLUSH:
+                    flushed.append(callback)
+
+            try:
+                self.ledger.flush()
+            except Exception:
+                # The new records cannot be read back
+                appended = [(callback, None) for callback, _ in appended]
+                raise
+            self._messages.flush()
+            if stats is not None:
+                with open(self.stats_file, 'w') as stats_file:
+                    stats_file.write(stats)
+
+            now = time.time()
+            if sync or self.fsync_policy == FSYNC_BATCH or \
+                    (self.fsync_policy == FSYNC_INTERVAL and now - self.last_sync >= DISK_FSYNC_INTERVAL):
+                self.ledger.sync()
+                os.fsync(self._messages.fileno())
+                self.last_sync = now
+        finally:
+            # Only now can the new records be read back
+            for callback, offset in appended:
+                try:
+                    callback(offset)
+                except Exception:
+                    log.exception("Error in block written callback")
+            for callback in flushed:
+                callback()
@@ -0,0 +1,82 @@
+"""Tracks which blocks and messages a node has seen, for inventory gossip."""
+import hashlib
+import time
+
+from blockchain_constants import *
+from bloom import RollingBloomFilter
+from cache import LRUCache
+
+
+def inventory_hash(item_type, item):
+    """
+    Hash a block or message string is announced by.
+
+    Blocks are announced by their block hash (SHA-512) and messages by
+    Message.digest (SHA-256), so a receiver can look them up directly.
+
+    :param item_type: MESSAGE_TYPE or BLOCK_TYPE
+    :param item: Block or message string
+    :rtype: str
+    """
+    if item_type == BLOCK_TYPE:
+        return hashlib.sha512(item.encode()).hexdigest()
+    return hashlib.sha256(item.encode()).hexdigest()
+
+
+class Inventory(object):
+
+    def __init__(self, blockchain, capacity=SEEN_FILTER_CAPACITY, error_rate=SEEN_FILTER_ERROR_RATE):
+        """
+        Decides which announced blocks and messages to ask a peer for.
+
+        Hashes of every item received are kept in a RollingBloomFilter, so
+        items which were invalid, or have already left the message queue,
+        are not fetched again. Items we asked a peer for are not asked for
+        again for INV_REQUEST_TIMEOUT, since every peer announces the same
+        item at about the same time.
+
+        :param blockchain: Blockchain checked for blocks and messages we already have
+        :param capacity: Number of recent item hashes always remembered
+        :param error_rate: False positive rate of the seen filter
+        """
+        self.blockchain = blockchain
+        self.seen = RollingBloomFilter(capacity, error_rate)
+        self.requested = LRUCache(INV_REQUEST_CACHE_SIZE)  # item hash -> time requested
+
+    def add(self, item_type, item):
+        """
+        Records that a block or message string was received.
+
+        :return: The inventory hash of the item
+        """
+        item_hash = inventory_hash(item_type, item)
+        self.mark_seen(item_hash)
+        return item_hash
+
+    def mark_seen(self, item_hash):
+        """Records that the item with the given inventory hash was received."""
+        self.seen.add(item_hash)
+
+    def want(self, item_type, item_hash):
+        """
+        Whether to ask the announcing peer for an item.
+
+        Returns True at most once per INV_REQUEST_TIMEOUT for the same item.
+
+        :param item_type: MESSAGE_TYPE or BLOCK_TYPE
+        :param item_hash: The announced inventory hash
+        :rtype: bool
+        """
+        if item_hash in self.seen:
+            return False
+        if item_type == BLOCK_TYPE and self.blockchain.has_block(item_hash):
+            return False
+        if item_type == MESSAGE_TYPE and self.blockchain.has_message(item_hash):
+            return False
+
+        now = time.time()
+        requested = self.requested.get(item_hash)
+        if requested is not None and now - requested < INV_REQUEST_TIMEOUT:
+            return False
+        self.requested.put(item_hash, now)
+        return True
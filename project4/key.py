@@ -8,6 +8,39 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 
+from blockchain_constants import *
+from cache import LRUCache
+
+# Parsed public key objects keyed by the SHA-256 hex digest of their PEM.
+# Shared by every Keys object and by message signature verification.
+public_key_cache = LRUCache(PUBLIC_KEY_CACHE_SIZE)
+
+
+def get_pem_hash(pem):
+    """Returns the SHA-256 hex digest of a PEM public key, as used for miner ids and pub_table."""
+    if isinstance(pem, str):
+        pem = pem.encode()
+    return hashlib.sha256(pem).hexdigest()
+
+
+def load_public_key(pem):
+    """
+    Parses a PEM encoded public key, reusing the cached key object if the same
+    PEM was parsed before.
+
+    :param pem: PEM encoded public key
+    :type pem: str or bytes
+    :raises ValueError: If the PEM is not a valid public key
+    """
+    if isinstance(pem, str):
+        pem = pem.encode()
+    pem_hash = get_pem_hash(pem)
+    public_key = public_key_cache.get(pem_hash)
+    if public_key is None:
+        public_key = serialization.load_pem_public_key(pem, backend=default_backend())
+        public_key_cache.put(pem_hash, public_key)
+    return public_key
+
 
 class Keys:
 
@@ -55,8 +88,9 @@ class Keys:
 
             for index in range(key_num):
                 public_key, public_key_str = load_key(data, index, False)
-                public_key_hash = hashlib.sha256(public_key_str).hexdigest()
+                public_key_hash = get_pem_hash(public_key_str)
                 self.pub_table[public_key_hash] = public_key
+                public_key_cache.put(public_key_hash, public_key)
 
     def get_main_pub_key(self):
         return self.publickey_main.public_bytes(
@@ -0,0 +1,327 @@
+"""Append-only storage for the block strings of a Blockchain."""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from binascii import hexlify, unhexlify
+
+from blockchain_constants import *
+from cache import LRUCache
+from objects import parse_block
+
+log = logging.getLogger('blockchain')
+
+LEDGER_MAGIC = b'BBSLEDG1'
+# Record header: payload length, CRC-32 of hash + payload, raw SHA-512 block hash
+RECORD_HEADER = struct.Struct('>II64s')
+# Index entry: raw SHA-512 block hash, offset of the record in the ledger
+INDEX_ENTRY = struct.Struct('>64sQ')
+
+
+def open_ledger(file_name):
+    """
+    Opens the ledger stored in file_name.
+
+    Files ending in BINARY_LEDGER_EXTENSION use the binary format, anything
+    else is treated as a plain ledger.txt with one block string per line.
+
+    :rtype: TextLedger or BinaryLedger
+    """
+    if file_name.endswith(BINARY_LEDGER_EXTENSION):
+        return BinaryLedger(file_name)
+    return TextLedger(file_name)
+
+
+class TextLedger(object):
+    """
+    Ledger file with one block string per line.
+
+    Block hashes are not stored, so blocks loaded from a text ledger have to
+    be re-verified.
+    """
+
+    trusted = False
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.cache = LRUCache(BLOCK_STR_CACHE_SIZE)  # record offset -> block string
+        self._ledger = None  # Opened by the first append
+        self._reader = None  # Opened by the first read
+        self._read_lock = threading.Lock()
+
+    def __iter__(self):
+        """Yields (block_hash, offset, block_str) for every block. block_hash is always None."""
+        with open(self.file_name, 'rb') as ledger:
+            offset = ledger.tell()
+            for line in ledger:
+                yield None, offset, line.decode().strip()
+                offset += len(line)
+
+    def append(self, block_hash, block_str, flush=True):
+        """
+        Appends a block string to the ledger.
+
+        :param flush: Whether to flush the file. Otherwise the record cannot
+                      be read back until flush() is called.
+        :return: Offset of the new record
+        """
+        if self._ledger is None:
+            self._ledger = open(self.file_name, 'ab')
+        offset = self._ledger.tell()
+        self._ledger.write((block_str + "\n").encode())
+        if flush:
+            self._ledger.flush()
+        return offset
+
+    def read(self, offset):
+        """Returns the block string stored at offset. Recently read block strings are cached."""
+        block_str = self.cache.get(offset)
+        if block_str is None:
+            with self._read_lock:
+                if self._reader is None:
+                    self._reader = open(self.file_name, 'rb')
+                self._reader.seek(offset)
+                block_str = self._reader.readline().decode().strip()
+            self.cache.put(offset, block_str)
+        return block_str
+
+    def flush(self):
+        if self._ledger is not None:
+            self._ledger.flush()
+
+    def sync(self):
+        """Flushes the ledger and waits until it is on disk."""
+        if self._ledger is not None:
+            self._ledger.flush()
+            os.fsync(self._ledger.fileno())
+
+    def close(self):
+        if self._ledger is not None:
+            self._ledger.close()
+            self._ledger = None
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+class BinaryLedger(object):
+    """
+    Binary ledger of length-prefixed, checksummed block records.
+
+    The file starts with LEDGER_MAGIC, followed by one record per block: a
+    RECORD_HEADER holding the payload length, a CRC-32 and the block hash,
+    then the block string itself. Since the hash of every record was checked
+    when the block was first added, blocks loaded from this file are trusted
+    and not hashed again.
+
+    A companion index file (file_name + '.idx') maps block hashes to record
+    offsets so single blocks can be read without scanning the ledger. Records
+    are read through a memory map of the ledger.
+    """
+
+    trusted = True
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index_file_name = file_name + '.idx'
+        self.offsets = {}  # block hash -> record offset
+        self.cache = LRUCache(BLOCK_STR_CACHE_SIZE)  # record offset -> block string
+        self._map = None
+        # Guards the memory map, which is replaced as the ledger grows
+        self._map_lock = threading.Lock()
+
+        if not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0:
+            with open(self.file_name, 'wb') as ledger:
+                ledger.write(LEDGER_MAGIC)
+            open(self.index_file_name, 'wb').close()
+
+        with open(self.file_name, 'rb') as ledger:
+            if ledger.read(len(LEDGER_MAGIC)) != LEDGER_MAGIC:
+                raise ValueError("%s is not a binary ledger" % self.file_name)
+
+        self._size = os.path.getsize(self.file_name)  # Bytes of the ledger which can be read
+        self._load_index()
+        self._end = self._size  # Bytes of the ledger written, including ones not flushed yet
+        self._unflushed = []  # (block hash, offset) of records not flushed yet
+        self._ledger = open(self.file_name, 'ab')
+        self._index = open(self.index_file_name, 'ab')
+
+    def _load_index(self):
+        """
+        Reads the offset index, then indexes any records written after it.
+
+        A record with a bad checksum or a truncated record at the end of the
+        file (e.g. from a crash mid-write) is cut off along with everything
+        after it. If the index does not match the ledger it is rebuilt.
+        """
+        if os.path.exists(self.index_file_name):
+            with open(self.index_file_name, 'rb') as index:
+                data = index.read()
+            for i in range(len(data) // INDEX_ENTRY.size):
+                raw_hash, offset = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                self.offsets[hexlify(raw_hash).decode()] = offset
+
+        # Records after the last indexed one are missing from the index
+        offset = len(LEDGER_MAGIC)
+        rebuild = False
+        if len(self.offsets) > 0:
+            last_hash, last_offset = max(self.offsets.items(), key=lambda item: item[1])
+            record = self._read_record(last_offset)
+            if record is not None and record[0] == last_hash:
+                offset = record[2]
+            else:
+                log.warning("Index of %s is out of date, rebuilding it", self.file_name)
+                self.offsets = {}
+                rebuild = True
+
+        missing = []
+        while True:
+            record = self._read_record(offset)
+            if record is None:
+                break
+            missing.append((record[0], offset))
+            offset = record[2]
+
+        if offset < self._size:
+            log.warning("Truncating corrupt tail of %s at offset %d", self.file_name, offset)
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            os.truncate(self.file_name, offset)
+            self._size = offset
+
+        for block_hash, record_offset in missing:
+            self.offsets[block_hash] = record_offset
+        with open(self.index_file_name, 'wb' if rebuild else 'ab') as index:
+            entries = sorted(self.offsets.items(), key=lambda item: item[1]) if rebuild else missing
+            for block_hash, record_offset in entries:
+                index.write(INDEX_ENTRY.pack(unhexlify(block_hash), record_offset))
+
+    def _get_map(self):
+        """Returns a memory map covering the whole ledger."""
+        if self._map is None or len(self._map) < self._size:
+            if self._map is not None:
+                self._map.close()
+            with open(self.file_name, 'rb') as ledger:
+                self._map = mmap.mmap(ledger.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _read_record(self, offset):
+        """
+        Reads and checks the record at offset.
+
+        :return: (block_hash, block_str, next_offset), or None if the record is
+                 truncated or its checksum does not match
+        """
+        if offset + RECORD_HEADER.size > self._size:
+            return None
+        with self._map_lock:
+            data = self._get_map()
+            length, checksum, raw_hash = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > self._size:
+                return None
+            payload = data[start:start + length]
+        if zlib.crc32(raw_hash + payload) != checksum:
+            return None
+        return hexlify(raw_hash).decode(), payload.decode(), start + length
+
+    def __iter__(self):
+        """Yields (block_hash, offset, block_str) for every block in the order they were added."""
+        offset = len(LEDGER_MAGIC)
+        while True:
+            record = self._read_record(offset)
+            if record is None:
+                return
+            block_hash, block_str, next_offset = record
+            yield block_hash, offset, block_str
+            offset = next_offset
+
+    def append(self, block_hash, block_str, flush=True):
+        """
+        Appends a block record and indexes it.
+
+        :param block_hash: SHA-512 hex digest of the block string
+        :param block_str: The string form of the block
+        :param flush: Whether to flush the files. Otherwise the record cannot
+                      be read back until flush() is called.
+        :return: Offset of the new record
+        """
+        raw_hash = unhexlify(block_hash)
+        payload = block_str.encode()
+        offset = self._end
+        self._ledger.write(RECORD_HEADER.pack(len(payload), zlib.crc32(raw_hash + payload), raw_hash))
+        self._ledger.write(payload)
+        self._index.write(INDEX_ENTRY.pack(raw_hash, offset))
+        self._end += RECORD_HEADER.size + len(payload)
+        self._unflushed.append((block_hash, offset))
+        if flush:
+            self.flush()
+        return offset
+
+    def read(self, offset):
+        """Returns the block string stored in the record at offset. Recently read block strings are cached."""
+        block_str = self.cache.get(offset)
+        if block_str is None:
+            record = self._read_record(offset)
+            if record is None:
+                raise ValueError("No valid ledger record at offset %d" % offset)
+            block_str = record[1]
+            self.cache.put(offset, block_str)
+        return block_str
+
+    def get_block_str(self, block_hash):
+        """Returns the string of the block with the given hash, or None if it is not in the ledger."""
+        if block_hash not in self.offsets:
+            return None
+        return self.read(self.offsets[block_hash])
+
+    def flush(self):
+        """Flushes appended records, after which they can be read."""
+        self._ledger.flush()
+        self._index.flush()
+        self._size = self._end
+        for block_hash, offset in self._unflushed:
+            self.offsets[block_hash] = offset
+        self._unflushed = []
+
+    def sync(self):
+        """Flushes the ledger and its index and waits until they are on disk."""
+        self.flush()
+        os.fsync(self._ledger.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        with self._map_lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+        self._ledger.close()
+        self._index.close()
+
+
+def convert_text_ledger(text_file, binary_file):
+    """
+    Converts a ledger.txt into a binary ledger.
+
+    Every block is parsed and its Proof-of-Work checked, since the binary
+    ledger is trusted when it is loaded. Invalid blocks are skipped.
+
+    :return: Number of blocks written
+    """
+    ledger = BinaryLedger(binary_file)
+    written = 0
+    try:
+        for _, _, block_str in TextLedger(text_file):
+            block = parse_block(block_str)
+            if block is None or not block.verify_pow():
+                log.warning("Skipping invalid block: %s", block_str[:40])
+                continue
+            ledger.append(block.block_hash, repr(block))
+            written += 1
+    finally:
+        ledger.close()
+    return written
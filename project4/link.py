@@ -0,0 +1,490 @@
+"""
+Long-lived, multiplexed connections to peers.
+
+A client opens a link by sending the line "LINK". A server which knows the
+command replies "ACK", after which both sides exchange frames. A frame is a
+FRAME_HEADER (payload length, request id, flags) followed by the payload.
+Request frames carry a whole line protocol request, e.g.
+"MESSAGE_BROADCAST\\n<message>\\n". The server answers each with one or more
+response frames carrying the same request id. Every frame but the last has
+FRAME_MORE set, so long responses such as UPDATE_STREAM are still streamed.
+Frames with request id KEEPALIVE_ID are echoed back by the server.
+
+Responses are flow controlled per request. The server sends at most
+LINK_RESPONSE_WINDOW frames of a response before the client grants more
+with a FRAME_CREDIT frame, whose payload is the number of frames granted.
+A client which stops reading a response early sends FRAME_CANCEL. A slow
+reader therefore holds back only its own response, not the whole link.
+A client has at most LINK_MAX_IN_FLIGHT requests open on a link, so the
+server never stops reading a link while it waits for credit.
+
+Servers which do not know LINK reply "ERROR Command not recognized". Those
+peers are sent every request over its own connection, as before.
+"""
+import logging
+import queue
+import struct
+import threading
+import time
+from socket import create_connection, timeout, IPPROTO_TCP, SHUT_RDWR, TCP_NODELAY
+
+from blockchain_constants import *
+
+log = logging.getLogger('Server')
+
+# Frame header: payload length, request id, flags
+FRAME_HEADER = struct.Struct('>IIB')
+FRAME_MORE = 1  # More response frames follow for this request
+FRAME_CREDIT = 2  # Client grants more response frames for this request
+FRAME_CANCEL = 4  # Client no longer wants the response to this request
+FRAME_CONTROL = FRAME_CREDIT | FRAME_CANCEL
+KEEPALIVE_ID = 0
+
+
+class LegacyPeerError(Exception):
+    """Raised when a peer does not accept LINK."""
+
+
+class RequestCancelled(OSError):
+    """Raised by FrameWriter when the client cancelled the request or stopped granting credit."""
+
+
+def pack_frame(request_id, flags, payload):
+    """
+    :type payload: bytes
+    :rtype: bytes
+    """
+    return FRAME_HEADER.pack(len(payload), request_id, flags) + payload
+
+
+def read_frame(rfile):
+    """
+    Reads a frame from a binary file.
+
+    :return: (request_id, flags, payload), or None at the end of the file
+    :raises ValueError: If the frame is truncated or larger than MAX_FRAME_SIZE
+    """
+    header = rfile.read(FRAME_HEADER.size)
+    if len(header) == 0:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    length, request_id, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame of %d bytes too large" % length)
+    payload = rfile.read(length)
+    if len(payload) < length:
+        raise ValueError("Truncated frame")
+    return request_id, flags, payload
+
+
+class FrameWriter(object):
+    """
+    File-like object which sends what is written to it as response frames.
+
+    Used as f_out for Server.handle_request. Each flush() sends the data
+    written so far as a frame with FRAME_MORE set, and close() sends the
+    final frame. flush() waits while the client has not granted credit for
+    another frame, and raises RequestCancelled if it does not within
+    LINK_IDLE_TIMEOUT or cancelled the request.
+    """
+
+    def __init__(self, send_frame, request_id, window=LINK_RESPONSE_WINDOW):
+        """
+        :param send_frame: Called with (request_id, flags, payload) to send a frame
+        :param request_id: Id of the request being answered
+        :param window: Frames which may be sent before the client grants more
+        """
+        self.send_frame = send_frame
+        self.request_id = request_id
+        self.buffer = []
+        self.credits = threading.Semaphore(window)
+        self.cancelled = False
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            if not self.credits.acquire(timeout=LINK_IDLE_TIMEOUT):
+                raise RequestCancelled("No credit granted for request %d" % self.request_id)
+            if self.cancelled:
+                raise RequestCancelled("Request %d cancelled" % self.request_id)
+            self.send_frame(self.request_id, FRAME_MORE, "".join(self.buffer).encode())
+            self.buffer = []
+
+    def close(self):
+        if not self.cancelled:
+            self.send_frame(self.request_id, 0, "".join(self.buffer).encode())
+        self.buffer = []
+
+    def cancel(self):
+        """Stops sending the response, e.g. because the link closed."""
+        self.cancelled = True
+        # Wakes a flush() waiting for credit
+        self.credits.release()
+
+    def control(self, flags, payload):
+        """
+        Applies a FRAME_CREDIT or FRAME_CANCEL frame the client sent for the request.
+
+        :raises ValueError: If a credit payload is not a positive number
+        """
+        if flags & FRAME_CANCEL:
+            self.cancel()
+        else:
+            credit = int(payload)
+            if credit <= 0:
+                raise ValueError("Invalid credit %d" % credit)
+            self.credits.release(credit)
+
+
+class LinkResponse(object):
+    """
+    Response to a request sent over a PeerLink, read like a socket file.
+
+    readline() raises socket.timeout if no frame arrives within TIMEOUT, and
+    returns '' once the response is complete or the link closed. Credit for
+    more frames is granted as they are read, so at most
+    LINK_RESPONSE_WINDOW frames are ever queued.
+    """
+
+    def __init__(self, link, request_id):
+        self.link = link
+        self.request_id = request_id
+        self.chunks = queue.Queue()
+        self.buffer = ''
+        self.done = False
+        self.read_frames = 0  # Frames read since credit was last granted
+
+    def feed(self, payload, final):
+        """
+        Called by the link reader with each response frame. A None payload means the link closed.
+
+        :return: False if the peer sent more frames than it was granted
+        """
+        if payload is not None and not final and self.chunks.qsize() >= LINK_RESPONSE_WINDOW:
+            return False
+        self.chunks.put((payload, final))
+        return True
+
+    def readline(self):
+        while '\n' not in self.buffer and not self.done:
+            try:
+                payload, final = self.chunks.get(timeout=TIMEOUT)
+            except queue.Empty:
+                raise timeout("No response from %s" % self.link.host)
+            if payload is None:
+                self.done = True
+            else:
+                self.buffer += payload.decode()
+                self.done = final
+                if not final:
+                    self.read_frames += 1
+                    if self.read_frames >= LINK_RESPONSE_WINDOW // 2:
+                        self.link.grant(self.request_id, self.read_frames)
+                        self.read_frames = 0
+
+        end = self.buffer.find('\n') + 1
+        if end == 0:
+            end = len(self.buffer)
+        line = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        return line
+
+    def close(self):
+        if not self.done:
+            self.link.cancel(self.request_id)
+        self.done = True
+        self.link.discard(self.request_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LineResponse(object):
+    """Response to a request sent over its own connection with the line protocol."""
+
+    def __init__(self, host, payload):
+        self.sock = create_connection((host, DEFAULT_PORT), TIMEOUT)
+        try:
+            self.sock.sendall(payload.encode())
+            self.f_in = self.sock.makefile('r')
+        except:
+            self.sock.close()
+            raise
+
+    def readline(self):
+        return self.f_in.readline()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PeerLink(object):
+
+    def __init__(self, host):
+        """
+        Opens a link to host and starts its reader thread.
+
+        :raises LegacyPeerError: If the peer does not accept LINK
+        :raises OSError: If the peer cannot be reached
+        """
+        self.host = host
+        self.sock = create_connection((host, DEFAULT_PORT), TIMEOUT)
+        try:
+            self.sock.sendall(b"LINK\n")
+            self.rfile = self.sock.makefile('rb')
+            reply = self.rfile.readline().strip()
+        except:
+            self.sock.close()
+            raise
+        if reply.startswith(b"ERROR Server busy") or reply.startswith(b"ERROR Too many connections"):
+            # The peer knows LINK but cannot take the connection now
+            self.sock.close()
+            raise OSError("%s refused the link: %s" % (host, reply.decode()))
+        if reply != b"ACK":
+            self.sock.close()
+            raise LegacyPeerError(host)
+
+        # The reader blocks until the link closes. Dead links are found by keepalive().
+        self.sock.settimeout(None)
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.closed = False
+        self.last_sent = self.last_received = time.time()
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_id = KEEPALIVE_ID + 1
+        self.responses = {}  # request id -> LinkResponse
+        self.in_flight = threading.BoundedSemaphore(LINK_MAX_IN_FLIGHT)
+
+        self._reader = threading.Thread(target=self._read_frames)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def request(self, payload):
+        """
+        Sends a line protocol request over the link.
+
+        Waits while LINK_MAX_IN_FLIGHT responses are still open on the link.
+
+        :param payload: Command line and any lines following it
+        :return: LinkResponse to read the reply from
+        :raises OSError: If the link is closed
+        :raises socket.timeout: If no response finished within TIMEOUT
+        """
+        if not self.in_flight.acquire(timeout=TIMEOUT):
+            raise timeout("Too many requests open on the link to %s" % self.host)
+        with self.lock:
+            if self.closed:
+                self.in_flight.release()
+                raise OSError("Link to %s is closed" % self.host)
+            request_id = self.next_id
+            self.next_id = self.next_id % 0xffffffff + 1
+            response = LinkResponse(self, request_id)
+            self.responses[request_id] = response
+        try:
+            self._send(request_id, payload.encode())
+        except OSError:
+            self.discard(request_id)
+            raise
+        return response
+
+    def keepalive(self):
+        """
+        Pings the peer if the link has been quiet, and closes the link if the
+        peer has not answered for LINK_IDLE_TIMEOUT.
+
+        :return: False if the link is closed
+        """
+        now = time.time()
+        if now - self.last_received > LINK_IDLE_TIMEOUT:
+            log.info("Link to %s timed out", self.host)
+            self.close()
+        elif now - self.last_sent >= LINK_KEEPALIVE_INTERVAL:
+            try:
+                self._send(KEEPALIVE_ID, b'')
+            except OSError:
+                pass
+        return not self.closed
+
+    def grant(self, request_id, credit):
+        """Lets the peer send credit more frames of the response to a request."""
+        try:
+            self._send(request_id, b"%d" % credit, FRAME_CREDIT)
+        except OSError:
+            # The response gets None once the reader sees the link closed
+            pass
+
+    def cancel(self, request_id):
+        """Tells the peer to stop sending the response to a request."""
+        try:
+            self._send(request_id, b'', FRAME_CANCEL)
+        except OSError:
+            pass
+
+    def discard(self, request_id):
+        """Drops any further frames for a request."""
+        with self.lock:
+            self._remove(request_id)
+
+    def _remove(self, request_id):
+        """Forgets a request, freeing its in-flight slot. Must hold self.lock."""
+        if self.responses.pop(request_id, None) is not None:
+            self.in_flight.release()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            responses = list(self.responses.values())
+            for request_id in list(self.responses):
+                self._remove(request_id)
+        try:
+            # Unblocks the reader and any sender
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for response in responses:
+            response.feed(None, True)
+
+    def _send(self, request_id, payload, flags=0):
+        if self.closed:
+            raise OSError("Link to %s is closed" % self.host)
+        try:
+            with self.send_lock:
+                self.sock.sendall(pack_frame(request_id, flags, payload))
+            self.last_sent = time.time()
+        except OSError:
+            self.close()
+            raise
+
+    def _read_frames(self):
+        """Reader thread loop. Hands each response frame to its LinkResponse."""
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    break
+                self.last_received = time.time()
+                request_id, flags, payload = frame
+                if request_id == KEEPALIVE_ID:
+                    continue
+
+                final = not flags & FRAME_MORE
+                with self.lock:
+                    response = self.responses.get(request_id)
+                    if final:
+                        self._remove(request_id)
+                if response is not None and not response.feed(payload, final):
+                    raise ValueError("Peer sent more frames than granted for request %d" % request_id)
+        except (OSError, ValueError) as e:
+            log.debug("Link to %s failed: %s", self.host, e)
+        self.close()
+
+
+class ConnectionPool(object):
+
+    def __init__(self):
+        """
+        Keeps one PeerLink open to every peer we send requests to.
+
+        Links are opened on first use and reopened if they drop. A keepalive
+        thread pings quiet links and closes dead ones. Peers which do not
+        accept LINK are sent each request over a new connection, and asked
+        again after LEGACY_RETRY_INTERVAL in case they were upgraded.
+        """
+        self.lock = threading.Lock()
+        self.links = {}  # host -> PeerLink
+        self.legacy_hosts = {}  # host -> time the peer refused LINK
+
+        self._keepalive = threading.Thread(target=self._keep_alive)
+        self._keepalive.daemon = True
+        self._keepalive.start()
+
+    def request(self, host, payload):
+        """
+        Sends a line protocol request to host.
+
+        :param payload: Command line and any lines following it, e.g. "PEER_REQUEST\\n"
+        :return: Response with readline() and close(), usable as a context manager
+        :raises OSError: If the peer cannot be reached
+        """
+        link = self._get_link(host)
+        if link is None:
+            return LineResponse(host, payload)
+        try:
+            return link.request(payload)
+        except OSError:
+            if not link.closed:
+                raise
+            # The link went stale since it was last used, so reconnect once
+            link = self._get_link(host)
+            if link is None:
+                return LineResponse(host, payload)
+            return link.request(payload)
+
+    def _get_link(self, host):
+        """Returns an open link to host, or None if host only speaks the line protocol."""
+        with self.lock:
+            link = self.links.get(host)
+            if link is not None and not link.closed:
+                return link
+            refused = self.legacy_hosts.get(host)
+            if refused is not None and time.time() - refused < LEGACY_RETRY_INTERVAL:
+                return None
+
+        try:
+            link = PeerLink(host)
+        except LegacyPeerError:
+            log.info("Peer %s does not accept LINK, using one connection per request", host)
+            with self.lock:
+                self.legacy_hosts[host] = time.time()
+            return None
+
+        with self.lock:
+            current = self.links.get(host)
+            if current is not None and not current.closed:
+                # Another thread connected first
+                link.close()
+                return current
+            self.legacy_hosts.pop(host, None)
+            self.links[host] = link
+        return link
+
+    def close(self, host):
+        """Closes the link to host, if there is one."""
+        with self.lock:
+            link = self.links.pop(host, None)
+        if link is not None:
+            link.close()
+
+    def close_all(self):
+        with self.lock:
+            links = list(self.links.values())
+            self.links = {}
+        for link in links:
+            link.close()
+
+    def _keep_alive(self):
+        """Keepalive thread loop."""
+        while True:
+            time.sleep(LINK_KEEPALIVE_INTERVAL / 2)
+            with self.lock:
+                links = list(self.links.items())
+            for host, link in links:
+                if not link.keepalive():
+                    with self.lock:
+                        if self.links.get(host) is link:
+                            del self.links[host]
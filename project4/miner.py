@@ -0,0 +1,175 @@
+"""Multi-process proof-of-work search for new blocks."""
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+from binascii import hexlify
+
+from blockchain_constants import *
+
+
+def search_nonces(suffix, start, count, hardness=PROOF_OF_WORK_HARDNESS):
+    """
+    Searches a range of nonces for one which satisfies the Proof-of-Work.
+
+    The block string is the nonce followed by a suffix which stays constant
+    for a single work unit (see objects.get_block_suffix), so only the nonce
+    region is rebuilt for every attempt. Nonces are encoded the same way the
+    original miner encoded them: the hexlified decimal string of an integer.
+
+    :param suffix: Encoded block string following the nonce
+    :param start: First integer nonce to try
+    :param count: Number of consecutive nonces to try
+    :param hardness: Number of leading hex 0s required in the hash
+
+    :type suffix: bytes
+    :type start: int
+    :type count: int
+    :type hardness: int
+
+    :return: The nonce string of a valid block, or None if none was found
+    """
+    zero_bytes = b'\x00' * (hardness // 2)
+    full = len(zero_bytes)
+    odd = hardness % 2 == 1
+    sha512 = hashlib.sha512
+
+    for n in range(start, start + count):
+        nonce = hexlify(str(n).encode())
+        digest = sha512(nonce + suffix).digest()
+        if digest[:full] == zero_bytes and (not odd or digest[full] < 0x10):
+            return nonce.decode()
+    return None
+
+
+def _mine_worker(jobs, results, current_job, hardness):
+    """
+    Worker process loop.
+
+    Takes (job_id, suffix) work units from jobs and searches random regions
+    of the nonce space until a valid nonce is found, the job is cancelled or a
+    newer job arrives. A None job shuts the worker down.
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        job_id, suffix = job
+        # Each worker picks its own random starting point so workers do not
+        # search overlapping nonces.
+        nonce = int.from_bytes(os.urandom(NONCE_BIT_LENGTH // 8), 'big')
+        while current_job.value == job_id and jobs.empty():
+            found = search_nonces(suffix, nonce, NONCE_BATCH_SIZE, hardness)
+            if found is not None:
+                results.put((job_id, found))
+                break
+            nonce += NONCE_BATCH_SIZE
+
+
+class MiningPool(object):
+
+    def __init__(self, workers=MINING_WORKERS, hardness=PROOF_OF_WORK_HARDNESS, on_result=None):
+        """
+        Starts a pool of worker processes which search for block nonces.
+
+        Work is handed out as the encoded block suffix of the block being
+        mined, which is computed once per work unit by the Blockchain. Every
+        worker receives the same work unit and searches a different random
+        part of the nonce space, so hash rate scales with the number of
+        workers rather than being limited by the GIL.
+
+        If on_result is given, a collector thread calls on_result(job_id, nonce)
+        as soon as a worker finds a nonce for the current job, so the caller
+        can block on its own condition variable instead of polling. Otherwise
+        results are collected with get_result().
+
+        :param workers: Number of worker processes to start
+        :param hardness: Number of leading hex 0s required in the hash
+        :param on_result: Callback for found nonces
+        """
+        self.workers = max(1, workers)
+        self.hardness = hardness
+
+        self._current_job = multiprocessing.Value('L', 0)
+        self._results = multiprocessing.Queue()
+        self._jobs = []
+        self._processes = []
+
+        for _ in range(self.workers):
+            jobs = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_mine_worker,
+                                              args=(jobs, self._results, self._current_job, hardness))
+            process.daemon = True
+            process.start()
+            self._jobs.append(jobs)
+            self._processes.append(process)
+
+        self._collector = None
+        if on_result is not None:
+            self._collector = threading.Thread(target=self._collect_results, args=(on_result,))
+            self._collector.daemon = True
+            self._collector.start()
+
+    def _collect_results(self, on_result):
+        """Collector thread loop. Forwards results for the current job to on_result."""
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            job_id, nonce = result
+            if job_id == self._current_job.value:
+                on_result(job_id, nonce)
+
+    def submit(self, suffix):
+        """
+        Hands a new work unit to every worker, superseding any previous one.
+
+        :param suffix: Block string following the nonce (see objects.get_block_suffix)
+        :type suffix: str
+        :return: Id of the new job, used to collect its result
+        """
+        with self._current_job.get_lock():
+            self._current_job.value += 1
+            job_id = self._current_job.value
+
+        encoded = suffix.encode()
+        for jobs in self._jobs:
+            jobs.put((job_id, encoded))
+        return job_id
+
+    def cancel(self):
+        """Stops the workers from searching for the current job."""
+        with self._current_job.get_lock():
+            self._current_job.value += 1
+
+    def get_result(self, job_id, timeout=None):
+        """
+        Waits for a worker to find a nonce for the given job.
+
+        Results reported for older jobs are discarded.
+
+        :param job_id: Job returned by submit()
+        :param timeout: Seconds to wait before giving up
+        :return: The nonce string, or None if no nonce was found in time
+        """
+        while True:
+            try:
+                result_job, nonce = self._results.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if result_job == job_id:
+                return nonce
+
+    def close(self):
+        """Shuts down all worker processes."""
+        self.cancel()
+        for jobs in self._jobs:
+            jobs.put(None)
+        for process in self._processes:
+            process.join(TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        if self._collector is not None:
+            self._results.put(None)
@@ -4,8 +4,16 @@ import time
 import random
 import logging
 import traceback, sys
+import io
+from concurrent.futures import ThreadPoolExecutor
 from socket import *
 from blockchain_constants import *
+from admission import ConnectionLimiter, RateLimiter
+from broadcaster import Broadcaster
+from inventory import Inventory, inventory_hash
+from link import ConnectionPool, FRAME_CONTROL, FrameWriter, KEEPALIVE_ID, RequestCancelled, pack_frame, read_frame
+from peers import PeerRegistry, PeerStats, Prober
+from sync import SyncManager, format_header
 
 class Server:
 
@@ -40,6 +48,10 @@ class Server:
         s.close()
 
         self.lock = threading.Lock()
+        self.pool = ConnectionPool()
+        self.peers = PeerRegistry()
+        self.prober = Prober()
+        self.discovery_lock = threading.Lock()
 
         self.peering_file = "peers.txt"
         self.read_peers()
@@ -50,7 +62,17 @@ class Server:
         self.accept_non_local_msgs = accept_non_local_msgs
 
         self.broadcast_queue = queue.Queue()
+        self.broadcaster = Broadcaster(on_failure=self.punish_peer, on_success=self.peers.record, pool=self.pool)
         self.blockchain = blockchain
+        self.inventory = Inventory(blockchain)
+        self.rate_limiter = RateLimiter()
+        self.connection_limiter = ConnectionLimiter()
+        self.link_executor = ThreadPoolExecutor(max_workers=LINK_HANDLER_THREADS)
+        self.sync = SyncManager(blockchain, self.pool, peers=self.peers)
+        self.orphan_fetcher = ThreadPoolExecutor(max_workers=ORPHAN_FETCH_THREADS)
+        self.fetching = set()  # Hashes of missing parent blocks being or waiting to be requested
+        self.fetching_lock = threading.Lock()
+        self.cleanup = 0
         self.log.warning("============ Server init complete ===========")
 
 
@@ -60,75 +82,79 @@ class Server:
         if host == MAIN_HOST and host == self.host:
             return True
 
-        with self.lock:
-            if len(self.peers) < MAX_PEERS and not self.is_peer(host):
-                self.peers.append((gethostbyname(host), 0))
-                #self.write_peers()
-                return True
+        if self.is_peer(host):
             return False
+        return self.peers.add(host)
 
     def punish_peer(self, host):
 
-        if host == MAIN_HOST:
+        # Peers are keyed by address, so host may be the address MAIN_HOST resolved to
+        if self.peers.same_host(host, MAIN_HOST):
             return
 
         self.log.info("Thread: %d - Warning: Punishing peer %s." %
                       (threading.get_ident() % 10000, host))
 
-        punished = False
-
-        new_peers = []
-        #print(self.peers)
-        with self.lock:
-            for i in range(len(self.peers)):
-                if (self.peers[i][0] == host):
-                    fails = self.peers[i][1] + 1
-                    punished = True
-                    if (fails <= MAX_PEER_FAILURE):
-                        new_peers.append((host, fails))
-                else:
-                    new_peers.append(self.peers[i])
-
-            self.peers = new_peers
+        # Saved with the next save_peers()
+        self.peers.punish(host)
 
-        if punished:
-            self.write_peers()
+    def read_peers(self):
 
+        self.log.info("Reading peers from %s." % self.peering_file)
+        self.peers.clear()
+        self.peers.add(MAIN_HOST)
+        with open(self.peering_file, 'r') as f:
+
+            for line in f.readlines():
+                line = line.strip()
+                if len(line) <= 0:
+                    break
+                fields = line.split()
+                stats = None
+                if len(fields) > 1:
+                    try:
+                        stats = PeerStats.parse(fields[1:])
+                    except ValueError:
+                        self.log.warning("Ignoring bad peer stats in %s: %s" % (self.peering_file, line))
+                # Host names are resolved in the background
+                self.peers.add(fields[0], stats)
 
-    def read_peers(self):
+    def write_peers(self):
+        """Writes every peer and its PeerStats to the peering file."""
 
         with self.lock:
-            self.log.info("Reading peers from %s." % self.peering_file)
-            self.peers = [(MAIN_HOST, 0)]
-            with open(self.peering_file, 'r') as f:
+            lines = self.peers.lines()
+            with open(self.peering_file, 'w') as f:
+                for line in lines:
+                    f.write(line + "\n")
+            self.log.info("Wrote %d peers to %s" % (len(lines), self.peering_file))
 
-                for line in f.readlines():
-                    line = line.strip()
-                    if len(line) <= 0:
-                        break
-                    host = line
-                    self.peers.append((gethostbyname(host), 0))
+    def save_peers(self):
+        """
+        Peer saving thread loop. Writes the peering file every
+        PEER_SAVE_INTERVAL if the peers changed, rather than on every change.
+        """
 
-        self.confirm_peers()
+        while True:
+            time.sleep(PEER_SAVE_INTERVAL)
+            if self.peers.dirty:
+                self.write_peers()
 
-    def write_peers(self):
+    def append_peer(self, host):
+        """Adds a new peer to the peering file without rewriting it."""
 
         with self.lock:
-            with open(self.peering_file, 'w') as f:
-                for peer in self.peers:
-                    f.write(peer[0] + "\n")
-            self.log.info("Wrote peers to %s: %s" % (self.peering_file, str(self.peers)))
+            with open(self.peering_file, 'a') as f:
+                f.write(host + "\n")
+            self.log.info("Appended peer %s to %s" % (host, self.peering_file))
 
     def is_peer(self, host):
 
         if host == '' or host == "localhost" or host == '127.0.0.1' or host == self.host:
             return True
 
-        for peer in self.peers:
-            if gethostbyname(host) == gethostbyname(peer[0]):
-                return True
-
-        return False
+        # Never blocks on DNS
+        return host in self.peers
 
     def run(self):
 
@@ -140,13 +166,50 @@ class Server:
             sock = socket(AF_INET,SOCK_STREAM)
             sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             sock.bind(addr)
-            sock.listen(1)
+            sock.listen(SERVER_BACKLOG)
             self.log.info("Started up on port %d" % addr[1])
         except:
             self.log.error("Unable to start on port %d" % addr[1])
             exit()
 
-        # self.request_peers()
+        self.start_background_threads()
+
+        # Main server loop
+        while True:
+            conn, cl_addr = sock.accept()
+
+            #print("received connection")
+
+            if not self.connection_limiter.acquire(cl_addr[0]):
+                self.log.debug("Thread: %d - From: %s - Warning: Denied, too many connections" %
+                               (threading.get_ident() % 10000, str(cl_addr)))
+                try:
+                    conn.sendall(b"ERROR Too many connections\n")
+                except OSError:
+                    pass
+                conn.close()
+                continue
+
+            # Handle connection on new thread
+            t = threading.Thread(target=self.handle_connection, args=(conn, cl_addr))
+            t.start()
+
+            self.maintain()
+
+    def start_background_threads(self):
+        """
+        Starts peer discovery, catches up with our peers, then starts the
+        broadcast and update threads.
+        """
+
+        t = threading.Thread(target=self.discover_peers)
+        t.daemon = True
+        t.start()
+
+        t = threading.Thread(target=self.save_peers)
+        t.daemon = True
+        t.start()
+
         self.get_updates(loop=False)
         # self.blockchain.mining_flag = CONTINUE_MINING
 
@@ -162,58 +225,59 @@ class Server:
         t = threading.Thread(target=self.get_updates)
         t.start()
 
-        # Main server loop
-        cleanup = 0
-        while True:
-            conn, cl_addr = sock.accept()
+    def maintain(self):
+        """
+        Called once per accepted connection. Every 10000 connections, looks
+        for new peers if we have too few.
+        """
 
-            #print("received connection")
+        if self.cleanup > 10000:
+            # Locate new peers
+            self.log.info("Cleaning up.")
+            if len(self.peers) < MIN_PEERS:
+                t = threading.Thread(target=self.request_peers)
+                t.start()
+            self.cleanup = 0
+        else:
+            self.cleanup += 1
 
-            # Handle connection on new thread
-            t = threading.Thread(target=self.handle_connection, args=(conn, cl_addr))
-            t.start()
 
-            # Maintaince
-            if cleanup > 10000:
-                # Locate new peers
-                self.log.info("Cleaning up.")
-                if len(self.peers) < MIN_PEERS:
-                    t = threading.Thread(target=self.request_peers)
-                    t.start()
-                cleanup = 0
-            else:
-                cleanup += 1
 
 
+    def discover_peers(self):
+        """
+        Confirms the peers read from the peering file, then asks them for
+        more peers if we have too few.
+        """
 
+        self.confirm_peers()
+        if len(self.peers) < MIN_PEERS:
+            self.request_peers()
 
     def confirm_peers(self):
+        """
+        Sends PEER_REQUEST to all peers at once and drops those which do not
+        accept within PEER_PROBE_DEADLINE.
+        """
+
+        hosts = self.peers.hosts()
+        results, failed = self.prober.map(self.confirm_peer, hosts)
+        bad_peers = failed + [host for host, good in results.items() if not good]
+
+        for host in bad_peers:
+            self.peers.remove(host)
+        if len(bad_peers) > 0:
+            self.write_peers()
 
-        good_peers = []
-        for peer in self.peers:
-            if self.confirm_peer(peer[0]):
-                good_peers.append(peer[0])
-
-        with self.lock:
-            self.peers = []
-
-        for peer in good_peers:
-            self.add_peer(peer)
-
-        self.write_peers()
+        self.log.warning("Thread: %d - Confirmed %d of %d peers" %
+                         (threading.get_ident() % 10000, len(hosts) - len(bad_peers), len(hosts)))
 
     def confirm_peer(self, host):
 
         good = True
-        sock = socket(AF_INET, SOCK_STREAM)
         try:
-            sock = create_connection((host, DEFAULT_PORT),TIMEOUT)
-            f_in = sock.makefile('r')
-            f_out = sock.makefile('w')
-            f_out.write("PEER_REQUEST\n")
-            f_out.flush()
-            time.sleep(WAIT_TIME)
-            ack = f_in.readline().strip()
+            with self.pool.request(host, "PEER_REQUEST\n") as f_in:
+                ack = f_in.readline().strip()
             if ack != "ACK":
                 good = False
                 self.log.warning("Thread: %d - Peer request denied. %s" %
@@ -221,100 +285,98 @@ class Server:
             else:
                 self.log.info("Thread: %d - Peer request accepted. %s" %
                               (threading.get_ident() % 10000, host))
-            sock.close()
         except:
             good = False
             self.log.info("Thread: %d - Peer request failed. %s" %
                           (threading.get_ident() % 10000, host))
-            try:
-                sock.close()
-            except:
-                pass
 
         return good
 
 
 
     def request_peers(self):
+        """
+        Asks every peer for its peers, then confirms the new ones, all with
+        at most PEER_PROBE_WORKERS requests in flight. Each confirmed peer is
+        appended to the peering file as soon as it accepts.
+        """
+
+        if not self.discovery_lock.acquire(blocking=False):
+            # Already looking for peers
+            return
 
-        self.log.info("Thread: %d - Start requesting peers. %d peers currently" %
-                      (threading.get_ident() % 10000, len(self.peers) + 1))
+        try:
+            self.log.info("Thread: %d - Start requesting peers. %d peers currently" %
+                          (threading.get_ident() % 10000, len(self.peers) + 1))
 
-        bad_peers = []
-        new_peers = []
-        for peer in self.peers:
-            sock = socket(AF_INET, SOCK_STREAM)
-            try:
-                sock = create_connection((peer[0], DEFAULT_PORT),TIMEOUT)
-                f_in = sock.makefile('r')
-                f_out = sock.makefile('w')
-                f_out.write("PEERS_REQUEST\n")
-                f_out.flush()
-                time.sleep(WAIT_TIME)
-                num = int(f_in.readline().strip())
-                for i in range(num):
-                    tokens = f_in.readline().strip().split(":")
-                    host = tokens[0]
-                    port = int(tokens[1])
-                    new_peers.append(host)
-                sock.close()
-
-            except:
-                bad_peers.append(peer)
-                try:
-                    sock.close()
-                except:
-                    pass
+            results, bad_peers = self.prober.map(self.get_peer_list, self.peers.ranked())
+            for peer in bad_peers:
+                self.punish_peer(peer)
 
-        for peer in bad_peers:
-            self.punish_peer(peer[0])
+            new_peers = list({host for hosts in results.values() for host in hosts if not self.is_peer(host)})
+            random.shuffle(new_peers)
+            new_peers = new_peers[:max(0, MAX_PEERS - len(self.peers))]
+            self.prober.map(self.confirm_peer, new_peers, on_result=self._peer_confirmed)
 
-        random.shuffle(new_peers)
-        for new_peer in new_peers:
-            if not self.is_peer(new_peer) and len(self.peers) <= MAX_PEERS:
-                if self.confirm_peer(new_peer):
-                    self.add_peer(new_peer)
+            self.log.warning("Thread: %d - Complete requesting peers. %d peers currently" %
+                             (threading.get_ident() % 10000, len(self.peers) + 1))
+        finally:
+            self.discovery_lock.release()
 
-        self.write_peers()
+    def get_peer_list(self, host):
+        """
+        :return: List of the peers of host
+        """
+
+        new_peers = []
+        with self.pool.request(host, "PEERS_REQUEST\n") as f_in:
+            num = int(f_in.readline().strip())
+            for i in range(num):
+                tokens = f_in.readline().strip().split(":")
+                new_peers.append(tokens[0])
+        return new_peers
 
-        self.log.warning("Thread: %d - Complete requesting peers. %d peers currently" %
-                         (threading.get_ident() % 10000, len(self.peers) + 1))
+    def _peer_confirmed(self, host, good):
+        """Prober callback. Adds and persists a new peer which accepted PEER_REQUEST."""
+
+        if good and self.add_peer(host):
+            self.append_peer(host)
 
     def get_updates(self, loop=True):
+        """
+        Downloads new blocks from all peers, then again every minute if loop is True.
+
+        Blocks are synced headers-first by the SyncManager, so every block is
+        downloaded from only one peer. Peers which do not know HEADERS_REQUEST
+        are updated from one after another with request_updates(). Peers
+        backing off after failures are skipped, and the best ranked peers
+        are preferred.
+        """
         while True:
             self.log.warning("Thread: %d - Started updating from peers" %
                              (threading.get_ident() % 10000))
 
-            bad_peers = []
-            for peer in self.peers:
-                self.log.debug("Updating from peer %s", peer)
-                sock = socket(AF_INET, SOCK_STREAM)
+            hosts = self.peers.ranked()
+            since = self.blockchain.last_update
+            started = time.time()
+            count, failed, legacy = self.sync.sync(hosts, since)
+            self.log.info("Thread: %d - Received %d blocks from %d peers." %
+                          (threading.get_ident() % 10000, count, len(hosts) - len(failed) - len(legacy)))
+            if loop and len(failed) < len(hosts):
+                self.blockchain.last_update = started
+
+            bad_peers = list(failed)
+            for host in legacy:
+                self.log.debug("Updating from legacy peer %s", host)
                 try:
-                    sock = create_connection((peer[0], DEFAULT_PORT), TIMEOUT)
-                    f_in = sock.makefile('r')
-                    f_out = sock.makefile('w')
-                    f_out.write("UPDATE_REQUEST\n")
-                    f_out.flush()
-
-                    # MODIFICATION: Per Nexus instructions
-                    f_out.write("%f\n" % self.blockchain.last_update) #(self.blockchain.latest_time - UPDATE_PAD))
-                    # f_out.write("%f\n" % 0) #(self.blockchain.latest_time - UPDATE_PAD))
-                    f_out.flush()
-                    time.sleep(WAIT_TIME)
-                    count = int(f_in.readline().strip())
-                    for i in range(count):
-                        self.blockchain.add_block_str(f_in.readline().strip())
-                    sock.close()
+                    start = time.time()
+                    count = self.request_updates(host, since)
+                    self.peers.record(host, time.time() - start, count)
+                    self.peers.credit(host, count)
                     self.log.info("Thread: %d - Received %d blocks from %s." %
-                                     (threading.get_ident() % 10000, count, peer[0]))
-                    if loop:
-                        self.blockchain.last_update = time.time()
+                                     (threading.get_ident() % 10000, count, host))
                 except:
-                    bad_peers.append(peer[0])
-                    try:
-                        sock.close()
-                    except:
-                        pass
+                    bad_peers.append(host)
 
             for peer in bad_peers:
                 self.punish_peer(peer)
@@ -327,65 +389,305 @@ class Server:
             time.sleep(60)
 
 
+    def request_updates(self, host, since=None):
+        """
+        Downloads and adds every block newer than since from host.
+
+        Uses UPDATE_STREAM, which sends blocks in frames of a count line
+        followed by that many block strings, ending with a 0 count. A reader
+        thread receives and splits frames while this thread adds the blocks of
+        earlier frames. At most UPDATE_PIPELINE_DEPTH frames are buffered here,
+        and a peer link queues at most LINK_RESPONSE_WINDOW more, so a long
+        chain is synced in bounded memory. Peers which do not know
+        UPDATE_STREAM are asked with UPDATE_REQUEST instead.
+
+        :param since: Time to download blocks after. Defaults to blockchain.last_update.
+        :return: Number of blocks received
+        """
+        if since is None:
+            since = self.blockchain.last_update
+        f_in = self.pool.request(host, "UPDATE_STREAM\n%f\n" % since)
+        try:
+            header = f_in.readline().strip()
+
+            if header.startswith("ERROR Command not recognized"):
+                f_in.close()
+                return self.request_updates_legacy(host, since)
+
+            batches = queue.Queue(UPDATE_PIPELINE_DEPTH)
+            reader = threading.Thread(target=self._read_update_stream, args=(f_in, header, batches))
+            reader.daemon = True
+            reader.start()
+
+            count = 0
+            try:
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+                    for block_str in batch:
+                        self.blockchain.add_block_str(block_str)
+                    count += len(batch)
+            finally:
+                # Unblock the reader if we stopped early
+                f_in.close()
+                while reader.is_alive():
+                    try:
+                        batches.get(timeout=WAIT_TIME)
+                    except queue.Empty:
+                        pass
+            return count
+        finally:
+            f_in.close()
+
+    def _read_update_stream(self, f_in, first_line, batches):
+        """Reader thread for request_updates(). Puts each frame on batches, then None or the exception raised."""
+        try:
+            count = int(first_line)
+            while count > 0:
+                batches.put([f_in.readline().strip() for _ in range(count)])
+                count = int(f_in.readline().strip())
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def request_updates_legacy(self, host, since):
+        """
+        Downloads and adds blocks from host with the one-shot UPDATE_REQUEST.
+
+        :return: Number of blocks received
+        """
+        # MODIFICATION: Per Nexus instructions
+        request = "UPDATE_REQUEST\n%f\n" % since #(self.blockchain.latest_time - UPDATE_PAD))
+        # request = "UPDATE_REQUEST\n%f\n" % 0 #(self.blockchain.latest_time - UPDATE_PAD))
+        with self.pool.request(host, request) as f_in:
+            count = int(f_in.readline().strip())
+            for i in range(count):
+                self.blockchain.add_block_str(f_in.readline().strip())
+            return count
+
+    def request_orphan_parent(self, host, block_hash):
+        """
+        Queues a fetch of the missing parent of block_hash from host, if it is an orphan.
+
+        Fetches run on ORPHAN_FETCH_THREADS threads. A parent already being
+        fetched is not queued again, and once ORPHAN_FETCH_QUEUE are queued
+        further missing parents are left to get_updates().
+
+        :param host: The peer which sent the block
+        :param block_hash: inventory_hash() of the block string
+        """
+        parent_hash = self.blockchain.get_orphan_parent(block_hash)
+        if parent_hash is not None and self._start_fetch(parent_hash):
+            self.orphan_fetcher.submit(self.fetch_orphan_parents, host, parent_hash)
+
+    def _start_fetch(self, block_hash):
+        """
+        Adds block_hash to self.fetching, unless it is already there or full.
+
+        :return: Whether the caller should fetch the block
+        """
+        with self.fetching_lock:
+            if block_hash in self.fetching or len(self.fetching) >= ORPHAN_FETCH_QUEUE:
+                return False
+            self.fetching.add(block_hash)
+            return True
+
+    def fetch_orphan_parents(self, host, parent_hash):
+        """
+        Requests the missing parent of an orphan block with BLOCK_REQUEST.
+
+        If the parent turns out to be an orphan too, its parent is requested
+        next, up to ORPHAN_FETCH_DEPTH blocks back. Anything further is left
+        to get_updates(). Once a fetched block connects, the Blockchain adds
+        the orphans waiting on it. A reply which is not the requested block
+        is dropped.
+
+        :param parent_hash: Hash of the missing block, already added to self.fetching
+        """
+        for _ in range(ORPHAN_FETCH_DEPTH):
+            try:
+                with self.pool.request(host, "BLOCK_REQUEST\n%s\n" % parent_hash) as f_in:
+                    block_str = f_in.readline().strip()
+            except OSError:
+                self.log.info("Thread: %d - Failed to request block %s from %s" %
+                              (threading.get_ident() % 10000, parent_hash[:5], host))
+                return
+            finally:
+                with self.fetching_lock:
+                    self.fetching.discard(parent_hash)
+
+            if block_str == '' or block_str.startswith("ERROR"):
+                self.log.debug("Thread: %d - Peer %s does not have block %s" %
+                               (threading.get_ident() % 10000, host, parent_hash[:5]))
+                return
+
+            block_hash = inventory_hash(BLOCK_TYPE, block_str)
+            if block_hash != parent_hash:
+                self.log.debug("Thread: %d - Peer %s sent block %s when asked for %s" %
+                               (threading.get_ident() % 10000, host, block_hash[:5], parent_hash[:5]))
+                return
+
+            added = self.blockchain.add_block_str(block_str)
+            self.mark_blocks_seen([block_hash])
+            if added:
+                self.log.info("Thread: %d - Fetched missing block %s from %s" %
+                              (threading.get_ident() % 10000, parent_hash[:5], host))
+                return
+            parent_hash = self.blockchain.get_orphan_parent(block_hash)
+            if parent_hash is None or not self._start_fetch(parent_hash):
+                return
+
+    def mark_blocks_seen(self, block_hashes):
+        """
+        Marks received blocks as seen in the inventory once they are in the
+        tree or known to be invalid. Orphans are left out, so one evicted
+        from the orphan pool is fetched again when a peer announces it.
+        """
+
+        for block_hash in block_hashes:
+            if self.blockchain.is_known_block(block_hash):
+                self.inventory.mark_seen(block_hash)
+
+    def mark_messages_seen(self, digests):
+        """
+        Marks received messages as seen in the inventory once they are
+        queued, in the main chain or known to be invalid. A message refused
+        only because the message queue was full is left out, so it is
+        fetched again when a peer announces it.
+        """
+
+        for digest in digests:
+            if self.blockchain.is_known_message(digest):
+                self.inventory.mark_seen(digest)
+
     def broadcast(self):
+        """
+        Broadcast thread loop. Hands our mined blocks and the items on
+        broadcast_queue to the Broadcaster, which sends them to all peers in
+        parallel.
+        """
 
         while True:
-            bad_peers = []
-
             # Broadcast our own mined blocks first
             item = self.blockchain.get_new_block_str()
             item_type = BLOCK_TYPE
             if (item == None):
                 # Broadcast peers messages otherwise
                 try:
-                    (item_type, item) = self.broadcast_queue.get_nowait()
-                except:
-                    # Wait if nothing to broadcast
-                    time.sleep(WAIT_TIME)
+                    (item_type, item) = self.broadcast_queue.get(timeout=WAIT_TIME)
+                except queue.Empty:
                     continue
+            else:
+                # So we do not ask for our own block when peers announce it back
+                self.inventory.add(BLOCK_TYPE, item)
 
             self.log.info("Broadcasting %s to peers." % ("message" if item_type == MESSAGE_TYPE else "block"))
 
-            for peer in self.peers:
-                sock = socket(AF_INET, SOCK_STREAM)
-                try:
-                    sock = create_connection((peer[0], DEFAULT_PORT),TIMEOUT)
-                    f_out = sock.makefile('w')
-                    if item_type == MESSAGE_TYPE:
-                        f_out.write("MESSAGE_BROADCAST\n")
-                    else:
-                        f_out.write("BLOCK_BROADCAST\n")
-                    f_out.flush()
-                    f_out.write(item + "\n")
-                    f_out.flush()
-                    time.sleep(WAIT_TIME)
-                    sock.close()
-                except:
-                    self.log.warning("Peer failed to receive broadcasting")
-
-                    bad_peers.append(peer)
-                    try:
-                        sock.close()
-                    except:
-                        pass
+            # Peers backing off still get the item, their senders retry on their own
+            self.broadcaster.broadcast(self.peers.ranked(backing_off=True), item_type, item)
 
-            for peer in bad_peers:
-                self.punish_peer(peer[0])
 
-            self.log.info("Broadcasting complete.")
+    def handle_connection(self, conn, cl_addr):
 
+        try:
+            rfile = conn.makefile('rb')
+            command = rfile.readline().decode().strip()
+            if command == "LINK":
+                self.serve_link(conn, rfile, cl_addr)
+            else:
+                f_in = io.TextIOWrapper(rfile)
+                f_out = conn.makefile('w')
+                self.handle_request(f_in, f_out, cl_addr, command)
+        except:
+            self.log.error("Thread: %d - From: %s - Exception in handling connection\n%s" %
+                           (threading.get_ident() % 10000, str(cl_addr), traceback.format_exc()))
+        finally:
+            self.connection_limiter.release(cl_addr[0])
 
-    def handle_connection(self, conn, cl_addr):
+        conn.close()
 
+    def serve_link(self, conn, rfile, cl_addr):
+        """
+        Serves a peer link (see link.py) until the peer closes it.
+
+        Request frames are handled concurrently on the link_executor threads,
+        so a slow request does not hold up the others on the link. At most
+        LINK_MAX_IN_FLIGHT requests of a link are handled at once. Frames are
+        not read while the link is at that limit. Credit and cancel frames
+        are passed to the FrameWriter of their request.
+        """
+        send_lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(LINK_MAX_IN_FLIGHT)
+        writers = {}  # request id -> FrameWriter of requests being handled
+
+        def finished(request_id):
+            writers.pop(request_id, None)
+            in_flight.release()
+
+        def send_frame(request_id, flags, payload):
+            with send_lock:
+                conn.sendall(pack_frame(request_id, flags, payload))
+
+        conn.settimeout(LINK_IDLE_TIMEOUT)
+        # Frames are small and sent as soon as they are ready
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        conn.sendall(b"ACK\n")
+        self.log.debug("Thread: %d - From: %s - Opened link" %
+                       (threading.get_ident() % 10000, str(cl_addr)))
+        try:
+            while True:
+                frame = read_frame(rfile)
+                if frame is None:
+                    break
+                request_id, flags, payload = frame
+                if request_id == KEEPALIVE_ID:
+                    send_frame(KEEPALIVE_ID, 0, b'')
+                    continue
+                if flags & FRAME_CONTROL:
+                    writer = writers.get(request_id)
+                    if writer is not None:
+                        writer.control(flags, payload)
+                    continue
+                in_flight.acquire()
+                writers[request_id] = writer = FrameWriter(send_frame, request_id)
+                handler = self.link_executor.submit(self.handle_frame, payload, writer, cl_addr)
+                handler.add_done_callback(lambda _, request_id=request_id: finished(request_id))
+        except (OSError, ValueError) as e:
+            self.log.debug("Thread: %d - From: %s - Link closed: %s" %
+                           (threading.get_ident() % 10000, str(cl_addr), e))
+        finally:
+            for writer in list(writers.values()):
+                writer.cancel()
+
+    def handle_frame(self, payload, f_out, cl_addr):
+        """Handles a request received over a peer link and sends the final response frame."""
+        self.handle_request(io.StringIO(payload.decode()), f_out, cl_addr)
         try:
-            f_in = conn.makefile('r')
-            f_out = conn.makefile('w')
+            f_out.close()
+        except OSError:
+            # The link closed while handling the request
+            pass
 
-            command = f_in.readline().strip()
-            #print("command:", command)
+    def handle_request(self, f_in, f_out, cl_addr, command=None):
+        """
+        Reads one command from f_in and writes the response to f_out.
+
+        f_in and f_out only need readline() and write()/flush(), so the same
+        protocol handling serves plain sockets (handle_connection), peer links
+        and the asyncio server in async_network.py.
+
+        :param command: The command, if it was already read from f_in
+        """
+        cl_host = cl_addr[0]
+        cl_port = int(cl_addr[1])
 
-            cl_host = cl_addr[0]
-            cl_port = int(cl_addr[1])
+        try:
+            if command is None:
+                command = f_in.readline().strip()
+            #print("command:", command)
 
 
             self.log.info("Thread: %d - Command: %s - From: %s:%d" %
@@ -409,7 +711,7 @@ class Server:
                     f_out.write("ERROR Denied, too many active peers\n")
                     f_out.flush()
                 else:
-                    self.write_peers()
+                    self.append_peer(cl_host)
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Accepted peer." %
                                   (threading.get_ident() % 10000, command, cl_host, cl_port))
                     f_out.write("ACK\n")
@@ -419,39 +721,153 @@ class Server:
             elif command == "MESSAGE_BROADCAST":
                 ## Add to queue and send to other peers
                 msg_str = f_in.readline().strip()
-                if not self.accept_non_local_msgs and (cl_host == '' or cl_host == 'localhost' or cl_host == '127.0.0.1'):
-                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Message ignored" %
-                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
-                    self.broadcast_queue.put((MESSAGE_TYPE, msg_str))
-                    f_out.write("ACK\n")
+                if not self.rate_limiter.allow(cl_host):
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Rate limit exceeded" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    f_out.write("FAILURE - Rate limit exceeded, try again later.\n")
                     f_out.flush()
+                else:
+                    digest = inventory_hash(MESSAGE_TYPE, msg_str)
+                    if not self.accept_non_local_msgs and (cl_host == '' or cl_host == 'localhost' or cl_host == '127.0.0.1'):
+                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Message ignored" %
+                                      (threading.get_ident() % 10000, command, cl_host, cl_port))
+                        self.inventory.mark_seen(digest)
+                        self.broadcast_queue.put((MESSAGE_TYPE, msg_str))
+                        f_out.write("ACK\n")
+                        f_out.flush()
 
-                elif self.blockchain.get_message_queue_size() >= MSG_BUFFER_SIZE:
-                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
-                                     (threading.get_ident() % 10000, command, cl_host, cl_port))
-                    f_out.write("FAILURE - Message buffer full, try again later.\n")
-                    f_out.flush()
+                    elif self.blockchain.is_known_message(digest):
+                        # Checked before parsing or verifying the message
+                        self.inventory.mark_seen(digest)
+                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
+                                      (threading.get_ident() % 10000, command, cl_host, cl_port))
+                        f_out.write("FAILURE - Invalid or duplicate\n")
+                        f_out.flush()
 
-                elif self.blockchain.add_message_str(msg_str):
-                    # Only broadcast if valid and not seen
-                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received new message to process and broadcast" %
-                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
-                    self.broadcast_queue.put((MESSAGE_TYPE, msg_str))
-                    f_out.write("ACK\n")
-                    f_out.flush()
+                    elif self.blockchain.is_message_queue_full():
+                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
+                                         (threading.get_ident() % 10000, command, cl_host, cl_port))
+                        f_out.write("FAILURE - Message buffer full, try again later.\n")
+                        f_out.flush()
 
+                    elif self.blockchain.add_message_str(msg_str):
+                        # Only broadcast if valid and not seen
+                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received new message to process and broadcast" %
+                                      (threading.get_ident() % 10000, command, cl_host, cl_port))
+                        self.inventory.mark_seen(digest)
+                        self.broadcast_queue.put((MESSAGE_TYPE, msg_str))
+                        f_out.write("ACK\n")
+                        f_out.flush()
+
+                    else:
+                        self.mark_messages_seen([digest])
+                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
+                                      (threading.get_ident() % 10000, command, cl_host, cl_port))
+                        f_out.write("FAILURE - Invalid or duplicate\n")
+                        f_out.flush()
+
+
+            elif command == "MESSAGES_BROADCAST":
+                ## Batch of messages: a count line, then one message per line.
+                ## Replies with one result line per message.
+                count = int(f_in.readline().strip())
+                if count > MSG_BUFFER_SIZE:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Batch of %d messages too large" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, count))
+                    f_out.write("ERROR Too many messages\n")
+                    f_out.flush()
                 else:
-                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
-                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
-                    f_out.write("FAILURE - Invalid or duplicate\n")
+                    msg_strs = [f_in.readline().strip() for _ in range(count)]
+                    # Messages past the peer's rate limit are turned away unread
+                    allowed = self.rate_limiter.take(cl_host, count)
+                    digests = [inventory_hash(MESSAGE_TYPE, msg_str) for msg_str in msg_strs[:allowed]]
+                    if not self.accept_non_local_msgs and (cl_host == '' or cl_host == 'localhost' or cl_host == '127.0.0.1'):
+                        results = [None] * allowed
+                        for digest in digests:
+                            self.inventory.mark_seen(digest)
+                    elif self.blockchain.is_message_queue_full():
+                        results = [False] * allowed
+                    else:
+                        # Duplicates and known invalid messages are not parsed
+                        results = [False if self.blockchain.is_known_message(digest) else None for digest in digests]
+                        new_msg_strs = [msg_str for msg_str, result in zip(msg_strs, results) if result is None]
+                        added = iter(self.blockchain.add_message_strs(new_msg_strs))
+                        results = [next(added) if result is None else result for result in results]
+                        self.mark_messages_seen(digests)
+
+                    for msg_str, result in zip(msg_strs, results):
+                        if result is False:
+                            f_out.write("FAILURE - Invalid or duplicate\n")
+                        else:
+                            # Only broadcast if valid and not seen (or ignored local messages)
+                            self.broadcast_queue.put((MESSAGE_TYPE, msg_str))
+                            f_out.write("ACK\n")
+                    f_out.write("FAILURE - Rate limit exceeded, try again later.\n" * (count - allowed))
                     f_out.flush()
-
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received %d new messages of %d, %d over rate limit" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port,
+                                    results.count(True), count, count - allowed))
+
+            elif command == "INV":
+                ## Announcement of blocks and messages: a count line, then one
+                ## "<type> <hash>" line per item. Replies in the same format
+                ## with the items we want sent.
+                count = int(f_in.readline().strip())
+                if count > BROADCAST_BATCH_SIZE:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Inventory of %d items too large" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, count))
+                    f_out.write("ERROR Too many items\n")
+                    f_out.flush()
+                else:
+                    wanted = []
+                    for _ in range(count):
+                        item_type, item_hash = f_in.readline().split()
+                        if self.inventory.want(int(item_type), item_hash):
+                            wanted.append("%s %s\n" % (item_type, item_hash))
+                    f_out.write("%d\n" % len(wanted) + "".join(wanted))
+                    f_out.flush()
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Wanted %d of %d announced items" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, len(wanted), count))
+
+            elif command == "BLOCKS_BROADCAST":
+                ## Batch of blocks: a count line, then one block per line.
+                ## Replies with one result line per block.
+                count = int(f_in.readline().strip())
+                if count > BROADCAST_BATCH_SIZE:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Batch of %d blocks too large" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, count))
+                    f_out.write("ERROR Too many blocks\n")
+                    f_out.flush()
+                else:
+                    added = 0
+                    for _ in range(count):
+                        block_str = f_in.readline().strip()
+                        block_hash = inventory_hash(BLOCK_TYPE, block_str)
+                        if not self.accept_blocks:
+                            self.inventory.mark_seen(block_hash)
+                            self.broadcast_queue.put((BLOCK_TYPE, block_str))
+                            f_out.write("ACK\n")
+                        elif self.blockchain.add_block_str(block_str):
+                            # Only broadcast if valid and not seen
+                            self.inventory.mark_seen(block_hash)
+                            self.broadcast_queue.put((BLOCK_TYPE, block_str))
+                            f_out.write("ACK\n")
+                            added += 1
+                        else:
+                            self.mark_blocks_seen([block_hash])
+                            self.request_orphan_parent(cl_host, block_hash)
+                            f_out.write("FAILURE - Invalid or duplicate.\n")
+                    f_out.flush()
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received %d new blocks of %d" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, added, count))
 
             elif command == "BLOCK_BROADCAST":
                 block_str = f_in.readline().strip()
+                block_hash = inventory_hash(BLOCK_TYPE, block_str)
                 if not self.accept_blocks:
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Ignored block broadcast" %
                                   (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    self.inventory.mark_seen(block_hash)
                     self.broadcast_queue.put((BLOCK_TYPE, block_str))
                     f_out.write("ACK\n")
                     f_out.flush()
@@ -459,24 +875,77 @@ class Server:
                     # Only broadcast if valid and not seen
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received new block to process and broadcast" %
                                   (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    self.inventory.mark_seen(block_hash)
                     self.broadcast_queue.put((BLOCK_TYPE, block_str))
                     f_out.write("ACK\n")
                     f_out.flush()
                 else:
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Received duplicate or invalid message, ignoring" %
                                   (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    self.mark_blocks_seen([block_hash])
+                    self.request_orphan_parent(cl_host, block_hash)
                     f_out.write("FAILURE - Invalid or duplicate.\n")
                     f_out.flush()
 
+            elif command == "BLOCK_REQUEST":
+                block_hash = f_in.readline().strip()
+                block_str = self.blockchain.get_block_str(block_hash)
+                if block_str is None:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Block %s not found" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, block_hash[:5]))
+                    f_out.write("ERROR Block not found\n")
+                else:
+                    f_out.write(block_str + "\n")
+                f_out.flush()
+
+            elif command == "BLOCKS_REQUEST":
+                ## Batch of block hashes: a count line, then one hash per line.
+                ## Replies with one line per hash, the block string or an error.
+                count = int(f_in.readline().strip())
+                if count > SYNC_BATCH_SIZE:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Request for %d blocks too large" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, count))
+                    f_out.write("ERROR Too many blocks\n")
+                else:
+                    found = 0
+                    for _ in range(count):
+                        block_str = self.blockchain.get_block_str(f_in.readline().strip())
+                        if block_str is None:
+                            f_out.write("ERROR Block not found\n")
+                        else:
+                            f_out.write(block_str + "\n")
+                            found += 1
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Sent %d blocks of %d" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, found, count))
+                f_out.flush()
+
+            elif command == "HEADERS_REQUEST":
+                try:
+                    t = float(f_in.readline().strip())
+                except ValueError:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Recieved invalid HEADERS_REQUEST" %
+                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    f_out.write("ERROR Time not recognized\n")
+                    f_out.flush()
+                else:
+                    headers = self.blockchain.get_headers(t)
+                    f_out.write("%d\n" % len(headers))
+                    for i in range(0, len(headers), UPDATE_BATCH_SIZE):
+                        f_out.write("".join(format_header(*header) for header in headers[i:i + UPDATE_BATCH_SIZE]))
+                        f_out.flush()
+                    f_out.flush()
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Sent %d block headers to update peer" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, len(headers)))
+
             elif command == "UPDATE_REQUEST":
                 try:
                     t = float(f_in.readline().strip())
                     block_strs = self.blockchain.get_all_block_strs(t)
                     f_out.write("%d\n" % len(block_strs))
-                    f_out.flush()
-                    for block_str in block_strs:
-                        f_out.write(block_str + "\n")
+                    for i in range(0, len(block_strs), UPDATE_BATCH_SIZE):
+                        f_out.write("".join(block_str + "\n" for block_str in block_strs[i:i + UPDATE_BATCH_SIZE]))
                         f_out.flush()
+                    f_out.flush()
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Sent %d blocks to update peer" %
                                      (threading.get_ident() % 10000, command, cl_host, cl_port, len(block_strs)))
                 except:
@@ -485,6 +954,26 @@ class Server:
                     f_out.write("ERROR Time not recognized")
                     f_out.flush()
 
+            elif command == "UPDATE_STREAM":
+                try:
+                    t = float(f_in.readline().strip())
+                except ValueError:
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning: Recieved invalid UPDATE_STREAM" %
+                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
+                    f_out.write("ERROR Time not recognized\n")
+                    f_out.flush()
+                else:
+                    # One frame and one flush per batch of blocks, then an empty frame
+                    count = 0
+                    for block_strs in self.blockchain.iter_block_strs(t):
+                        f_out.write("%d\n" % len(block_strs) + "".join(block_str + "\n" for block_str in block_strs))
+                        f_out.flush()
+                        count += len(block_strs)
+                    f_out.write("0\n")
+                    f_out.flush()
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Streamed %d blocks to update peer" %
+                                   (threading.get_ident() % 10000, command, cl_host, cl_port, count))
+
             elif command == "PEERS_REQUEST":
                 if not self.do_peering:
                     self.log.debug("Thread: %d - Command: %s - From: %s:%d - Ignored peers request." %
@@ -493,22 +982,22 @@ class Server:
                     f_out.flush()
                 else:
 
-                    with self.lock:
-                        f_out.write(str(len(self.peers)) + "\n")
-                        f_out.flush()
-                        for peer in self.peers:
-                            f_out.write(peer[0] + ":" + str(peer[1]) + "\n")
-                            f_out.flush()
-                        self.log.debug("Thread: %d - Command: %s - From: %s:%d - Sent %d peers to peer" %
-                                      (threading.get_ident() % 10000, command, cl_host, cl_port, len(self.peers)))
+                    peers = self.peers.items()
+                    f_out.write(str(len(peers)) + "\n")
+                    for host, fails in peers:
+                        f_out.write(host + ":" + str(fails) + "\n")
+                    f_out.flush()
+                    self.log.debug("Thread: %d - Command: %s - From: %s:%d - Sent %d peers to peer" %
+                                  (threading.get_ident() % 10000, command, cl_host, cl_port, len(peers)))
             else:
                 self.log.debug("Thread: %d - Command: %s - From: %s:%d - Warning Invalid request from peer" %
                                  (threading.get_ident() % 10000, command, cl_host, cl_port))
                 f_out.write("ERROR Command not recognized\n")
                 f_out.flush()
 
+        except RequestCancelled as e:
+            self.log.debug("Thread: %d - Command: %s - From: %s:%d - %s" %
+                           (threading.get_ident() % 10000, command, cl_host, cl_port, e))
         except:
             self.log.error("Thread: %d - Command: %s - From: %s:%d - Exception in handling request\n%s" %
                            (threading.get_ident() % 10000, command, cl_host, cl_port, traceback.format_exc()))
-
-        conn.close()
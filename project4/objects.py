@@ -7,15 +7,19 @@ from binascii import hexlify, unhexlify
 
 import time
 from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 
 from blockchain_constants import *
-from key import Keys
+from cache import LRUCache
+from key import Keys, load_public_key
 
 log = logging.getLogger('blockchain')
 
+# Result of every signature check keyed by Message.digest. The digest covers
+# the signature, so a replayed or duplicate message costs no RSA work.
+signature_cache = LRUCache(SIGNATURE_CACHE_SIZE)
+
 
 class Message(object):
     """Represents a message on the chain."""
@@ -52,6 +56,7 @@ class Message(object):
         self.message = message
         self.signature = signature
         self.recipient = recipient
+        self._digest = None
 
     def __str__(self):
         ret_str = "Sender Key: {sender}\n" + \
@@ -66,8 +71,9 @@ class Message(object):
         return ret_str
 
     def __repr__(self):
+        msg = self.message.encode() if self.recipient is None else self.message
         body_str = "{time}:{text}".format(time=self.create_time,
-                                          text=hexlify(self.message.encode()).decode()
+                                          text=hexlify(msg).decode()
                                           )
         if self.recipient:
             body_str += ":{rcp}".format(rcp=hexlify(self.recipient.encode()).decode())
@@ -77,6 +83,20 @@ class Message(object):
                                             sig=hexlify(self.signature).decode()
                                             )
 
+    @property
+    def digest(self):
+        """
+        SHA-256 hex digest of the message string, used to index messages.
+
+        Computed on first use and cached since a Message is not modified after
+        it is created.
+
+        :rtype: str
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha256(repr(self).encode()).hexdigest()
+        return self._digest
+
     def get_signature_string(self):
         """
         Gets the unsigned string representation of the body of the message.
@@ -103,18 +123,28 @@ class Message(object):
         is valid, indicating that the message itself is both unaltered and was
         sent by the specified sender given in the message string.
 
+        Results are cached by message digest, and the sender's public key is
+        parsed once through the shared key cache.
+
         :rtype: bool
         """
+        verified = signature_cache.get(self.digest)
+        if verified is not None:
+            return verified
+
         try:
-            public_key = serialization.load_pem_public_key(self.sender.encode(), default_backend())
+            public_key = load_public_key(self.sender)
             public_key.verify(self.signature, self.get_signature_string(),
                               padding.PSS(
                                   mgf=padding.MGF1(hashes.SHA256()),
                                   salt_length=padding.PSS.MAX_LENGTH),
                               hashes.SHA256())
-            return True
+            verified = True
         except InvalidSignature:
-            return False
+            verified = False
+
+        signature_cache.put(self.digest, verified)
+        return verified
 
     def decrypt(self, private_key):
         """
@@ -158,7 +188,7 @@ class Message(object):
 
 class Block(object):
 
-    def __init__(self, nonce: str, parent: str, create_time: float, miner: str, posts: list):
+    def __init__(self, nonce: str, parent: str, create_time: float, miner: str, posts: list, block_hash=None):
         """
         Takes data from a parsed block, deciphers them, and creates a Block.
 
@@ -176,6 +206,8 @@ class Block(object):
         :param create_time: Time the block was created
         :param miner: Hash of block miner's public key
         :param posts: Posts attached to the block
+        :param block_hash: Known hash of the block, e.g. from a trusted local
+                           ledger. The hash is computed if this is None.
 
         :type nonce: str
         :type parent: str
@@ -190,7 +222,10 @@ class Block(object):
         self.create_time = create_time
         self.miner_key_hash = miner
         self.posts = posts
-        self.block_hash = str(hashlib.sha512(repr(self).encode()).hexdigest())
+        self._block_str = None  # Cached repr()
+        if block_hash is None:
+            block_hash = str(hashlib.sha512(repr(self).encode()).hexdigest())
+        self.block_hash = block_hash
 
     def __str__(self):
         posts_str = "\n"
@@ -209,13 +244,20 @@ class Block(object):
                               )
 
     def __repr__(self):
-        ret_str = self.nonce + "|"
-        ret_str += self.parent_hash + "|"
-        ret_str += self.miner_key_hash + "|"
-        ret_str += str(self.create_time)
-        for post in self.posts:
-            ret_str += "|" + repr(post)
-        return ret_str
+        if self._block_str is None:
+            self._block_str = self.nonce + get_block_suffix(self.parent_hash, self.miner_key_hash, self.create_time,
+                                                            self.posts)
+        return self._block_str
+
+    @property
+    def post_strs(self):
+        """The string form of each post."""
+        return [repr(post) for post in self.posts]
+
+    @property
+    def post_digests(self):
+        """The Message.digest of each post."""
+        return [post.digest for post in self.posts]
 
     def verify_pow(self):
         """
@@ -240,6 +282,92 @@ class Block(object):
                        self.posts))
 
 
+class LazyBlock(Block):
+
+    def __init__(self, block_hash: str, parent: str, create_time: float, miner: str, ledger, offset: int):
+        """
+        A Block whose posts stay in the ledger until something asks for them.
+
+        Only the header fields are kept in memory. The nonce, the posts and
+        the string form of the block are read back from the ledger record at
+        offset on every access, so a long chain does not keep the text of
+        every post resident. The ledger keeps the most recently read block
+        strings cached, so blocks served to peers again and again are not
+        read from disk each time.
+
+        WARNING: The block string stored in the ledger must be exactly
+        repr() of the Block, which is what Blockchain writes.
+
+        :param block_hash: Hash of the block
+        :param parent: Hash of the parent block
+        :param create_time: Time the block was created
+        :param miner: Hash of block miner's public key
+        :param ledger: TextLedger or BinaryLedger holding the block string
+        :param offset: Offset of the block's record in the ledger
+
+        :rtype: LazyBlock
+        """
+        self.block_hash = block_hash
+        self.parent_hash = parent
+        self.create_time = create_time
+        self.miner_key_hash = miner
+        self.ledger = ledger
+        self.offset = offset
+
+    def __repr__(self):
+        return self.ledger.read(self.offset)
+
+    @property
+    def nonce(self):
+        return repr(self).split('|', 1)[NONCE]
+
+    @property
+    def posts(self):
+        return parse_block(repr(self), self.block_hash).posts
+
+    @property
+    def post_strs(self):
+        return repr(self).split('|')[MESSAGE_START:]
+
+    @property
+    def post_digests(self):
+        # The stored post strings are already in canonical form, so they can
+        # be hashed without parsing the messages.
+        return [hashlib.sha256(post_str.encode()).hexdigest() for post_str in self.post_strs]
+
+
+def make_lazy_block(block: Block, ledger, offset):
+    """Returns a LazyBlock for a Block which has been written to the ledger at offset."""
+    return LazyBlock(block.block_hash, block.parent_hash, block.create_time, block.miner_key_hash, ledger, offset)
+
+
+def parse_lazy_block(block_str, block_hash, ledger, offset):
+    """
+    Parses the header of a trusted block string from the ledger into a LazyBlock.
+
+    The posts are not parsed. The block string must come from a ledger which
+    only holds verified blocks.
+
+    :param block_str: The string representation of a block
+    :param block_hash: Known hash of the block string
+    :param ledger: Ledger the block string was read from
+    :param offset: Offset of the block's record in the ledger
+    :rtype: LazyBlock
+    """
+    block_parts = block_str.split('|', MESSAGE_START)
+    if len(block_parts) != MESSAGE_START + 1:
+        log.info("Error parsing block header: Length %s invalid", len(block_parts))
+        return None
+
+    try:
+        created = float(block_parts[CREATE_TIME])
+    except ValueError:
+        log.info("Error parsing block header: Invalid creation time %s", block_parts[CREATE_TIME])
+        return None
+
+    return LazyBlock(block_hash, block_parts[PARENT_HASH], created, block_parts[BLOCK_MINER], ledger, offset)
+
+
 def parse_message(msg_str):
     """
     Parses the string form of a message into a Message object.
@@ -336,7 +464,7 @@ def parse_message(msg_str):
     return Message(sender_key, create_time, message_str, message_sig, recipient_key)
 
 
-def parse_block(block_str):
+def parse_block(block_str, block_hash=None):
     """
     Parses the string form of a block into a Block object.
 
@@ -349,6 +477,7 @@ def parse_block(block_str):
     attached to the block.
 
     :param block_str: The string representation of a block
+    :param block_hash: Known hash of the block string, skips hashing it again
     :type block_str: str
     :rtype: Block
     """
@@ -383,7 +512,28 @@ def parse_block(block_str):
 
     messages = list(filter(lambda x: x is not None, map(parse_message, block_parts[MESSAGE_START:])))
 
-    return Block(nonce, parent, created, miner, messages)
+    return Block(nonce, parent, created, miner, messages, block_hash)
+
+
+def get_block_suffix(parent_hash, miner, create_time, posts):
+    """
+    Builds the part of a block string which follows the nonce.
+
+    This is everything in the string form of a block except the nonce, so a
+    miner can compute it once and then only vary the nonce.
+
+    :param parent_hash: Hash of the parent block
+    :param miner: Hash of block miner's public key
+    :param create_time: Time the block was created
+    :param posts: Posts attached to the block
+    :rtype: str
+    """
+    ret_str = "|" + parent_hash
+    ret_str += "|" + miner
+    ret_str += "|" + str(create_time)
+    for post in posts:
+        ret_str += "|" + repr(post)
+    return ret_str
 
 
 def get_collusion_message(key_manager: Keys):
@@ -0,0 +1,409 @@
+"""Table of peers keyed by address, with a non-blocking DNS cache."""
+import ipaddress
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from socket import gethostbyname
+
+from blockchain_constants import *
+
+log = logging.getLogger('Server')
+
+
+def is_address(host):
+    """Whether host is an IP address rather than a host name."""
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class Resolver(object):
+
+    def __init__(self, ttl=DNS_CACHE_TTL, workers=DNS_WORKERS, resolve=gethostbyname):
+        """
+        Caches host name lookups for ttl seconds.
+
+        Lookups never block: a host name which is not cached yet is resolved
+        on a worker thread, and an expired entry is still returned while it
+        is refreshed in the background. So a slow name server only delays
+        the first use of a name.
+
+        :param workers: Threads resolving host names
+        :param resolve: Function resolving a host name to an address
+        """
+        self.ttl = ttl
+        self.resolve = resolve
+        self.lock = threading.Lock()
+        self.cache = {}  # host name -> (address, time it expires)
+        self.pending = {}  # host name -> callbacks waiting for it to be resolved
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def lookup(self, host):
+        """
+        :return: The cached address of host, or None if it is not known yet.
+                 IP addresses are returned as they are.
+        """
+        if is_address(host):
+            return host
+        with self.lock:
+            entry = self.cache.get(host)
+        if entry is None or entry[1] < time.time():
+            self.resolve_async(host)
+        return None if entry is None else entry[0]
+
+    def resolve_async(self, host, callback=None):
+        """
+        Resolves host on a worker thread.
+
+        :param callback: Called with (host, address) once it is resolved, or
+                         (host, None) if it could not be
+        """
+        with self.lock:
+            callbacks = self.pending.get(host)
+            if callbacks is not None:
+                if callback is not None:
+                    callbacks.append(callback)
+                return
+            self.pending[host] = [] if callback is None else [callback]
+        self._executor.submit(self._resolve, host)
+
+    def _resolve(self, host):
+        try:
+            address = self.resolve(host)
+        except OSError as e:
+            log.info("Could not resolve %s: %s", host, e)
+            address = None
+
+        with self.lock:
+            if address is not None:
+                self.cache[host] = (address, time.time() + self.ttl)
+            callbacks = self.pending.pop(host, [])
+        for callback in callbacks:
+            callback(host, address)
+
+
+def ewma(average, sample, weight=PEER_EWMA_WEIGHT):
+    """Exponentially weighted moving average, updated with a new sample."""
+    return average + weight * (sample - average)
+
+
+class PeerStats(object):
+    """
+    Moving averages of how well a peer has served us.
+
+    :ivar rtt: Seconds a request to the peer takes
+    :ivar throughput: Blocks per second the peer sends when syncing
+    :ivar failure_rate: Fraction of requests which failed
+    :ivar useful: New blocks we got from the peer per sync
+    :ivar failures: Failures in a row
+    :ivar backoff_until: Time before which the peer is not asked
+    """
+    __slots__ = ['rtt', 'throughput', 'failure_rate', 'useful', 'failures', 'backoff_until']
+
+    def __init__(self, rtt=TIMEOUT, throughput=0.0, failure_rate=0.0, useful=0.0, failures=0):
+        self.rtt = rtt
+        self.throughput = throughput
+        self.failure_rate = failure_rate
+        self.useful = useful
+        self.failures = failures
+        self.backoff_until = 0.0
+
+    def success(self, rtt, blocks=0):
+        """
+        Records a request which succeeded.
+
+        :param rtt: Seconds the request took
+        :param blocks: Blocks the peer sent
+        """
+        self.rtt = ewma(self.rtt, rtt)
+        if blocks > 0:
+            self.throughput = ewma(self.throughput, blocks / max(rtt, WAIT_TIME))
+        self.failure_rate = ewma(self.failure_rate, 0.0)
+        self.failures = 0
+        self.backoff_until = 0.0
+
+    def failure(self, now):
+        """Records a failed request, and skips the peer for twice as long as after the last failure."""
+        self.failure_rate = ewma(self.failure_rate, 1.0)
+        self.failures += 1
+        self.backoff_until = now + min(PEER_BACKOFF_MAX, PEER_BACKOFF_BASE * 2 ** (self.failures - 1))
+
+    def score(self):
+        """Higher is better: peers which answer fast, reliably and with new blocks."""
+        return (1.0 + self.useful) * (1.0 - self.failure_rate) / (self.rtt + WAIT_TIME)
+
+    def format(self):
+        return "%r %r %r %r %d" % (self.rtt, self.throughput, self.failure_rate, self.useful, self.failures)
+
+    @staticmethod
+    def parse(fields):
+        """
+        :param fields: Fields of format(), split on whitespace
+        :raises ValueError: If the fields are ill-formed
+        """
+        if len(fields) != 5:
+            raise ValueError("Ill-formed peer stats: %r" % fields)
+        return PeerStats(float(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]), int(fields[4]))
+
+
+class PeerRegistry(object):
+
+    def __init__(self, resolver=None, capacity=MAX_PEERS):
+        """
+        The peers of a Server, with PeerStats for each.
+
+        Peers are keyed by IP address, so checking whether a connecting host
+        is a peer is a dict lookup. Peers given by host name are keyed by the
+        name until the Resolver has resolved it in the background, then by
+        their address. Host names are re-resolved every DNS_CACHE_TTL, and
+        their peer is moved if the address changed.
+
+        A peer which fails is skipped by ranked() for an exponentially
+        growing backoff, and dropped after more than MAX_PEER_FAILURE
+        failures in a row. dirty is set whenever the table changes, so it
+        can be saved in batches.
+
+        :param resolver: Resolver for peers given by host name
+        :param capacity: Most peers kept
+        """
+        self.resolver = Resolver() if resolver is None else resolver
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self._peers = OrderedDict()  # address (or unresolved host name) -> PeerStats
+        self._names = {}  # host name -> key of its peer in self._peers
+        self.dirty = False
+
+        self._refresher = threading.Thread(target=self._refresh)
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def _key(self, host):
+        """Key host is stored under, without blocking on DNS."""
+        address = self.resolver.lookup(host)
+        return host if address is None else address
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, host):
+        return self._key(host) in self._peers
+
+    def same_host(self, host, other):
+        """Whether host and other name the same peer, e.g. an address and a host name resolved to it."""
+        return host == other or self._key(host) == self._key(other)
+
+    def hosts(self):
+        """List of the peers' addresses (or host names not resolved yet)."""
+        with self.lock:
+            return list(self._peers)
+
+    def items(self):
+        """List of (address, failures in a row)."""
+        with self.lock:
+            return [(key, stats.failures) for key, stats in self._peers.items()]
+
+    def stats(self, host):
+        """
+        :return: Copy of the PeerStats of host, or None if it is not a peer
+        """
+        key = self._key(host)
+        with self.lock:
+            stats = self._peers.get(key)
+            if stats is None:
+                return None
+            copy = PeerStats(stats.rtt, stats.throughput, stats.failure_rate, stats.useful, stats.failures)
+            copy.backoff_until = stats.backoff_until
+            return copy
+
+    def ranked(self, now=None, backing_off=False):
+        """
+        :param backing_off: Whether to list the peers backing off too, after the others
+        :return: Hosts of the peers not backing off, unless backing_off, best score first
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            entries = [(key, stats.backoff_until > now, stats.score()) for key, stats in self._peers.items()
+                       if backing_off or stats.backoff_until <= now]
+        entries.sort(key=lambda entry: (entry[1], -entry[2]))
+        return [key for key, _, _ in entries]
+
+    def lines(self):
+        """
+        Lines to save the table as, clearing dirty.
+
+        :return: List of "<host> <PeerStats.format()>"
+        """
+        with self.lock:
+            self.dirty = False
+            return ["%s %s" % (key, stats.format()) for key, stats in self._peers.items()]
+
+    def add(self, host, stats=None):
+        """
+        Adds a peer unless it already is one or the table is full.
+
+        :param stats: PeerStats saved for the peer, if any
+        :return: Whether the peer was added
+        """
+        key = self._key(host)
+        with self.lock:
+            if key in self._peers or len(self._peers) >= self.capacity:
+                return False
+            self._peers[key] = PeerStats() if stats is None else stats
+            self.dirty = True
+            if not is_address(host):
+                self._names[host] = key
+        if key == host and not is_address(host):
+            self.resolver.resolve_async(host, self._resolved)
+        return True
+
+    def record(self, host, rtt, blocks=0):
+        """
+        Records a request to a peer which succeeded. See PeerStats.success().
+
+        :return: Whether host was a peer
+        """
+        key = self._key(host)
+        with self.lock:
+            stats = self._peers.get(key)
+            if stats is None:
+                return False
+            stats.success(rtt, blocks)
+            self.dirty = True
+            return True
+
+    def credit(self, host, useful):
+        """
+        Records how many new blocks we got from a peer in a sync.
+
+        :return: Whether host was a peer
+        """
+        key = self._key(host)
+        with self.lock:
+            stats = self._peers.get(key)
+            if stats is None:
+                return False
+            stats.useful = ewma(stats.useful, useful)
+            self.dirty = True
+            return True
+
+    def punish(self, host, max_failures=MAX_PEER_FAILURE):
+        """
+        Records a failure of a peer, and removes it after more than
+        max_failures in a row.
+
+        :return: Whether host was a peer
+        """
+        key = self._key(host)
+        with self.lock:
+            stats = self._peers.get(key)
+            if stats is None:
+                return False
+            stats.failure(time.time())
+            if stats.failures > max_failures:
+                self._remove(key)
+            self.dirty = True
+            return True
+
+    def remove(self, host):
+        with self.lock:
+            self._remove(self._key(host))
+
+    def clear(self):
+        with self.lock:
+            self._peers.clear()
+            self._names.clear()
+            self.dirty = True
+
+    def _remove(self, key):
+        if self._peers.pop(key, None) is not None:
+            self.dirty = True
+        for name in [name for name, name_key in self._names.items() if name_key == key]:
+            del self._names[name]
+
+    def _resolved(self, host, address):
+        """Resolver callback. Moves the peer added as host to its new address."""
+        with self.lock:
+            key = self._names.get(host)
+            if key is None or address is None or key == address:
+                return
+            stats = self._peers.pop(key, None)
+            if stats is None:
+                return
+            self._names[host] = address
+            if address not in self._peers:
+                self._peers[address] = stats
+            self.dirty = True
+            log.info("Peer %s is now at %s", host, address)
+
+    def _refresh(self):
+        """Refresher thread loop."""
+        while True:
+            time.sleep(self.resolver.ttl)
+            with self.lock:
+                names = list(self._names)
+            for host in names:
+                self.resolver.resolve_async(host, self._resolved)
+
+
+class Prober(object):
+
+    def __init__(self, workers=PEER_PROBE_WORKERS, deadline=PEER_PROBE_DEADLINE):
+        """
+        Sends the same request to many peers at once.
+
+        At most workers peers are probed at a time, and a peer which has not
+        answered deadline seconds after its probe started counts as failed.
+        A probe that overran keeps its worker until the connection times out,
+        but nobody waits for it.
+
+        :param workers: Peers probed at once
+        :param deadline: Seconds each peer has to answer
+        """
+        self.deadline = deadline
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def map(self, probe, hosts, on_result=None):
+        """
+        Calls probe(host) for every host.
+
+        :param on_result: Called with (host, result) as soon as each probe succeeds
+        :return: (dict of host -> result, list of hosts whose probe raised an
+                 error or missed its deadline)
+        """
+        started = {}  # host -> time its probe started
+
+        def run(host):
+            started[host] = time.time()
+            return probe(host)
+
+        pending = {self._executor.submit(run, host): host for host in set(hosts)}
+        results = {}
+        failed = []
+        while len(pending) > 0:
+            now = time.time()
+            deadlines = [started[host] + self.deadline for host in pending.values() if host in started]
+            timeout = max(0.0, min(deadlines) - now) if len(deadlines) > 0 else self.deadline
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                host = pending.pop(future)
+                try:
+                    results[host] = future.result()
+                except Exception as e:
+                    log.info("Probe of %s failed: %s", host, e)
+                    failed.append(host)
+                    continue
+                if on_result is not None:
+                    on_result(host, results[host])
+
+            now = time.time()
+            for future, host in list(pending.items()):
+                if host in started and now - started[host] >= self.deadline:
+                    log.info("Probe of %s missed its deadline", host)
+                    del pending[future]
+                    failed.append(host)
+        return results, failed
@@ -0,0 +1,340 @@
+"""
+Headers-first download of new blocks from several peers at once.
+
+HEADERS_REQUEST asks a peer for the header of every block it has after a
+time, as a count line followed by one "<hash> <parent hash> <time> <miner>"
+line per block. BLOCKS_REQUEST asks for up to SYNC_BATCH_SIZE block strings
+by hash, as a count line followed by one hash per line. The peer answers
+with one line per hash: the block string, or "ERROR Block not found".
+"""
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from blockchain_constants import *
+from inventory import inventory_hash
+
+log = logging.getLogger('Server')
+
+BlockHeader = namedtuple('BlockHeader', ['block_hash', 'parent_hash', 'create_time', 'miner'])
+
+
+def format_header(block_hash, parent_hash, create_time, miner):
+    """Line a header is sent as, ending with a newline."""
+    return "%s %s %r %s\n" % (block_hash, parent_hash, create_time, miner)
+
+
+def parse_header(line):
+    """
+    :rtype: BlockHeader
+    :raises ValueError: If the line is not a header
+    """
+    parts = line.split()
+    if len(parts) != 4:
+        raise ValueError("Ill-formed block header: %r" % line[:40])
+    return BlockHeader(parts[0], parts[1], float(parts[2]), parts[3])
+
+
+class SyncManager(object):
+
+    def __init__(self, blockchain, pool, workers=SYNC_WORKERS, batch_size=SYNC_BATCH_SIZE,
+                 peers=None, deadline=SYNC_DEADLINE):
+        """
+        Downloads the blocks our peers have and we do not.
+
+        The headers of every new block are fetched from all peers in
+        parallel. Missing blocks are then ordered best chain first and
+        parents before children, and each is downloaded from only one of the
+        peers which announced it. A round of downloads asks every peer for up
+        to batch_size blocks at once, and its blocks are added in order once
+        the round is complete, so they connect without waiting as orphans.
+
+        A peer which has not answered deadline seconds after its request
+        started counts as failed, and the sync goes on without it. Requests
+        still waiting for a worker once all could have had their full
+        deadline are dropped without counting against their peer. The time
+        each request took, and the new blocks each peer sent, are recorded in
+        peers.
+
+        :param blockchain: Blockchain to add the blocks to
+        :param pool: ConnectionPool to send requests through
+        :param workers: Peers downloaded from at once
+        :param batch_size: Most blocks asked of a peer at once
+        :param peers: PeerRegistry to record how peers did in, if any
+        :param deadline: Seconds a peer has to answer a request
+        """
+        self.blockchain = blockchain
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.peers = peers
+        self.deadline = deadline
+
+    def sync(self, hosts, since):
+        """
+        Downloads and adds the blocks created after since which hosts have.
+
+        :param hosts: Hosts to sync from, preferred ones first
+        :return: (number of blocks added, set of hosts which failed, set of
+                 hosts which do not know HEADERS_REQUEST)
+        """
+        failed = set()
+        legacy = set()
+        headers = {}  # block hash -> BlockHeader
+        sources = {}  # block hash -> hosts which have the block
+
+        useful = {}  # host -> blocks it sent which were added
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            requests = [(host, self.request_headers, host, since) for host in hosts]
+            for host, future in self.run_requests(executor, requests):
+                if future is None:
+                    log.info("Header request to %s timed out", host)
+                    failed.add(host)
+                    continue
+                if future.cancelled():
+                    log.info("Header request to %s not sent in time", host)
+                    continue
+                try:
+                    seconds, host_headers = future.result()
+                except (OSError, ValueError) as e:
+                    log.info("Header request to %s failed: %s", host, e)
+                    failed.add(host)
+                    continue
+                if host_headers is None:
+                    legacy.add(host)
+                    continue
+                self.record(host, seconds)
+                useful[host] = 0
+                for header in host_headers:
+                    headers.setdefault(header.block_hash, header)
+                    sources.setdefault(header.block_hash, []).append(host)
+
+            missing = self.plan(headers)
+            log.info("%d new block headers from %d peers, %d blocks to download",
+                     len(headers), len(hosts) - len(failed) - len(legacy), len(missing))
+            added = self.download(executor, missing, sources, failed, useful)
+        finally:
+            # Requests to hosts which missed the deadline are left to time out on their own
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.peers is not None:
+            for host, count in useful.items():
+                if host not in failed:
+                    self.peers.credit(host, count)
+        return added, failed, legacy
+
+    def run_requests(self, executor, requests):
+        """
+        Runs requests on executor, each with deadline seconds from when it
+        starts, so requests waiting for a free worker are not held to the
+        deadline. Requests which have not started once every request could
+        have had its full deadline are cancelled.
+
+        :param requests: List of (host, function, *args) tuples. function(*args) is timed().
+        :return: List of (host, future), in the order of requests. future is
+                 None if the request timed out, and cancelled if it never started.
+        """
+        started = {}  # request index -> time it started
+
+        def run(i, request, args):
+            started[i] = time.time()
+            return self.timed(request, *args)
+
+        futures = [executor.submit(run, i, request[1], request[2:]) for i, request in enumerate(requests)]
+        give_up = time.time() + self.deadline * -(-len(requests) // self.workers)
+        timed_out = set()
+        pending = set(range(len(futures)))
+        while len(pending) > 0:
+            now = time.time()
+            for i in list(pending):
+                if futures[i].done():
+                    pending.discard(i)
+                elif i in started and now - started[i] >= self.deadline:
+                    timed_out.add(i)
+                    pending.discard(i)
+                elif i not in started and now >= give_up and futures[i].cancel():
+                    pending.discard(i)
+            if len(pending) == 0:
+                break
+            next_check = min([started[i] + self.deadline for i in pending if i in started] + [give_up])
+            wait([futures[i] for i in pending], timeout=max(0.0, next_check - now), return_when=FIRST_COMPLETED)
+
+        return [(request[0], None if i in timed_out else futures[i]) for i, request in enumerate(requests)]
+
+    def timed(self, request, *args):
+        """
+        :return: (seconds request(*args) took, its result)
+        """
+        start = time.time()
+        result = request(*args)
+        return time.time() - start, result
+
+    def record(self, host, seconds, blocks=0):
+        if self.peers is not None:
+            self.peers.record(host, seconds, blocks)
+
+    def plan(self, headers):
+        """
+        Orders the blocks to download.
+
+        Headers whose ancestry does not lead back to a block we have or a
+        root block are dropped, since the blocks could not be added. The
+        blocks of the deepest chain come first, then those of other forks,
+        each sorted by depth.
+
+        :param headers: Dict of block hash -> BlockHeader
+        :return: List of block hashes
+        """
+        depths = {}  # block hash -> depth, or None if it cannot be connected
+        for block_hash in headers:
+            # Walk up to a block with a known depth, then fill in the depths on the way back
+            path = []
+            on_path = set()
+            while block_hash not in depths:
+                depth = self.blockchain.get_block_depth(block_hash)
+                if depth is not None:
+                    depths[block_hash] = depth
+                    break
+                header = headers.get(block_hash)
+                if header is None or block_hash in on_path:
+                    # A root's parent, or a parent nobody sent (or a cycle of made up headers)
+                    depths[block_hash] = 0 if block_hash.strip('0') == '' else None
+                    break
+                path.append(block_hash)
+                on_path.add(block_hash)
+                block_hash = header.parent_hash
+
+            depth = depths[block_hash]
+            for block_hash in reversed(path):
+                depth = None if depth is None else depth + 1
+                depths[block_hash] = depth
+
+        missing = [block_hash for block_hash in headers
+                   if depths[block_hash] is not None and not self.blockchain.has_block(block_hash)]
+        if len(missing) == 0:
+            return []
+
+        best_chain = set()
+        block_hash = max(missing, key=lambda h: (depths[h], -headers[h].create_time))
+        while block_hash in headers and not self.blockchain.has_block(block_hash):
+            best_chain.add(block_hash)
+            block_hash = headers[block_hash].parent_hash
+
+        return sorted(missing, key=lambda h: (h not in best_chain, depths[h]))
+
+    def download(self, executor, missing, sources, failed, useful=None):
+        """
+        Downloads and adds the missing blocks, in rounds of up to
+        batch_size blocks per source.
+
+        :param missing: Block hashes in the order to add them
+        :param sources: Dict of block hash -> hosts which have the block
+        :param failed: Set of hosts not to ask. Hosts which fail are added.
+        :param useful: Dict of host -> blocks added, counted up for the blocks each host sent
+        :return: Number of blocks added
+        """
+        useful = {} if useful is None else useful
+        added = 0
+        start = 0
+        while start < len(missing):
+            hosts = {host for block_hash in missing[start:start + self.batch_size] for host in sources[block_hash]}
+            window = missing[start:start + self.batch_size * max(1, len(hosts - failed))]
+            start += len(window)
+
+            block_strs = {}
+            senders = {}  # block hash -> host which sent it
+            asked = {}  # block hash -> hosts asked for it
+            pending = window
+            # Blocks a peer fails to send are asked of another peer which has them
+            for _ in range(2):
+                batches = self.assign(pending, sources, failed, asked)
+                requests = [(host, self.request_blocks, host, batch) for host, batch in batches]
+                for (host, future), (_, batch) in zip(self.run_requests(executor, requests), batches):
+                    if future is None:
+                        log.info("Block request to %s timed out", host)
+                        failed.add(host)
+                        continue
+                    if future.cancelled():
+                        log.info("Block request to %s not sent in time", host)
+                        # The host was not asked, so it may be asked for these blocks again
+                        for block_hash in batch:
+                            asked[block_hash].discard(host)
+                        continue
+                    try:
+                        seconds, host_block_strs = future.result()
+                    except (OSError, ValueError) as e:
+                        log.info("Block request to %s failed: %s", host, e)
+                        failed.add(host)
+                        continue
+                    self.record(host, seconds, len(host_block_strs))
+                    block_strs.update(host_block_strs)
+                    senders.update((block_hash, host) for block_hash in host_block_strs)
+                pending = [block_hash for block_hash in pending if block_hash not in block_strs]
+                if len(pending) == 0:
+                    break
+
+            for block_hash in window:
+                if block_hash in block_strs and self.blockchain.add_block_str(block_strs[block_hash]):
+                    added += 1
+                    host = senders[block_hash]
+                    useful[host] = useful.get(host, 0) + 1
+        return added
+
+    def assign(self, block_hashes, sources, failed, asked):
+        """
+        Spreads block downloads across the hosts which have them.
+
+        Each block goes to the working host with the fewest blocks assigned
+        so far, which was not asked for it before. Ties go to the host listed
+        first in sources, so the hosts sync() was given first are preferred.
+
+        :param asked: Dict of block hash -> hosts already asked for it. Updated with the new assignments.
+        :return: List of (host, block hashes), at most batch_size hashes each
+        """
+        assigned = {}  # host -> block hashes
+        for block_hash in block_hashes:
+            tried = asked.setdefault(block_hash, set())
+            hosts = [host for host in sources[block_hash] if host not in failed and host not in tried]
+            if len(hosts) == 0:
+                continue
+            host = min(hosts, key=lambda h: len(assigned.get(h, ())))
+            assigned.setdefault(host, []).append(block_hash)
+            tried.add(host)
+
+        return [(host, block_hashes[i:i + self.batch_size])
+                for host, block_hashes in assigned.items()
+                for i in range(0, len(block_hashes), self.batch_size)]
+
+    def request_headers(self, host, since):
+        """
+        :return: List of BlockHeaders, or None if host does not know HEADERS_REQUEST
+        """
+        with self.pool.request(host, "HEADERS_REQUEST\n%f\n" % since) as f_in:
+            first = f_in.readline().strip()
+            if first.startswith("ERROR Command not recognized"):
+                return None
+            return [parse_header(f_in.readline()) for _ in range(int(first))]
+
+    def request_blocks(self, host, block_hashes):
+        """
+        Downloads blocks by hash. Blocks the peer does not have, or sends
+        with a different hash, are left out.
+
+        :return: Dict of block hash -> block string
+        """
+        with self.pool.request(host, "BLOCKS_REQUEST\n%d\n" % len(block_hashes) +
+                               "".join(block_hash + "\n" for block_hash in block_hashes)) as f_in:
+            first = f_in.readline()
+            if first.startswith("ERROR Too many blocks") or first.startswith("ERROR Command not recognized"):
+                raise ValueError(first.strip())
+            lines = [first] + [f_in.readline() for _ in range(len(block_hashes) - 1)]
+
+        block_strs = {}
+        for block_hash, line in zip(block_hashes, lines):
+            block_str = line.strip()
+            if inventory_hash(BLOCK_TYPE, block_str) == block_hash:
+                block_strs[block_hash] = block_str
+        return block_strs
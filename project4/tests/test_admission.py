@@ -0,0 +1,39 @@
+import unittest
+
+from admission import ConnectionLimiter, RateLimiter, TokenBucket
+
+
+class TestAdmission(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10.0, burst=5, now=0.0)
+        self.assertEqual(bucket.take(3, now=0.0), 3)
+        self.assertEqual(bucket.take(3, now=0.0), 2)
+        self.assertEqual(bucket.take(1, now=0.05), 0)
+        # Refills at rate, up to burst
+        self.assertEqual(bucket.take(1, now=0.1), 1)
+        self.assertEqual(bucket.take(10, now=100.0), 5)
+
+    def test_rate_limiter_per_host(self):
+        limiter = RateLimiter(rate=0.001, burst=2, capacity=10)
+        self.assertTrue(limiter.allow('10.0.0.1'))
+        self.assertTrue(limiter.allow('10.0.0.1'))
+        self.assertFalse(limiter.allow('10.0.0.1'))
+        self.assertEqual(limiter.take('10.0.0.2', 5), 2)
+
+    def test_connection_limiter(self):
+        limiter = ConnectionLimiter(max_per_host=2)
+        self.assertTrue(limiter.acquire('10.0.0.1'))
+        self.assertTrue(limiter.acquire('10.0.0.1'))
+        self.assertFalse(limiter.acquire('10.0.0.1'))
+        self.assertTrue(limiter.acquire('10.0.0.2'))
+
+        limiter.release('10.0.0.1')
+        self.assertTrue(limiter.acquire('10.0.0.1'))
+        for _ in range(3):
+            limiter.release('10.0.0.2')
+        self.assertNotIn('10.0.0.2', limiter.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
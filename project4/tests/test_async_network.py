@@ -0,0 +1,31 @@
+import asyncio
+import unittest
+
+from async_network import AsyncServer
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def read_request(self, data):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            # read_request does not touch any server state
+            return await AsyncServer.__new__(AsyncServer).read_request(reader)
+
+        return asyncio.run(read())
+
+    def test_read_single_line_request(self):
+        self.assertEqual(self.read_request(b"BLOCK_BROADCAST\nblock\nextra\n"),
+                         ["BLOCK_BROADCAST\n", "block\n"])
+
+    def test_read_no_payload_request(self):
+        self.assertEqual(self.read_request(b"PEERS_REQUEST\nextra\n"), ["PEERS_REQUEST\n"])
+
+    def test_read_message_batch(self):
+        self.assertEqual(self.read_request(b"MESSAGES_BROADCAST\n2\na\nb\nextra\n"),
+                         ["MESSAGES_BROADCAST\n", "2\n", "a\n", "b\n"])
+
+    def test_read_closed_connection(self):
+        self.assertEqual(self.read_request(b""), [""])
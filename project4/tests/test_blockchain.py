@@ -1,9 +1,15 @@
+import hashlib
 import logging
+import threading
 import unittest
+from unittest import mock
 
 import os
 
-from blockchain import Blockchain
+from blockchain import BlockNode, Blockchain, ForkChoice, MessageQueue, OrphanPool, get_common_ancestor, \
+    get_skip_depth
+from blockchain_constants import EVICT_OLDEST, REJECT_NEWEST, MSGS_PER_BLOCK
+from objects import Block, Message
 
 
 class TestBlockchain(unittest.TestCase):
@@ -11,6 +17,7 @@ class TestBlockchain(unittest.TestCase):
     valid_message = 'tests/message_data/valid_public.txt'
     invalid_message = 'tests/message_data/bad_timestamp.txt'
     invalid_ds = 'tests/message_data/bad_ds.txt'
+    valid_private_message = 'tests/message_data/valid_private.txt'
     ledger = 'tests/ledger.txt'
     example_ledger = 'tests/chain_data/ledger.txt'
     example_messages = 'tests/messages.txt'
@@ -20,6 +27,8 @@ class TestBlockchain(unittest.TestCase):
         logging.getLogger("blockchain").disabled = True
 
     def tearDown(self):
+        if hasattr(self, 'blockchain'):
+            self.blockchain.close()
         try:
             remove_file(TestBlockchain.ledger)
             remove_file(TestBlockchain.example_messages)
@@ -64,6 +73,28 @@ class TestBlockchain(unittest.TestCase):
         self.blockchain.add_message_str(get_message_str(TestBlockchain.invalid_ds))
         self.assertEqual(self.blockchain.get_message_queue_size(), 0)
 
+    def test_message_queue_batch(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        msgs = [get_message_str(TestBlockchain.valid_message), get_message_str(TestBlockchain.invalid_ds),
+                get_message_str(TestBlockchain.valid_private_message), get_message_str(TestBlockchain.valid_message),
+                get_message_str(TestBlockchain.invalid_message)]
+        self.assertEqual(self.blockchain.add_message_strs(msgs), [True, False, True, False, False])
+        self.assertEqual(2, self.blockchain.get_message_queue_size())
+
+    def test_known_messages(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        valid = get_message_str(TestBlockchain.valid_message)
+        invalid = get_message_str(TestBlockchain.invalid_ds)
+        digests = [hashlib.sha256(msg.encode()).hexdigest() for msg in (valid, invalid)]
+        self.assertFalse(any(self.blockchain.is_known_message(digest) for digest in digests))
+
+        self.assertEqual(self.blockchain.add_message_strs([valid, invalid]), [True, False])
+        self.assertTrue(all(self.blockchain.is_known_message(digest) for digest in digests))
+        self.assertIn(digests[1], self.blockchain.message_rejects)
+        self.assertFalse(self.blockchain.add_message_str(invalid))
+
     def test_no_mined_block(self):
         self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
                                               TestBlockchain.stats)
@@ -96,6 +127,102 @@ class TestBlockchain(unittest.TestCase):
         self.add_all_blocks(TestBlockchain.valid_chain)
         self.assertEqual(len(self.blockchain.get_all_block_strs(1519774044.163314)), 3)
 
+    def test_get_all_block_strs_time_order(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 5)
+        first = add_test_block(self.blockchain, root.block_hash, 1)
+        second = add_test_block(self.blockchain, first.block_hash, 3)
+        self.assertEqual(self.blockchain.get_all_block_strs(0), [repr(first), repr(second), repr(root)])
+        self.assertEqual(self.blockchain.get_all_block_strs(3), [repr(root)])
+        self.assertEqual(self.blockchain.get_all_block_strs(5), [])
+
+    def test_main_chain_messages(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        add_test_block(self.blockchain, root.block_hash, 1)
+        self.assertTrue(self.blockchain._is_duplicate_message(get_test_message(MSGS_PER_BLOCK)))
+        self.assertEqual(self.blockchain.message_num, 2 * MSGS_PER_BLOCK)
+
+    def test_main_chain_reorg(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        stale = add_test_block(self.blockchain, root.block_hash, 1)
+        fork = add_test_block(self.blockchain, root.block_hash, 2)
+        self.assertTrue(self.blockchain._is_duplicate_message(stale.posts[0]))
+        self.assertFalse(self.blockchain._is_duplicate_message(fork.posts[0]))
+
+        fork = add_test_block(self.blockchain, fork.block_hash, 3)
+        self.assertFalse(self.blockchain._is_duplicate_message(stale.posts[0]))
+        self.assertTrue(self.blockchain._is_duplicate_message(fork.posts[0]))
+        self.assertEqual(self.blockchain.message_num, 3 * MSGS_PER_BLOCK)
+
+        self.blockchain.flush()
+        with open(TestBlockchain.example_messages, 'r') as messages:
+            expected = [repr(get_test_message(i)) for i in range(MSGS_PER_BLOCK)] + \
+                       [repr(get_test_message(i)) for i in range(2 * MSGS_PER_BLOCK, 4 * MSGS_PER_BLOCK)]
+            self.assertEqual(messages.read().split("\n")[:-1], expected)
+
+    def test_duplicate_block_not_parsed(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        block_strs = self.add_all_blocks(TestBlockchain.valid_chain).split("\n")
+        with mock.patch('blockchain.parse_block') as parse_block:
+            for block_str in block_strs:
+                self.assertFalse(self.blockchain.add_block_str(block_str))
+            parse_block.assert_not_called()
+
+    def test_invalid_pow_remembered(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        block_str = "1" + get_block_strs(TestBlockchain.valid_chain)[0]
+        block_hash = hashlib.sha512(block_str.encode()).hexdigest()
+        with mock.patch('blockchain.parse_block') as parse_block:
+            self.assertFalse(self.blockchain.add_block_str(block_str))
+            parse_block.assert_not_called()
+        self.assertEqual(self.blockchain.rejects.get(block_hash), "invalid POW")
+
+    def test_rejected_parent(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        block_strs = get_block_strs(TestBlockchain.valid_chain)
+        self.assertTrue(self.blockchain.add_block_str(block_strs[0]))
+        self.blockchain.rejects.put(hashlib.sha512(block_strs[1].encode()).hexdigest(), "invalid POW")
+        self.assertFalse(self.blockchain.add_block_str(block_strs[1]))
+        # Children of a rejected block are rejected too
+        self.assertFalse(self.blockchain.add_block_str(block_strs[2]))
+        self.assertEqual(self.blockchain.rejects.get(hashlib.sha512(block_strs[2].encode()).hexdigest()),
+                         "rejected parent")
+
+    def test_orphan_connected_when_parent_arrives(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        block_strs = get_block_strs(TestBlockchain.valid_chain)
+        orphan_hash = hashlib.sha512(block_strs[1].encode()).hexdigest()
+        self.assertFalse(self.blockchain.add_block_str(block_strs[1]))
+        self.assertIsNone(self.blockchain.rejects.get(orphan_hash))
+        parent_hash = hashlib.sha512(block_strs[0].encode()).hexdigest()
+        self.assertEqual(self.blockchain.get_orphan_parent(orphan_hash), parent_hash)
+
+        self.assertTrue(self.blockchain.add_block_str(block_strs[0]))
+        self.assertTrue(self.blockchain.has_block(orphan_hash))
+        self.assertIsNone(self.blockchain.get_orphan_parent(orphan_hash))
+        self.assertEqual(self.blockchain.get_block_str(orphan_hash), block_strs[1])
+
+    def test_orphan_cascade(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        block_strs = get_block_strs(TestBlockchain.valid_chain)
+        for block_str in reversed(block_strs[1:]):
+            self.assertFalse(self.blockchain.add_block_str(block_str))
+        self.assertEqual(len(self.blockchain.orphans), len(block_strs) - 1)
+
+        self.assertTrue(self.blockchain.add_block_str(block_strs[0]))
+        self.assertEqual(self.blockchain.get_all_block_strs(0), block_strs)
+        self.assertEqual(len(self.blockchain.orphans), 0)
+
     def add_all_blocks(self, file_name):
         with open(file_name, 'r') as chain:
             raw_data = chain.read().strip()
@@ -104,16 +231,292 @@ class TestBlockchain(unittest.TestCase):
                 self.blockchain.add_block_str(block_string)
             return raw_data
 
+    def test_fork_stats_per_instance(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        first = add_test_block(self.blockchain, root.block_hash, 1)
+        add_test_block(self.blockchain, first.block_hash, 2)
+        add_test_block(self.blockchain, root.block_hash, 3)
+        self.assertEqual(self.blockchain._get_current_depth(), 3)
+        self.assertEqual(self.blockchain._get_fork_depth(), 2)
+        self.assertEqual(self.blockchain.fork_choice.stale, 1)
+
+        other = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages, TestBlockchain.stats)
+        self.assertEqual(other._get_current_depth(), 0)
+        other.close()
+        self.assertEqual(other.fork_counter, 0)
+        self.assertEqual(other.num_trees, 0)
+
+    def test_snapshot(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        add_test_block(self.blockchain, root.block_hash, 1)
+        snapshot = self.blockchain.get_snapshot()
+        add_test_block(self.blockchain, root.block_hash, 2)
+        self.assertEqual((snapshot.total_blocks, snapshot.longest, snapshot.stale), (2, 2, 0))
+        self.assertEqual(snapshot.message_num, 2 * MSGS_PER_BLOCK)
+        snapshot = self.blockchain.get_snapshot()
+        self.assertEqual((snapshot.total_blocks, snapshot.longest, snapshot.second_longest, snapshot.stale),
+                         (3, 2, 2, 1))
+
+    def test_readers_do_not_take_chain_lock(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        results = []
+
+        def read():
+            results.append(self.blockchain.get_all_block_strs(-1))
+            results.append(self.blockchain.get_block_str(root.block_hash))
+            results.append(self.blockchain.get_message_queue_size())
+            results.append(self.blockchain.has_message(get_test_message(0).digest))
+            results.append(self.blockchain.get_snapshot().longest)
+
+        with self.blockchain.lock:
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+        self.assertEqual(results, [[repr(root)], repr(root), 0, True, 1])
+
+
+    def test_same_block_added_at_once(self):
+        self.blockchain = get_test_blockchain(TestBlockchain.ledger, TestBlockchain.example_messages,
+                                              TestBlockchain.stats)
+        root = add_test_block(self.blockchain, '0' * 36, 0)
+        posts = [get_test_message(MSGS_PER_BLOCK + j) for j in range(MSGS_PER_BLOCK)]
+        blocks = [Block('00', root.block_hash, 1.0, '0' * 64, posts) for _ in range(8)]
+        start = threading.Barrier(len(blocks))
+        results = []
+
+        def add(block):
+            start.wait()
+            results.append(self.blockchain._add_block(block, False, False))
+
+        threads = [threading.Thread(target=add, args=(block,)) for block in blocks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+        self.assertEqual(len(self.blockchain.blocks[root.block_hash].children), 1)
+        self.assertEqual(self.blockchain.total_blocks, 2)
+        self.assertEqual(self.blockchain.message_num, 2 * MSGS_PER_BLOCK)
+
+
+class TestMessageQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [get_test_message(i) for i in range(5)]
+
+    def test_fifo_order(self):
+        queue = MessageQueue(10)
+        for msg in self.messages:
+            queue.append(msg)
+        self.assertEqual([queue.pop() for _ in range(len(self.messages))], self.messages)
+
+    def test_contains_equal_message(self):
+        queue = MessageQueue(10)
+        queue.append(self.messages[0])
+        self.assertIn(get_test_message(0), queue)
+        self.assertNotIn(self.messages[1], queue)
+
+    def test_no_duplicates(self):
+        queue = MessageQueue(10)
+        queue.append(self.messages[0])
+        queue.append(get_test_message(0))
+        self.assertEqual(len(queue), 1)
+
+    def test_remove(self):
+        queue = MessageQueue(10)
+        for msg in self.messages:
+            queue.append(msg)
+        queue.remove(self.messages[2])
+        self.assertNotIn(self.messages[2], queue)
+        self.assertEqual(len(queue), 4)
+        self.assertRaises(ValueError, queue.remove, self.messages[2])
+
+    def test_reject_newest(self):
+        queue = MessageQueue(3, REJECT_NEWEST)
+        results = [queue.append(msg) for msg in self.messages]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(list(queue), self.messages[:3])
+
+    def test_evict_oldest(self):
+        queue = MessageQueue(3, EVICT_OLDEST)
+        for msg in self.messages:
+            self.assertTrue(queue.append(msg))
+        self.assertEqual(list(queue), self.messages[2:])
+
+    def test_appendleft(self):
+        queue = MessageQueue(10)
+        queue.append(self.messages[1])
+        queue.appendleft(self.messages[0])
+        self.assertEqual(queue.pop(), self.messages[0])
+
+    def test_appendleft_over_capacity(self):
+        for policy in [REJECT_NEWEST, EVICT_OLDEST]:
+            queue = MessageQueue(3, policy)
+            for msg in self.messages[2:]:
+                queue.append(msg)
+            queue.appendleft(self.messages[1])
+            queue.appendleft(self.messages[0])
+            self.assertEqual(list(queue), self.messages)
+            self.assertTrue(queue.is_full())
+
+
+class TestBlockNode(unittest.TestCase):
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            BlockNode(None, None).extra = 1
+
+    def test_skip_depths_match_bitcoin(self):
+        # (height, skip height) from Bitcoin's GetSkipHeight. Depths are heights + 1.
+        bitcoin_skips = [(0, 0), (1, 0), (2, 0), (3, 1), (4, 0), (5, 1), (6, 4), (7, 1), (10, 8), (15, 9),
+                         (100, 96), (101, 65), (1000, 992), (1001, 961), (123457, 122881)]
+        for height, skip_height in bitcoin_skips:
+            self.assertEqual(get_skip_depth(height + 1), skip_height + 1)
+
+    def test_get_ancestor(self):
+        chain = make_chain(None, 1000)
+        for node in chain:
+            self.assertIs(chain[-1].get_ancestor(node.depth), node)
+        self.assertIsNone(chain[-1].get_ancestor(0))
+        self.assertIsNone(chain[10].get_ancestor(12))
+
+    def test_common_ancestor(self):
+        trunk = make_chain(None, 300)
+        for fork_depth in (1, 2, 7, 64, 129, 300):
+            fork = make_chain(trunk[fork_depth - 1], 150)
+            for other in (trunk[-1], trunk[fork_depth - 1], trunk[fork_depth // 2]):
+                expected = other if other.depth <= fork_depth else trunk[fork_depth - 1]
+                self.assertIs(get_common_ancestor(fork[-1], other), expected)
+                self.assertIs(get_common_ancestor(other, fork[-1]), expected)
+            self.assertIs(get_common_ancestor(fork[-1], fork[3]), fork[3])
+
+    def test_common_ancestor_other_tree(self):
+        self.assertIsNone(get_common_ancestor(make_chain(None, 40)[-1], make_chain(None, 60)[-1]))
+        self.assertIsNone(get_common_ancestor(BlockNode(None, None), None))
+
+
+class TestForkChoice(unittest.TestCase):
+
+    def setUp(self):
+        self.fork_choice = ForkChoice()
+        self.reorgs = []
+        self.fork_choice.on_reorg(self.reorgs.append)
+
+    def add(self, parent):
+        node = BlockNode(None, parent)
+        if parent is not None:
+            parent.add_child(node)
+        return node, self.fork_choice.add(node)
+
+    def test_extend(self):
+        root, switch = self.add(None)
+        self.assertEqual(switch, (None, None))
+        child, switch = self.add(root)
+        self.assertEqual(switch, (root, root))
+        self.assertIs(self.fork_choice.tip, child)
+        self.assertEqual((self.fork_choice.longest, self.fork_choice.second_longest, self.fork_choice.stale), (2, 0, 0))
+        self.assertEqual(self.fork_choice.num_tips, 1)
+        self.assertEqual(self.reorgs, [])
+
+    def test_first_seen_wins_ties(self):
+        root, _ = self.add(None)
+        first, _ = self.add(root)
+        second, switch = self.add(root)
+        self.assertIsNone(switch)
+        self.assertIs(self.fork_choice.tip, first)
+        self.assertIs(self.fork_choice.runner_up, second)
+        self.assertEqual(self.fork_choice.num_tips, 2)
+
+    def test_reorg(self):
+        root, _ = self.add(None)
+        main, _ = self.add(root)
+        main, _ = self.add(main)
+        fork, _ = self.add(root)
+        fork, _ = self.add(fork)
+        self.assertEqual((self.fork_choice.longest, self.fork_choice.second_longest, self.fork_choice.stale), (3, 3, 2))
+
+        fork, switch = self.add(fork)
+        self.assertEqual(switch, (main, root))
+        self.assertIs(self.fork_choice.tip, fork)
+        self.assertIs(self.fork_choice.runner_up, main)
+        self.assertEqual(self.reorgs, [(main, fork, root, 2)])
+        self.assertEqual((self.fork_choice.longest, self.fork_choice.second_longest, self.fork_choice.stale), (4, 3, 2))
+
+
+class TestOrphanPool(unittest.TestCase):
+
+    def test_pop_children(self):
+        pool = OrphanPool()
+        self.assertTrue(pool.add('a', 'p', 'block a'))
+        self.assertFalse(pool.add('a', 'p', 'block a'))
+        pool.add('b', 'p', 'block b')
+        pool.add('c', 'q', 'block c')
+        self.assertEqual(pool.get_parent('a'), 'p')
+        self.assertEqual(sorted(pool.pop_children('p')), [('a', 'block a'), ('b', 'block b')])
+        self.assertEqual(pool.pop_children('p'), [])
+        self.assertNotIn('a', pool)
+        self.assertIn('c', pool)
+
+    def test_evicts_oldest(self):
+        pool = OrphanPool(2)
+        pool.add('a', 'p', 'block a')
+        pool.add('b', 'p', 'block b')
+        pool.add('c', 'q', 'block c')
+        self.assertEqual(len(pool), 2)
+        self.assertNotIn('a', pool)
+        self.assertEqual(pool.pop_children('p'), [('b', 'block b')])
+
+    def test_discard(self):
+        pool = OrphanPool()
+        pool.add('a', 'p', 'block a')
+        pool.discard('a')
+        pool.discard('a')
+        self.assertEqual(pool.pop_children('p'), [])
+
 
 def get_test_blockchain(ledger_file, message_file, stats_file):
     return Blockchain(ledger_file, message_file, stats_file)
 
 
+def get_block_strs(file_name):
+    with open(file_name, 'r') as chain:
+        return chain.read().strip().split("\n")
+
+
+def make_chain(parent, length):
+    """Builds a chain of BlockNodes without blocks below parent."""
+    chain = []
+    for _ in range(length):
+        parent = BlockNode(None, parent)
+        chain.append(parent)
+    return chain
+
+
 def get_message_str(file):
     with open(file, 'r') as message:
         return message.read()
 
 
+def add_test_block(blockchain, parent_hash, i):
+    """Adds a block with made up posts, skipping the Proof-of-Work check."""
+    posts = [get_test_message(i * MSGS_PER_BLOCK + j) for j in range(MSGS_PER_BLOCK)]
+    block = Block('00', parent_hash, float(i), '0' * 64, posts)
+    blockchain._add_block(block, False, False)
+    return block
+
+
+def get_test_message(i):
+    return Message("sender", float(i), "message %d" % i, b"signature")
+
+
 def remove_file(file):
     if os.path.exists(file):
         os.remove(file)
@@ -0,0 +1,40 @@
+import unittest
+
+from bloom import BloomFilter, RollingBloomFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.001)
+        items = [str(i) for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+        self.assertEqual(len(bloom), 1000)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        false_positives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_clear(self):
+        bloom = BloomFilter(10, 0.01)
+        bloom.add('a')
+        bloom.clear()
+        self.assertNotIn('a', bloom)
+        self.assertEqual(len(bloom), 0)
+
+
+class TestRollingBloomFilter(unittest.TestCase):
+
+    def test_remembers_recent_items(self):
+        bloom = RollingBloomFilter(100, 0.001)
+        for i in range(250):
+            bloom.add(str(i))
+        # The last 100 items are always remembered
+        self.assertTrue(all(str(i) in bloom for i in range(150, 250)))
+        # Items from two generations ago are dropped
+        self.assertLess(sum(1 for i in range(100) if str(i) in bloom), 5)
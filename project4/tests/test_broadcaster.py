@@ -0,0 +1,147 @@
+import io
+import threading
+import unittest
+
+import broadcaster
+from blockchain_constants import *
+from broadcaster import BATCH_COMMANDS, SINGLE_COMMANDS, Broadcaster, PeerSender
+from inventory import inventory_hash
+from peers import PeerRegistry, Resolver
+
+
+class RecordingSender(PeerSender):
+    """PeerSender which records what it would send instead of connecting."""
+
+    def __init__(self, *args, **kwargs):
+        self.sent = []
+        self.done = threading.Event()
+        super().__init__(*args, **kwargs)
+        # Tests of INV turn this back on
+        self.announce = False
+
+    def _send_single(self, item_type, item):
+        self.sent.append((SINGLE_COMMANDS[item_type], [item]))
+
+    def _send_batch(self, item_type, items):
+        self.sent.append((BATCH_COMMANDS[item_type], items))
+
+    def send(self, batch):
+        super().send(batch)
+        self.done.set()
+
+
+def entries(*items):
+    return [(item_type, item, inventory_hash(item_type, item)) for item_type, item in items]
+
+
+class FakeResponse(io.StringIO):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TestPeerSender(unittest.TestCase):
+
+    def get_sender(self, announce=False):
+        sender = RecordingSender('peer')
+        # Only call send() directly
+        sender.stop()
+        sender.announce = announce
+        return sender
+
+    def test_single_item(self):
+        sender = self.get_sender()
+        sender.send(entries((MESSAGE_TYPE, 'm1')))
+        self.assertEqual(sender.sent, [("MESSAGE_BROADCAST", ['m1'])])
+
+    def test_batches_by_type_blocks_first(self):
+        sender = self.get_sender()
+        sender.send(entries((MESSAGE_TYPE, 'm1'), (BLOCK_TYPE, 'b1'), (MESSAGE_TYPE, 'm2'), (BLOCK_TYPE, 'b2')))
+        self.assertEqual(sender.sent, [("BLOCKS_BROADCAST", ['b1', 'b2']),
+                                       ("MESSAGES_BROADCAST", ['m1', 'm2'])])
+
+    def test_legacy_peer(self):
+        sender = self.get_sender()
+        sender.legacy = True
+        sender.send(entries((MESSAGE_TYPE, 'm1'), (MESSAGE_TYPE, 'm2')))
+        self.assertEqual(sender.sent, [("MESSAGE_BROADCAST", ['m1']), ("MESSAGE_BROADCAST", ['m2'])])
+
+    def test_announce_sends_wanted_items(self):
+        sender = self.get_sender(announce=True)
+        requests = []
+
+        def request(payload):
+            requests.append(payload)
+            return FakeResponse("1\n%d %s\n" % (MESSAGE_TYPE, inventory_hash(MESSAGE_TYPE, 'm2')))
+
+        sender._request = request
+        sender.send(entries((MESSAGE_TYPE, 'm1'), (MESSAGE_TYPE, 'm2')))
+        self.assertEqual(requests, ["INV\n2\n%d %s\n%d %s\n" % (MESSAGE_TYPE, inventory_hash(MESSAGE_TYPE, 'm1'),
+                                                                MESSAGE_TYPE, inventory_hash(MESSAGE_TYPE, 'm2'))])
+        self.assertEqual(sender.sent, [("MESSAGE_BROADCAST", ['m2'])])
+
+    def test_announce_legacy_peer(self):
+        sender = self.get_sender(announce=True)
+        sender._request = lambda payload: FakeResponse("ERROR Command not recognized\n")
+        sender.send(entries((MESSAGE_TYPE, 'm1')))
+        self.assertFalse(sender.announce)
+        self.assertEqual(sender.sent, [("MESSAGE_BROADCAST", ['m1'])])
+
+    def test_failure_reported(self):
+        failed = []
+        done = threading.Event()
+
+        def on_failure(host):
+            failed.append(host)
+            done.set()
+
+        # Nothing listens on this address
+        sender = PeerSender('127.0.0.2', on_failure)
+        sender.put(MESSAGE_TYPE, 'm1')
+        self.assertTrue(done.wait(TIMEOUT * 5))
+        sender.stop()
+        self.assertEqual(failed, ['127.0.0.2'])
+
+
+class TestBroadcaster(unittest.TestCase):
+
+    def setUp(self):
+        self.original = broadcaster.PeerSender
+        broadcaster.PeerSender = RecordingSender
+
+    def tearDown(self):
+        broadcaster.PeerSender = self.original
+
+    def test_broadcast_to_all_peers(self):
+        caster = Broadcaster()
+        caster.broadcast(['a', 'b'], MESSAGE_TYPE, 'm1')
+        self.assertEqual(set(caster.senders), {'a', 'b'})
+        for sender in caster.senders.values():
+            self.assertTrue(sender.done.wait(TIMEOUT))
+            self.assertEqual(sender.sent, [("MESSAGE_BROADCAST", ['m1'])])
+        caster.close()
+
+    def test_removed_peer_stopped(self):
+        caster = Broadcaster()
+        caster.broadcast(['a', 'b'], MESSAGE_TYPE, 'm1')
+        sender = caster.senders['b']
+        caster.broadcast(['a'], MESSAGE_TYPE, 'm2')
+        self.assertEqual(set(caster.senders), {'a'})
+        self.assertTrue(sender._stopped)
+        caster.close()
+
+    def test_backing_off_peer_kept(self):
+        peers = PeerRegistry(Resolver())
+        peers.add('10.0.0.1')
+        peers.add('10.0.0.2')
+        caster = Broadcaster()
+        caster.broadcast(peers.ranked(backing_off=True), MESSAGE_TYPE, 'm1')
+        sender = caster.senders['10.0.0.2']
+        peers.punish('10.0.0.2')
+        caster.broadcast(peers.ranked(backing_off=True), MESSAGE_TYPE, 'm2')
+        self.assertIs(caster.senders['10.0.0.2'], sender)
+        self.assertFalse(sender._stopped)
+        caster.close()
@@ -0,0 +1,35 @@
+import unittest
+
+from cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertIsNone(cache.pop('a'))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
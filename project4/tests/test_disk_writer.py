@@ -0,0 +1,107 @@
+import os
+import threading
+import unittest
+
+from blockchain_constants import *
+from disk_writer import DiskWriter
+from ledger import TextLedger
+
+
+class TestDiskWriter(unittest.TestCase):
+    ledger = 'tests/ledger.txt'
+    messages = 'tests/messages.txt'
+    stats = 'tests/stats.txt'
+
+    def setUp(self):
+        self.text_ledger = TextLedger(TestDiskWriter.ledger)
+        self.writer = DiskWriter(self.text_ledger, TestDiskWriter.messages, TestDiskWriter.stats, FSYNC_NEVER)
+
+    def tearDown(self):
+        self.writer.close()
+        self.text_ledger.close()
+        for file in [TestDiskWriter.ledger, TestDiskWriter.messages, TestDiskWriter.stats]:
+            if os.path.exists(file):
+                os.remove(file)
+
+    def read(self, file_name):
+        with open(file_name, 'r') as f:
+            return f.read()
+
+    def test_append_block(self):
+        offsets = []
+        self.writer.append_block('a', 'block a', offsets.append)
+        self.writer.append_block('b', 'block b', offsets.append)
+        self.writer.flush()
+        self.assertEqual(offsets, [0, 8])
+        self.assertEqual(self.text_ledger.read(offsets[1]), 'block b')
+
+    def test_messages_appended_and_truncated(self):
+        self.writer.append_messages(b"first\n")
+        self.writer.append_messages(b"second\n")
+        self.writer.truncate_messages(6)
+        self.writer.append_messages(b"third\n")
+        self.writer.flush()
+        self.assertEqual(self.read(TestDiskWriter.messages), "first\nthird\n")
+
+    def test_last_stats_written(self):
+        self.writer.write_stats("Longest chain: 1\n")
+        self.writer.write_stats("Longest chain: 2\n")
+        self.writer.flush()
+        self.assertEqual(self.read(TestDiskWriter.stats), "Longest chain: 2\n")
+
+    def test_close_writes_everything(self):
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def block_writer(offset):
+            blocked.set()
+            release.wait()
+
+        self.writer.append_block('a', 'block a', block_writer)
+        self.assertTrue(blocked.wait(TIMEOUT))
+        # Queued while the writer is busy, so written as one batch
+        for i in range(10):
+            self.writer.append_messages(b"message %d\n" % i)
+        release.set()
+        self.writer.close()
+        self.assertEqual(self.read(TestDiskWriter.messages), "".join("message %d\n" % i for i in range(10)))
+
+    def test_failed_append_reported(self):
+        original = self.text_ledger.append
+
+        def append(block_hash, block_str, flush=True):
+            if block_hash == 'bad':
+                raise OSError("No space left on device")
+            return original(block_hash, block_str, flush)
+
+        self.text_ledger.append = append
+        offsets = []
+        self.writer.append_block('bad', 'block bad', offsets.append)
+        self.writer.append_block('a', 'block a', offsets.append)
+        self.assertTrue(self.writer.flush(TIMEOUT))
+        self.assertEqual(offsets, [None, 0])
+
+    def test_writer_survives_callback_error(self):
+        def fail(offset):
+            raise RuntimeError("callback failed")
+
+        self.writer.append_block('a', 'block a', fail)
+        self.assertTrue(self.writer.flush(TIMEOUT))
+        offsets = []
+        self.writer.append_block('b', 'block b', offsets.append)
+        self.assertTrue(self.writer.flush(TIMEOUT))
+        self.assertEqual(offsets, [8])
+
+    def test_flush_after_failed_batch(self):
+        def fail():
+            raise OSError("Input/output error")
+
+        self.text_ledger.flush = fail
+        offsets = []
+        self.writer.append_block('a', 'block a', offsets.append)
+        self.assertTrue(self.writer.flush(TIMEOUT))
+        self.assertEqual(offsets, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import io
+import logging
+import queue
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import RateLimiter
+from blockchain_constants import *
+from inventory import Inventory, inventory_hash
+from network import Server
+
+
+class FakeBlockchain(object):
+
+    def __init__(self):
+        self.blocks = set()
+        self.messages = set()
+        self.invalid = set()
+        self.queue_full = False
+        self.orphans = set()
+
+    def has_block(self, block_hash):
+        return block_hash in self.blocks
+
+    def is_known_block(self, block_hash):
+        return block_hash in self.blocks or block_hash in self.invalid
+
+    def get_orphan_parent(self, block_hash):
+        return None
+
+    def add_block_str(self, block_str):
+        block_hash = inventory_hash(BLOCK_TYPE, block_str)
+        if block_str == 'invalid':
+            self.invalid.add(block_hash)
+            return False
+        if block_str.startswith('orphan'):
+            self.orphans.add(block_hash)
+            return False
+        self.blocks.add(block_hash)
+        return True
+
+    def has_message(self, digest):
+        return digest in self.messages
+
+    def is_known_message(self, digest):
+        return digest in self.messages or digest in self.invalid
+
+    def is_message_queue_full(self):
+        return self.queue_full
+
+    def add_message_str(self, msg_str):
+        digest = inventory_hash(MESSAGE_TYPE, msg_str)
+        if msg_str == 'invalid':
+            self.invalid.add(digest)
+            return False
+        self.messages.add(digest)
+        return True
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = FakeBlockchain()
+        self.inventory = Inventory(self.blockchain, 100, 0.001)
+
+    def test_want_new_item_once(self):
+        item_hash = inventory_hash(MESSAGE_TYPE, 'm1')
+        self.assertTrue(self.inventory.want(MESSAGE_TYPE, item_hash))
+        # Already asked another peer for it
+        self.assertFalse(self.inventory.want(MESSAGE_TYPE, item_hash))
+
+    def test_seen_item_not_wanted(self):
+        item_hash = self.inventory.add(BLOCK_TYPE, 'b1')
+        self.assertEqual(item_hash, inventory_hash(BLOCK_TYPE, 'b1'))
+        self.assertFalse(self.inventory.want(BLOCK_TYPE, item_hash))
+
+    def test_known_items_not_wanted(self):
+        block_hash = inventory_hash(BLOCK_TYPE, 'b1')
+        digest = inventory_hash(MESSAGE_TYPE, 'm1')
+        self.blockchain.blocks.add(block_hash)
+        self.blockchain.messages.add(digest)
+        self.assertFalse(self.inventory.want(BLOCK_TYPE, block_hash))
+        self.assertFalse(self.inventory.want(MESSAGE_TYPE, digest))
+
+
+def get_test_server(blockchain):
+    server = Server.__new__(Server)
+    server.log = logging.getLogger('Server')
+    server.blockchain = blockchain
+    server.inventory = Inventory(blockchain, 100, 0.001)
+    server.rate_limiter = RateLimiter()
+    server.broadcast_queue = queue.Queue()
+    server.accept_non_local_msgs = True
+    server.accept_blocks = True
+    return server
+
+
+class TestMessageBroadcastInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = FakeBlockchain()
+        self.server = get_test_server(self.blockchain)
+
+    def broadcast(self, msg_str):
+        f_out = io.StringIO()
+        self.server.handle_request(io.StringIO("MESSAGE_BROADCAST\n%s\n" % msg_str), f_out, ('127.0.0.1', 1))
+        return f_out.getvalue()
+
+    def test_message_refused_for_full_queue_still_wanted(self):
+        self.blockchain.queue_full = True
+        self.assertTrue(self.broadcast('m1').startswith("FAILURE - Message buffer full"))
+        self.assertTrue(self.server.inventory.want(MESSAGE_TYPE, inventory_hash(MESSAGE_TYPE, 'm1')))
+
+    def test_accepted_and_invalid_messages_seen(self):
+        self.assertEqual(self.broadcast('m1'), "ACK\n")
+        self.assertTrue(self.broadcast('invalid').startswith("FAILURE - Invalid"))
+        self.blockchain.messages.clear()
+        for msg_str in ['m1', 'invalid']:
+            self.assertIn(inventory_hash(MESSAGE_TYPE, msg_str), self.server.inventory.seen)
+
+
+class TestBlockBroadcastInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = FakeBlockchain()
+        self.server = get_test_server(self.blockchain)
+
+    def broadcast_block(self, block_str):
+        f_out = io.StringIO()
+        self.server.handle_request(io.StringIO("BLOCK_BROADCAST\n%s\n" % block_str), f_out, ('127.0.0.1', 1))
+        return f_out.getvalue()
+
+    def test_orphan_block_still_wanted(self):
+        self.assertTrue(self.broadcast_block('orphan b1').startswith("FAILURE"))
+        block_hash = inventory_hash(BLOCK_TYPE, 'orphan b1')
+        self.assertNotIn(block_hash, self.server.inventory.seen)
+        # Say it was evicted from the orphan pool: it is fetched again when announced
+        self.assertTrue(self.server.inventory.want(BLOCK_TYPE, block_hash))
+
+    def test_added_and_invalid_blocks_seen(self):
+        self.assertEqual(self.broadcast_block('b1'), "ACK\n")
+        self.assertTrue(self.broadcast_block('invalid').startswith("FAILURE"))
+        f_out = io.StringIO()
+        self.server.handle_request(io.StringIO("BLOCKS_BROADCAST\n2\nb2\norphan b3\n"), f_out, ('127.0.0.1', 1))
+        self.assertEqual(f_out.getvalue().split("\n")[0], "ACK")
+        for block_str in ['b1', 'invalid', 'b2']:
+            self.assertIn(inventory_hash(BLOCK_TYPE, block_str), self.server.inventory.seen)
+        self.assertNotIn(inventory_hash(BLOCK_TYPE, 'orphan b3'), self.server.inventory.seen)
+
+
+class FakeResponse(io.StringIO):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TestOrphanFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = FakeBlockchain()
+        self.server = get_test_server(self.blockchain)
+        self.server.fetching = set()
+        self.server.fetching_lock = threading.Lock()
+        self.server.orphan_fetcher = ThreadPoolExecutor(max_workers=ORPHAN_FETCH_THREADS)
+        self.replies = {}  # block hash -> block string sent for it
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = [0, 0]  # requests running now, most ever running at once
+        self.server.pool = self
+        self.parents = {}  # orphan hash -> missing parent hash
+        self.blockchain.get_orphan_parent = self.parents.get
+
+    def request(self, host, payload):
+        with self.lock:
+            self.running[0] += 1
+            self.running[1] = max(self.running)
+        self.release.wait(TIMEOUT)
+        with self.lock:
+            self.running[0] -= 1
+        return FakeResponse(self.replies.get(payload.split("\n")[1], "ERROR Block not found") + "\n")
+
+    def test_reply_checked_against_requested_hash(self):
+        self.release.set()
+        parent_hash = inventory_hash(BLOCK_TYPE, 'b1')
+        self.parents['orphan'] = parent_hash
+        self.replies[parent_hash] = 'b2'
+        self.server.request_orphan_parent('peer', 'orphan')
+        self.server.orphan_fetcher.shutdown(wait=True)
+        self.assertEqual(self.blockchain.blocks, set())
+
+        self.server.orphan_fetcher = ThreadPoolExecutor(max_workers=ORPHAN_FETCH_THREADS)
+        self.replies[parent_hash] = 'b1'
+        self.server.request_orphan_parent('peer', 'orphan')
+        self.server.orphan_fetcher.shutdown(wait=True)
+        self.assertEqual(self.blockchain.blocks, {parent_hash})
+        self.assertEqual(self.server.fetching, set())
+
+    def test_fetches_bounded(self):
+        for i in range(ORPHAN_FETCH_QUEUE * 2):
+            self.parents['orphan %d' % i] = 'parent %d' % i
+            self.server.request_orphan_parent('peer', 'orphan %d' % i)
+        # The same parent is not queued twice
+        self.server.request_orphan_parent('peer', 'orphan 0')
+        self.assertEqual(len(self.server.fetching), ORPHAN_FETCH_QUEUE)
+        self.release.set()
+        self.server.orphan_fetcher.shutdown(wait=True)
+        self.assertEqual(self.running[1], ORPHAN_FETCH_THREADS)
+        self.assertEqual(self.server.fetching, set())
+
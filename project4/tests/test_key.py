@@ -1,6 +1,6 @@
 import unittest
 
-from key import Keys
+from key import Keys, get_pem_hash, load_public_key, public_key_cache
 
 
 class TestKeyLoading(unittest.TestCase):
@@ -19,6 +19,18 @@ class TestKeyLoading(unittest.TestCase):
             data = test_key.read()
             self.assertIsNotNone(keys.look_up_private_keys(data))
 
+    def test_directory_keys_cached(self):
+        keys = Keys(TestKeyLoading.private, TestKeyLoading.public, TestKeyLoading.directory)
+        for key_hash, public_key in keys.pub_table.items():
+            self.assertIs(public_key_cache.get(key_hash), public_key)
+
+    def test_load_public_key_cached(self):
+        with open("tests/message_data/valid_public_sender_key.txt", 'r') as key_file:
+            pem = key_file.read()
+        public_key_cache.pop(get_pem_hash(pem))
+        public_key = load_public_key(pem)
+        self.assertIs(load_public_key(pem.encode()), public_key)
+
 
 if __name__ == '__main__':
     unittest.main()
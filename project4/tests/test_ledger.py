@@ -0,0 +1,165 @@
+import logging
+import os
+import unittest
+
+from blockchain import Blockchain
+from ledger import BinaryLedger, TextLedger, convert_text_ledger, open_ledger, LEDGER_MAGIC
+from objects import LazyBlock, parse_block, parse_lazy_block
+
+
+class TestLedger(unittest.TestCase):
+    example_ledger = 'tests/chain_data/ledger.txt'
+    binary_ledger = 'tests/ledger.bin'
+    text_ledger = 'tests/ledger.txt'
+    messages = 'tests/messages.txt'
+    stats = 'tests/stats.txt'
+
+    def setUp(self):
+        logging.getLogger("blockchain").disabled = True
+        with open(TestLedger.example_ledger, 'r') as ledger:
+            self.block_strs = ledger.read().strip().split("\n")
+
+    def tearDown(self):
+        for file in [TestLedger.binary_ledger, TestLedger.binary_ledger + '.idx', TestLedger.text_ledger,
+                     TestLedger.messages, TestLedger.stats]:
+            if os.path.exists(file):
+                os.remove(file)
+
+    def write_binary_ledger(self, count):
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        for block_str in self.block_strs[:count]:
+            ledger.append(parse_block(block_str).block_hash, block_str)
+        ledger.close()
+
+    def test_open_ledger(self):
+        self.assertIsInstance(open_ledger(TestLedger.text_ledger), TextLedger)
+        ledger = open_ledger(TestLedger.binary_ledger)
+        self.assertIsInstance(ledger, BinaryLedger)
+        ledger.close()
+
+    def test_text_ledger_offsets(self):
+        ledger = TextLedger(TestLedger.example_ledger)
+        for block_hash, offset, block_str in ledger:
+            self.assertIsNone(block_hash)
+            self.assertEqual(ledger.read(offset), block_str)
+
+    def test_binary_round_trip(self):
+        self.write_binary_ledger(len(self.block_strs))
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        records = list(ledger)
+        self.assertEqual([block_str for _, _, block_str in records], self.block_strs)
+        for block_hash, offset, block_str in records:
+            self.assertEqual(parse_block(block_str).block_hash, block_hash)
+            self.assertEqual(ledger.read(offset), block_str)
+            self.assertEqual(ledger.get_block_str(block_hash), block_str)
+        ledger.close()
+
+    def test_index_reloaded(self):
+        self.write_binary_ledger(3)
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual(len(ledger.offsets), 3)
+        ledger.close()
+
+    def test_missing_index_rebuilt(self):
+        self.write_binary_ledger(3)
+        os.remove(TestLedger.binary_ledger + '.idx')
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual(len(ledger.offsets), 3)
+        ledger.close()
+
+    def test_corrupt_tail_truncated(self):
+        self.write_binary_ledger(3)
+        size = os.path.getsize(TestLedger.binary_ledger)
+        with open(TestLedger.binary_ledger, 'r+b') as ledger:
+            ledger.seek(size - 10)
+            ledger.write(b'corrupted!')
+
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual([block_str for _, _, block_str in ledger], self.block_strs[:2])
+        ledger.append(parse_block(self.block_strs[2]).block_hash, self.block_strs[2])
+        ledger.close()
+
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual([block_str for _, _, block_str in ledger], self.block_strs[:3])
+        ledger.close()
+
+    def test_not_binary_ledger(self):
+        with open(TestLedger.binary_ledger, 'w') as ledger:
+            ledger.write(self.block_strs[0])
+        self.assertRaises(ValueError, BinaryLedger, TestLedger.binary_ledger)
+
+    def test_empty_file(self):
+        open(TestLedger.binary_ledger, 'w').close()
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual(list(ledger), [])
+        ledger.close()
+        with open(TestLedger.binary_ledger, 'rb') as ledger:
+            self.assertEqual(ledger.read(), LEDGER_MAGIC)
+
+    def test_lazy_block(self):
+        self.write_binary_ledger(len(self.block_strs))
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        for block_hash, offset, block_str in ledger:
+            block = parse_block(block_str)
+            lazy_block = parse_lazy_block(block_str, block_hash, ledger, offset)
+            self.assertEqual(lazy_block.parent_hash, block.parent_hash)
+            self.assertEqual(lazy_block.create_time, block.create_time)
+            self.assertEqual(lazy_block.miner_key_hash, block.miner_key_hash)
+            self.assertEqual(lazy_block.nonce, block.nonce)
+            self.assertEqual(repr(lazy_block), block_str)
+            self.assertEqual(list(map(repr, lazy_block.posts)), list(map(repr, block.posts)))
+            self.assertEqual(lazy_block.post_digests, block.post_digests)
+        ledger.close()
+
+    def test_convert_and_load(self):
+        self.assertEqual(convert_text_ledger(TestLedger.example_ledger, TestLedger.binary_ledger),
+                         len(self.block_strs))
+        blockchain = Blockchain(TestLedger.binary_ledger, TestLedger.messages, TestLedger.stats)
+        self.assertEqual(len(blockchain.get_all_block_strs(0)), len(self.block_strs))
+        self.assertTrue(all(isinstance(node.block, LazyBlock) for node in blockchain.blocks.values()))
+        blockchain.close()
+
+    def test_reads_cached(self):
+        self.write_binary_ledger(2)
+        for ledger in [TextLedger(TestLedger.example_ledger), BinaryLedger(TestLedger.binary_ledger)]:
+            offsets = [offset for _, offset, _ in ledger]
+            self.assertEqual(ledger.read(offsets[1]), self.block_strs[1])
+            self.assertEqual(ledger.cache.get(offsets[1]), self.block_strs[1])
+            self.assertIsNone(ledger.cache.get(offsets[0]))
+            self.assertEqual(ledger.read(offsets[1]), self.block_strs[1])
+            ledger.close()
+
+    def test_load_text_ledger_lazily(self):
+        with open(TestLedger.text_ledger, 'w') as ledger:
+            ledger.write("\n".join(self.block_strs) + "\n")
+        blockchain = Blockchain(TestLedger.text_ledger, TestLedger.messages, TestLedger.stats)
+        self.assertTrue(all(isinstance(node.block, LazyBlock) for node in blockchain.blocks.values()))
+        self.assertEqual(sorted(blockchain.get_all_block_strs(-1)), sorted(self.block_strs))
+        blockchain.close()
+
+    def test_unflushed_records_hidden(self):
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        block_hash = parse_block(self.block_strs[0]).block_hash
+        offset = ledger.append(block_hash, self.block_strs[0], flush=False)
+        self.assertIsNone(ledger.get_block_str(block_hash))
+        self.assertEqual(list(ledger), [])
+        ledger.flush()
+        self.assertEqual(ledger.get_block_str(block_hash), self.block_strs[0])
+        self.assertEqual(list(ledger), [(block_hash, offset, self.block_strs[0])])
+        ledger.close()
+
+    def test_blocks_written_in_background(self):
+        blockchain = Blockchain(TestLedger.binary_ledger, TestLedger.messages, TestLedger.stats)
+        for block_str in self.block_strs:
+            blockchain.add_block_str(block_str)
+        blockchain.flush()
+        self.assertTrue(all(isinstance(node.block, LazyBlock) for node in blockchain.blocks.values()))
+        blockchain.close()
+
+        ledger = BinaryLedger(TestLedger.binary_ledger)
+        self.assertEqual(sorted(block_str for _, _, block_str in ledger), sorted(self.block_strs))
+        ledger.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import io
+import logging
+import socket
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from blockchain_constants import *
+from link import FRAME_CANCEL, FRAME_CREDIT, FRAME_HEADER, FRAME_MORE, FrameWriter, LinkResponse, RequestCancelled, \
+    pack_frame, read_frame
+from network import Server
+
+
+class FakeLink(object):
+    host = 'peer'
+
+    def __init__(self):
+        self.discarded = []
+        self.granted = []
+        self.cancelled = []
+
+    def grant(self, request_id, credit):
+        self.granted.append((request_id, credit))
+
+    def cancel(self, request_id):
+        self.cancelled.append(request_id)
+
+    def discard(self, request_id):
+        self.discarded.append(request_id)
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = io.BytesIO(pack_frame(7, FRAME_MORE, b"PEER_REQUEST\n") + pack_frame(8, 0, b""))
+        self.assertEqual(read_frame(data), (7, FRAME_MORE, b"PEER_REQUEST\n"))
+        self.assertEqual(read_frame(data), (8, 0, b""))
+        self.assertIsNone(read_frame(data))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            read_frame(io.BytesIO(pack_frame(1, 0, b"PEER_REQUEST\n")[:-1]))
+        with self.assertRaises(ValueError):
+            read_frame(io.BytesIO(b"\x00\x00"))
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            read_frame(io.BytesIO(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, 1, 0)))
+
+    def test_frame_writer(self):
+        frames = []
+        f_out = FrameWriter(lambda *frame: frames.append(frame), 3)
+        f_out.write("2\n")
+        f_out.write("a\n")
+        f_out.flush()
+        f_out.flush()
+        f_out.write("b\n")
+        f_out.close()
+        self.assertEqual(frames, [(3, FRAME_MORE, b"2\na\n"), (3, 0, b"b\n")])
+
+    def test_frame_writer_waits_for_credit(self):
+        frames = []
+        f_out = FrameWriter(lambda *frame: frames.append(frame), 3, window=2)
+        sent = threading.Event()
+
+        def stream():
+            for i in range(4):
+                f_out.write("%d\n" % i)
+                f_out.flush()
+            sent.set()
+
+        threading.Thread(target=stream).start()
+        self.assertFalse(sent.wait(0.1))
+        self.assertEqual(len(frames), 2)
+        f_out.control(FRAME_CREDIT, b"2")
+        self.assertTrue(sent.wait(TIMEOUT))
+        self.assertEqual(len(frames), 4)
+
+    def test_frame_writer_cancelled(self):
+        frames = []
+        f_out = FrameWriter(lambda *frame: frames.append(frame), 3, window=1)
+        f_out.write("a\n")
+        f_out.flush()
+        f_out.control(FRAME_CANCEL, b'')
+        f_out.write("b\n")
+        with self.assertRaises(RequestCancelled):
+            f_out.flush()
+        f_out.close()
+        self.assertEqual(frames, [(3, FRAME_MORE, b"a\n")])
+        with self.assertRaises(ValueError):
+            f_out.control(FRAME_CREDIT, b"0")
+
+
+class TestLinkResponse(unittest.TestCase):
+
+    def test_readline_across_frames(self):
+        link = FakeLink()
+        response = LinkResponse(link, 5)
+        response.feed(b"2\nfir", False)
+        response.feed(b"st\nsecond", False)
+        response.feed(b"\n", True)
+        self.assertEqual(response.readline(), "2\n")
+        self.assertEqual(response.readline(), "first\n")
+        self.assertEqual(response.readline(), "second\n")
+        self.assertEqual(response.readline(), "")
+        response.close()
+        self.assertEqual(link.discarded, [5])
+        self.assertEqual(link.cancelled, [])
+
+    def test_window_bounded(self):
+        link = FakeLink()
+        response = LinkResponse(link, 5)
+        for i in range(LINK_RESPONSE_WINDOW):
+            self.assertTrue(response.feed(b"%d\n" % i, False))
+        # The peer did not wait for credit
+        self.assertFalse(response.feed(b"more\n", False))
+
+        for i in range(LINK_RESPONSE_WINDOW):
+            self.assertEqual(response.readline(), "%d\n" % i)
+        self.assertEqual(sum(credit for _, credit in link.granted), LINK_RESPONSE_WINDOW)
+        response.close()
+        self.assertEqual(link.cancelled, [5])
+
+    def test_link_closed(self):
+        response = LinkResponse(FakeLink(), 5)
+        response.feed(b"partial", False)
+        response.feed(None, True)
+        self.assertEqual(response.readline(), "partial")
+        self.assertEqual(response.readline(), "")
+
+    def test_timeout(self):
+        response = LinkResponse(FakeLink(), 5)
+        with self.assertRaises(OSError):
+            response.readline()
+
+
+class TestServeLink(unittest.TestCase):
+
+    def test_requests_in_flight_bounded(self):
+        server = Server.__new__(Server)
+        server.log = logging.getLogger('Server')
+        server.link_executor = ThreadPoolExecutor(max_workers=LINK_MAX_IN_FLIGHT * 2)
+        lock = threading.Lock()
+        running = [0, 0]  # handlers running now, most ever running at once
+        release = threading.Event()
+
+        def handle_frame(payload, f_out, cl_addr):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(TIMEOUT)
+            with lock:
+                running[0] -= 1
+
+        server.handle_frame = handle_frame
+
+        listener = socket.create_server(('127.0.0.1', 0))
+        client = socket.create_connection(listener.getsockname())
+        conn, cl_addr = listener.accept()
+        serving = threading.Thread(target=server.serve_link, args=(conn, conn.makefile('rb'), cl_addr))
+        serving.start()
+        client.sendall(b"".join(pack_frame(i + 1, 0, b"PEER_REQUEST\n") for i in range(LINK_MAX_IN_FLIGHT * 2)))
+        threading.Timer(0.2, release.set).start()
+        client.recv(3)
+        client.close()
+        serving.join(TIMEOUT * 2)
+        server.link_executor.shutdown()
+        conn.close()
+        listener.close()
+        self.assertEqual(running[1], LINK_MAX_IN_FLIGHT)
@@ -0,0 +1,55 @@
+import hashlib
+import unittest
+
+from miner import MiningPool, search_nonces
+from objects import Block, parse_block, get_block_suffix
+
+
+class TestMiner(unittest.TestCase):
+    block_data_path = 'tests/block_data/'
+    hardness = 2
+
+    def setUp(self):
+        with open(TestMiner.block_data_path + 'valid_block.txt', 'r') as data:
+            self.block = parse_block(data.read())
+
+    def get_suffix(self):
+        return get_block_suffix(self.block.parent_hash, self.block.miner_key_hash, self.block.create_time,
+                                self.block.posts)
+
+    def test_block_suffix(self):
+        self.assertEqual(repr(self.block), self.block.nonce + self.get_suffix())
+
+    def test_search_nonces(self):
+        nonce = search_nonces(self.get_suffix().encode(), 0, 100000, TestMiner.hardness)
+        self.assertIsNotNone(nonce)
+
+        block = Block(nonce, self.block.parent_hash, self.block.create_time, self.block.miner_key_hash,
+                      self.block.posts)
+        self.assertTrue(block.block_hash.startswith('0' * TestMiner.hardness))
+
+    def test_search_nonces_none_found(self):
+        self.assertIsNone(search_nonces(self.get_suffix().encode(), 0, 10, 64))
+
+    def test_search_nonces_odd_hardness(self):
+        suffix = self.get_suffix().encode()
+        nonce = search_nonces(suffix, 0, 100000, 3)
+        self.assertIsNotNone(nonce)
+        self.assertTrue(hashlib.sha512(nonce.encode() + suffix).hexdigest().startswith('000'))
+
+    def test_mining_pool(self):
+        pool = MiningPool(2, TestMiner.hardness)
+        try:
+            job_id = pool.submit(self.get_suffix())
+            nonce = pool.get_result(job_id, 10)
+        finally:
+            pool.close()
+
+        self.assertIsNotNone(nonce)
+        block = Block(nonce, self.block.parent_hash, self.block.create_time, self.block.miner_key_hash,
+                      self.block.posts)
+        self.assertTrue(block.block_hash.startswith('0' * TestMiner.hardness))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ import unittest
 
 from blockchain_constants import MSGS_PER_BLOCK
 from key import Keys
-from objects import parse_block, parse_message
+from objects import parse_block, parse_message, signature_cache
 
 private = "tests/key_data/private_keys.pem"
 public = "tests/key_data/public_keys.pem"
@@ -151,6 +151,11 @@ class TestMessageParsing(unittest.TestCase):
             string = data.read()
             self.assertEqual(repr(parse_message(string)), string)
 
+    def test_private_to_string(self):
+        with open(TestMessageParsing.message_data_path + 'valid_private.txt', 'r') as data:
+            string = data.read()
+            self.assertEqual(repr(parse_message(string)), string)
+
     def test_parsing_data(self):
         with open(TestMessageParsing.message_data_path + 'valid_public.txt', 'r') as data:
             message = parse_message(data.read())
@@ -182,6 +187,14 @@ class TestMessageParsing(unittest.TestCase):
             message = parse_message(data.read())
             self.assertFalse(message.verify_signature())
 
+    def test_signature_cached(self):
+        with open(TestMessageParsing.message_data_path + 'public_wrong_signature.txt', 'r') as data:
+            message = parse_message(data.read())
+            signature_cache.pop(message.digest)
+            self.assertFalse(message.verify_signature())
+            self.assertIs(signature_cache.get(message.digest), False)
+            self.assertFalse(message.verify_signature())
+
     def test_get_public_message(self):
         with open(TestMessageParsing.message_data_path + 'valid_public.txt', 'r') as data:
             message = parse_message(data.read())
@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+import unittest
+
+from blockchain_constants import *
+from network import Server
+from peers import PeerRegistry, PeerStats, Prober, Resolver, is_address
+
+
+class FakeDNS(object):
+    """Resolves host names from a dict, blocking until released."""
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.released = threading.Event()
+        self.lookups = []
+
+    def __call__(self, host):
+        self.lookups.append(host)
+        self.released.wait(TIMEOUT)
+        if host not in self.addresses:
+            raise OSError("Name or service not known")
+        return self.addresses[host]
+
+
+def wait_resolved(resolver, host):
+    done = threading.Event()
+    resolver.resolve_async(host, lambda *args: done.set())
+    return done.wait(TIMEOUT)
+
+
+class TestPeers(unittest.TestCase):
+
+    def setUp(self):
+        self.dns = FakeDNS({'peer.example': '10.0.0.1'})
+        self.resolver = Resolver(ttl=60, resolve=self.dns)
+        self.peers = PeerRegistry(self.resolver, capacity=3)
+
+    def tearDown(self):
+        self.dns.released.set()
+
+    def test_is_address(self):
+        self.assertTrue(is_address('10.0.0.1'))
+        self.assertTrue(is_address('::1'))
+        self.assertFalse(is_address('peer.example'))
+
+    def test_lookup_does_not_block(self):
+        self.assertIsNone(self.resolver.lookup('peer.example'))
+        self.dns.released.set()
+        self.assertTrue(wait_resolved(self.resolver, 'peer.example'))
+        self.assertEqual(self.resolver.lookup('peer.example'), '10.0.0.1')
+        self.assertEqual(self.dns.lookups, ['peer.example'])
+
+    def test_peer_rekeyed_by_address(self):
+        self.assertTrue(self.peers.add('peer.example'))
+        self.assertEqual(self.peers.hosts(), ['peer.example'])
+        self.dns.released.set()
+        self.assertTrue(wait_resolved(self.resolver, 'peer.example'))
+
+        self.assertEqual(self.peers.hosts(), ['10.0.0.1'])
+        self.assertIn('10.0.0.1', self.peers)
+        self.assertIn('peer.example', self.peers)
+        self.assertFalse(self.peers.add('10.0.0.1'))
+
+    def test_unresolvable_peer_kept_by_name(self):
+        self.dns.released.set()
+        self.assertTrue(self.peers.add('unknown.example'))
+        self.assertTrue(wait_resolved(self.resolver, 'unknown.example'))
+        self.assertEqual(self.peers.hosts(), ['unknown.example'])
+
+    def test_punish_and_remove(self):
+        self.peers.add('10.0.0.2')
+        for _ in range(MAX_PEER_FAILURE):
+            self.assertTrue(self.peers.punish('10.0.0.2'))
+        self.assertEqual(self.peers.items(), [('10.0.0.2', MAX_PEER_FAILURE)])
+        self.assertTrue(self.peers.punish('10.0.0.2'))
+        self.assertNotIn('10.0.0.2', self.peers)
+        self.assertFalse(self.peers.punish('10.0.0.2'))
+
+    def test_backoff_and_ranking(self):
+        for host in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            self.peers.add(host)
+        self.peers.record('10.0.0.1', 0.5)
+        self.peers.record('10.0.0.2', 0.05)
+        self.peers.credit('10.0.0.3', 10)
+        self.assertEqual(self.peers.ranked(), ['10.0.0.3', '10.0.0.2', '10.0.0.1'])
+
+        now = time.time()
+        self.peers.punish('10.0.0.3')
+        self.peers.punish('10.0.0.3')
+        self.assertEqual(self.peers.ranked(now), ['10.0.0.2', '10.0.0.1'])
+        backoff = self.peers.stats('10.0.0.3').backoff_until - now
+        self.assertGreaterEqual(backoff, 2 * PEER_BACKOFF_BASE)
+        self.assertLess(backoff, 4 * PEER_BACKOFF_BASE)
+        self.assertIn('10.0.0.3', self.peers.ranked(now + PEER_BACKOFF_MAX))
+        self.assertEqual(self.peers.ranked(now, backing_off=True), ['10.0.0.2', '10.0.0.1', '10.0.0.3'])
+
+        # A success ends the backoff
+        self.peers.record('10.0.0.3', 0.1)
+        self.assertEqual(self.peers.stats('10.0.0.3').failures, 0)
+        self.assertIn('10.0.0.3', self.peers.ranked())
+
+    def test_stats_saved_in_lines(self):
+        self.peers.add('10.0.0.1')
+        self.peers.record('10.0.0.1', 0.25, blocks=10)
+        self.peers.punish('10.0.0.1')
+        self.assertTrue(self.peers.dirty)
+        lines = self.peers.lines()
+        self.assertFalse(self.peers.dirty)
+
+        fields = lines[0].split()
+        self.assertEqual(fields[0], '10.0.0.1')
+        stats = PeerStats.parse(fields[1:])
+        self.assertEqual(stats.format(), self.peers.stats('10.0.0.1').format())
+        with self.assertRaises(ValueError):
+            PeerStats.parse(['0.1'])
+
+    def test_same_host(self):
+        self.peers.add('peer.example')
+        self.assertTrue(self.peers.same_host('peer.example', 'peer.example'))
+        self.assertFalse(self.peers.same_host('10.0.0.1', 'peer.example'))
+        self.dns.released.set()
+        self.assertTrue(wait_resolved(self.resolver, 'peer.example'))
+        self.assertTrue(self.peers.same_host('10.0.0.1', 'peer.example'))
+        self.assertFalse(self.peers.same_host('10.0.0.2', 'peer.example'))
+
+    def test_main_host_not_punished_by_address(self):
+        self.dns.addresses[MAIN_HOST] = '10.0.0.9'
+        self.dns.released.set()
+        server = Server.__new__(Server)
+        server.log = logging.getLogger('Server')
+        server.peers = self.peers
+        self.peers.add(MAIN_HOST)
+        self.assertTrue(wait_resolved(self.resolver, MAIN_HOST))
+        self.assertEqual(self.peers.hosts(), ['10.0.0.9'])
+
+        for _ in range(MAX_PEER_FAILURE + 1):
+            server.punish_peer('10.0.0.9')
+        self.assertIn('10.0.0.9', self.peers)
+        self.assertEqual(self.peers.stats('10.0.0.9').failures, 0)
+
+    def test_capacity(self):
+        for i in range(3):
+            self.assertTrue(self.peers.add('10.0.0.%d' % i))
+        self.assertFalse(self.peers.add('10.0.0.9'))
+        self.assertEqual(len(self.peers), 3)
+
+
+class TestProber(unittest.TestCase):
+
+    def test_probes_run_at_once(self):
+        barrier = threading.Barrier(4, timeout=TIMEOUT)
+
+        def probe(host):
+            barrier.wait()
+            return host.upper()
+
+        confirmed = []
+        results, failed = Prober(workers=4).map(probe, ['a', 'b', 'c', 'd'],
+                                                on_result=lambda host, result: confirmed.append(host))
+        self.assertEqual(results, {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'})
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(confirmed), ['a', 'b', 'c', 'd'])
+
+    def test_errors_and_deadline(self):
+        release = threading.Event()
+
+        def probe(host):
+            if host == 'slow':
+                release.wait(TIMEOUT)
+            elif host == 'down':
+                raise OSError("Connection refused")
+            return True
+
+        start = time.time()
+        results, failed = Prober(workers=2, deadline=0.2).map(probe, ['slow', 'down', 'up'])
+        release.set()
+        self.assertLess(time.time() - start, TIMEOUT)
+        self.assertEqual(results, {'up': True})
+        self.assertEqual(sorted(failed), ['down', 'slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import io
+import threading
+import time
+import unittest
+
+from blockchain_constants import *
+from inventory import inventory_hash
+from objects import parse_block
+from peers import PeerRegistry, Resolver
+from sync import BlockHeader, SyncManager, format_header, parse_header
+
+
+class FakeBlockchain(object):
+
+    def __init__(self):
+        self.depths = {}  # block hash -> depth
+        self.added = []
+
+    def has_block(self, block_hash):
+        return block_hash in self.depths
+
+    def get_block_depth(self, block_hash):
+        return self.depths.get(block_hash)
+
+    def add_block_str(self, block_str):
+        block = parse_block(block_str)
+        parent_depth = 0 if block.is_root() else self.depths.get(block.parent_hash)
+        if parent_depth is None:
+            return False
+        self.depths[inventory_hash(BLOCK_TYPE, block_str)] = parent_depth + 1
+        self.added.append(block_str)
+        return True
+
+
+class FakeResponse(io.StringIO):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakePool(object):
+    """Answers HEADERS_REQUEST and BLOCKS_REQUEST from the block strings each host has."""
+
+    def __init__(self, peers):
+        self.peers = peers  # host -> block strings, or None for a legacy peer
+        self.requested = {}  # host -> block hashes asked for
+        self.hung = set()  # hosts which never answer
+        self.release = threading.Event()
+        self.delay = 0.0  # seconds every request takes
+
+    def request(self, host, payload):
+        if host in self.hung:
+            self.release.wait(TIMEOUT)
+        time.sleep(self.delay)
+        if host not in self.peers:
+            raise OSError("Connection refused")
+        block_strs = self.peers[host]
+        if block_strs is None:
+            return FakeResponse("ERROR Command not recognized\n")
+        by_hash = {inventory_hash(BLOCK_TYPE, block_str): block_str for block_str in block_strs}
+
+        lines = payload.split("\n")
+        if lines[0] == "HEADERS_REQUEST":
+            headers = [format_header(block_hash, block.parent_hash, block.create_time, block.miner_key_hash)
+                       for block_hash, block in ((h, parse_block(s)) for h, s in by_hash.items())]
+            return FakeResponse("%d\n" % len(headers) + "".join(headers))
+
+        hashes = lines[2:2 + int(lines[1])]
+        self.requested.setdefault(host, []).extend(hashes)
+        return FakeResponse("".join(by_hash.get(block_hash, "ERROR Block not found") + "\n"
+                                    for block_hash in hashes))
+
+
+def get_block_strs(file_name):
+    with open(file_name, 'r') as chain:
+        return chain.read().strip().split("\n")
+
+
+class TestSync(unittest.TestCase):
+    valid_chain = 'tests/chain_data/valid_chain.txt'
+
+    def setUp(self):
+        self.block_strs = get_block_strs(TestSync.valid_chain)
+        self.hashes = [inventory_hash(BLOCK_TYPE, block_str) for block_str in self.block_strs]
+        self.blockchain = FakeBlockchain()
+
+    def test_header_round_trip(self):
+        header = BlockHeader('ab' * 64, '0' * 36, 1519773893.9249759, 'cd' * 32)
+        self.assertEqual(parse_header(format_header(*header)), header)
+        with self.assertRaises(ValueError):
+            parse_header("abc def\n")
+
+    def test_each_block_downloaded_once(self):
+        pool = FakePool({'a': self.block_strs, 'b': self.block_strs, 'c': self.block_strs[:2]})
+        added, failed, legacy = SyncManager(self.blockchain, pool, batch_size=2).sync(['a', 'b', 'c'], 0)
+        self.assertEqual((added, failed, legacy), (5, set(), set()))
+        self.assertEqual(self.blockchain.added, self.block_strs)
+
+        requested = [block_hash for hashes in pool.requested.values() for block_hash in hashes]
+        self.assertEqual(sorted(requested), sorted(self.hashes))
+        # Spread across the peers
+        self.assertGreater(len(pool.requested), 1)
+
+    def test_failed_and_legacy_peers(self):
+        pool = FakePool({'a': self.block_strs, 'legacy': None})
+        added, failed, legacy = SyncManager(self.blockchain, pool).sync(['a', 'down', 'legacy'], 0)
+        self.assertEqual((added, failed, legacy), (5, {'down'}, {'legacy'}))
+
+    def test_hung_peer_skipped(self):
+        pool = FakePool({'a': self.block_strs, 'slow': self.block_strs})
+        pool.hung.add('slow')
+        start = time.time()
+        added, failed, legacy = SyncManager(self.blockchain, pool, deadline=0.2).sync(['a', 'slow'], 0)
+        pool.release.set()
+        self.assertLess(time.time() - start, TIMEOUT)
+        self.assertEqual((added, failed, legacy), (5, {'slow'}, set()))
+
+    def test_deadline_from_request_start(self):
+        hosts = ['a', 'b', 'c']
+        pool = FakePool({host: self.block_strs for host in hosts})
+        pool.delay = 0.1
+        # Each request waits for the one before it, but is only held to its own deadline
+        added, failed, legacy = SyncManager(self.blockchain, pool, workers=1, deadline=0.25).sync(hosts, 0)
+        self.assertEqual((added, failed, legacy), (5, set(), set()))
+
+    def test_queued_request_not_failed(self):
+        pool = FakePool({'a': self.block_strs, 'slow': self.block_strs})
+        pool.hung.add('slow')
+        start = time.time()
+        added, failed, legacy = SyncManager(self.blockchain, pool, workers=1, deadline=0.2).sync(['slow', 'a'], 0)
+        pool.release.set()
+        self.assertLess(time.time() - start, TIMEOUT)
+        # a was never asked, since slow held the only worker
+        self.assertEqual((added, failed, legacy), (0, {'slow'}, set()))
+
+    def test_peers_credited(self):
+        peers = PeerRegistry(Resolver(), capacity=MAX_PEERS)
+        peers.add('10.0.0.1')
+        peers.add('10.0.0.2')
+        pool = FakePool({'10.0.0.1': self.block_strs, '10.0.0.2': self.block_strs[:1]})
+        SyncManager(self.blockchain, pool, peers=peers).sync(['10.0.0.1', '10.0.0.2'], 0)
+        self.assertGreater(peers.stats('10.0.0.1').useful, peers.stats('10.0.0.2').useful)
+        self.assertGreater(peers.stats('10.0.0.1').throughput, 0)
+        self.assertEqual(peers.ranked()[0], '10.0.0.1')
+
+    def test_missing_block_asked_of_other_peer(self):
+        pool = FakePool({'a': self.block_strs, 'b': self.block_strs})
+        sync = SyncManager(self.blockchain, pool)
+        headers = {header.block_hash: header for header in sync.request_headers('a', 0)}
+        # b announces every block, but does not have the last one after all
+        pool.peers['b'] = self.block_strs[:4]
+        sources = {block_hash: ['b', 'a'] for block_hash in headers}
+        added = sync.download(ThreadPoolExecutorStub(), sync.plan(headers), sources, set())
+        self.assertEqual(added, 5)
+        self.assertIn(self.hashes[4], pool.requested['b'])
+        self.assertIn(self.hashes[4], pool.requested['a'])
+
+    def test_plan_orders_and_drops_unconnected(self):
+        sync = SyncManager(self.blockchain, FakePool({}))
+        self.blockchain.add_block_str(self.block_strs[0])
+        headers = {header.block_hash: header for header in
+                   [BlockHeader(self.hashes[i], self.hashes[i - 1], float(i), 'm') for i in range(1, 5)] +
+                   [BlockHeader('fork', self.hashes[0], 0.0, 'm'),
+                    BlockHeader('orphan', 'unknown', 0.0, 'm'),
+                    BlockHeader('x', 'y', 0.0, 'm'), BlockHeader('y', 'x', 0.0, 'm')]}
+        self.assertEqual(sync.plan(headers), self.hashes[1:] + ['fork'])
+
+
+class ThreadPoolExecutorStub(object):
+    """Runs submitted calls right away."""
+
+    def submit(self, fn, *args):
+        future = FutureStub()
+        try:
+            future.value = fn(*args)
+        except Exception as e:
+            future.error = e
+        return future
+
+
+class FutureStub(object):
+    value = None
+    error = None
+
+    def done(self):
+        return True
+
+    def cancelled(self):
+        return False
+
+    def result(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+if __name__ == '__main__':
+    unittest.main()
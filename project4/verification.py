@@ -0,0 +1,64 @@
+"""Verifies message signatures on a pool of worker threads."""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from blockchain_constants import *
+
+log = logging.getLogger('blockchain')
+
+
+def verify_message(message):
+    """
+    Checks the signature of a single Message.
+
+    Unlike Message.verify_signature, this never raises: a malformed sender key
+    counts as an invalid signature.
+
+    :rtype: bool
+    """
+    try:
+        return message is not None and message.verify_signature()
+    except (ValueError, TypeError) as e:
+        log.debug("Error verifying message signature: %s", e)
+        return False
+
+
+class VerificationPool(object):
+
+    def __init__(self, workers=VERIFY_WORKERS):
+        """
+        Verifies batches of message signatures in parallel.
+
+        The cryptography backend releases the GIL while it checks RSA
+        signatures, so a pool of threads verifies a batch (e.g. the posts of a
+        block or a burst of broadcast messages) on several cores at once.
+
+        :param workers: Number of verification threads
+        """
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def verify_all(self, messages):
+        """
+        Verifies the signatures of a batch of messages.
+
+        Single messages are verified on the calling thread, since handing them
+        to the pool would only add latency.
+
+        :param messages: Messages to verify. None entries count as invalid.
+        :return: List of bools, in the same order as messages
+        """
+        if len(messages) <= 1:
+            return [verify_message(message) for message in messages]
+        return list(self._executor.map(verify_message, messages))
+
+    def submit(self, message):
+        """
+        Verifies a single message in the background.
+
+        :return: Future holding the result of verify_message()
+        """
+        return self._executor.submit(verify_message, message)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)